@@ -0,0 +1,226 @@
+"""Latency and query-count benchmarks for soundauth's hot paths.
+
+    python -m benchmarks.run                  # print results
+    python -m benchmarks.run --save           # record them as the baseline
+    python -m benchmarks.run --check          # exit 1 on regressions
+
+Query counts are deterministic and must not go above the baseline.
+Latencies depend on the machine, so they're only checked with --latency,
+against a baseline saved on the same machine: median latencies may then
+drift by --tolerance (a fraction) before counting as a regression.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import bcrypt
+import sqlalchemy
+
+from soundauth import account
+from soundauth import auth
+from soundauth import db
+from soundauth import group
+from soundauth import rule
+
+from . import workloads
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+MODES = {
+    "query": lambda: None,
+    "graph": group.load_graph,
+    "recursive": group.use_recursive_queries,
+    "incremental": group.use_incremental_caches,
+    "compact": group.use_compact_accounts,
+}
+
+
+class QueryCounter(object):
+
+    def __init__(self, engine):
+        self.count = 0
+        sqlalchemy.event.listen(engine, "before_cursor_execute", self.seen)
+
+    def seen(self, *args):
+        self.count += 1
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(counter, op, before=None, iterations=50):
+    """Time op() repeatedly, calling before() untimed ahead of each run."""
+    timings = []
+    queries = []
+    for _ in range(iterations):
+        if before is not None:
+            before()
+        counter.count = 0
+        start = timeit.default_timer()
+        op()
+        timings.append(timeit.default_timer() - start)
+        queries.append(counter.count)
+    return {
+        "p50": percentile(timings, 0.5) * 1000,
+        "p90": percentile(timings, 0.9) * 1000,
+        "p99": percentile(timings, 0.99) * 1000,
+        # The median, so that one-off work like compiling rules on the
+        # first call doesn't make counts depend on --iterations.
+        "queries": percentile(queries, 0.5),
+    }
+
+
+def group_benchmarks(workload):
+    """Yield (name, op, before) for each group operation on a workload."""
+    top = workload.top
+    member = workload.account
+    bottom = workload.groups[-1]
+    warm = lambda: group.list_accounts(top)
+
+    yield "list_accounts cold", lambda: group.list_accounts(top), \
+        group.clear_caches
+    yield "list_accounts warm", lambda: group.list_accounts(top), warm
+    yield "is_member_account cold", \
+        lambda: group.is_member_account(top, member), group.clear_caches
+    yield "is_member_account warm", \
+        lambda: group.is_member_account(top, member), warm
+    yield "list_account_memberships cold", \
+        lambda: group.list_account_memberships(member), group.clear_caches
+    yield "list_account_memberships warm", \
+        lambda: group.list_account_memberships(member), \
+        lambda: group.list_account_memberships(member)
+    yield "page_accounts cold", \
+        lambda: group.page_accounts(top, limit=100), group.clear_caches
+
+    def edit():
+        group.add_member_account(bottom, 0)
+        group.drop_member_account(bottom, 0)
+    yield "edit with warm caches", edit, warm
+
+    accounts = range(1000000, 1000100)
+
+    def edit_batch():
+        group.apply_edits(
+            [("add", bottom, account, "account") for account in accounts])
+        group.apply_edits(
+            [("drop", bottom, account, "account") for account in accounts])
+    yield "batch of 200 edits with warm caches", edit_batch, warm
+
+
+def rule_benchmarks(workload):
+    rule_id = rule.create_rule(workload.top, "grant", "always")
+    try:
+        yield "evaluate_rules", \
+            lambda: rule.evaluate_rules(workload.top, {}), None
+    finally:
+        rule.drop_rule(rule_id)
+
+
+def auth_benchmarks():
+    # A low work factor keeps this about lookups rather than raw bcrypt.
+    # BCRYPT_COST matches it, or the first verify would rehash at the
+    # default cost and every later one would time that.
+    cost = auth.BCRYPT_COST
+    auth.BCRYPT_COST = 4
+    account_id = account.create_account()
+    verifier = "bcrypt:{}".format(bcrypt.hashpw("hunter", bcrypt.gensalt(4)))
+    auth.create_authenticator("bench", verifier, account_id)
+    try:
+        yield "verify_authenticator", \
+            lambda: auth.verify_authenticator("bench", "hunter"), None
+        yield "verify_authenticator missing", \
+            lambda: auth.verify_authenticator("nobody", "hunter"), None
+    finally:
+        auth.drop_authenticator("bench")
+        account.drop_account(account_id)
+        auth.BCRYPT_COST = cost
+
+
+def run(iterations):
+    counter = QueryCounter(db.get_engine())
+    results = {}
+
+    def record(prefix, benchmarks):
+        for name, op, before in benchmarks:
+            key = "{}/{}".format(prefix, name)
+            results[key] = measure(counter, op, before, iterations)
+            report(key, results[key])
+
+    for build in workloads.WORKLOADS:
+        workload = build()
+        record(workload.name, group_benchmarks(workload))
+        record(workload.name, rule_benchmarks(workload))
+    record("auth", auth_benchmarks())
+    return results
+
+
+def report(key, result):
+    sys.stdout.write(
+        "{:<44} p50 {p50:8.3f}ms  p90 {p90:8.3f}ms  p99 {p99:8.3f}ms  "
+        "queries {queries:6.1f}\n".format(key, **result))
+
+
+def regressions(results, baseline, tolerance=None):
+    """Yield the results that regressed against a baseline.
+
+    Latencies are only compared if a tolerance is given.
+    """
+    for key, result in sorted(results.items()):
+        expected = baseline.get(key)
+        if expected is None:
+            continue
+        if result["queries"] > expected["queries"]:
+            yield "{}: {} queries, baseline {}".format(
+                key, result["queries"], expected["queries"])
+        if tolerance is None:
+            continue
+        # Ignore sub-0.1ms wobble on very fast operations.
+        limit = max(expected["p50"] * (1 + tolerance), expected["p50"] + 0.1)
+        if result["p50"] > limit:
+            yield "{}: p50 {:.3f}ms, baseline {:.3f}ms".format(
+                key, result["p50"], expected["p50"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run")
+    parser.add_argument("--mode", choices=sorted(MODES), default="query")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--latency", action="store_true",
+                        help="check latencies as well as query counts")
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    args = parser.parse_args(argv)
+
+    db.init(create_schema=True)
+    MODES[args.mode]()
+    results = run(args.iterations)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    if args.save:
+        baselines[args.mode] = results
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.check:
+        failures = list(regressions(
+            results, baselines.get(args.mode, {}),
+            args.tolerance if args.latency else None))
+        for failure in failures:
+            sys.stdout.write("REGRESSION {}\n".format(failure))
+        if failures:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""Synthetic group hierarchies for the benchmarks.
+
+Group names may only contain letters and dashes, so generated names
+count in base 26 with letters instead of digits.
+"""
+import itertools
+import random
+
+from soundauth import bulk
+
+
+# Shared by every workload so that their accounts don't overlap.
+ACCOUNT_IDS = itertools.count(1)
+
+
+def letters(i):
+    name = ""
+    while True:
+        name = chr(ord("a") + i % 26) + name
+        i = i // 26 - 1
+        if i < 0:
+            return name
+
+
+def names(prefix, count):
+    return ["{}-{}".format(prefix, letters(i)) for i in range(count)]
+
+
+class Workload(object):
+    """Groups and accounts loaded into the db, plus what to query."""
+
+    def __init__(self, name):
+        self.name = name
+        self.records = []
+        self.groups = []
+        self.accounts = []
+
+    def group(self, name):
+        self.groups.append(name)
+        self.records.append(dict(type="group", name=name))
+        return name
+
+    def edge(self, parent, child, edgetype="or"):
+        self.records.append(
+            dict(type="member", group=parent, member=child, edgetype=edgetype))
+
+    def add_accounts(self, parent, count):
+        accounts = [next(ACCOUNT_IDS) for _ in range(count)]
+        for account in accounts:
+            self.edge(parent, str(account), "account")
+        self.accounts.extend(accounts)
+        return accounts
+
+    def load(self):
+        bulk.load(iter(self.records))
+        # Query the first group, with an account from deep down.
+        self.top = self.groups[0]
+        self.account = self.accounts[-1]
+        return self
+
+
+def chain(depth=200, accounts=100):
+    """A single chain of "or" groups with the accounts at the bottom."""
+    workload = Workload("chain")
+    groups = [workload.group(name) for name in names("chain", depth)]
+    for parent, child in zip(groups, groups[1:]):
+        workload.edge(parent, child)
+    workload.add_accounts(groups[-1], accounts)
+    return workload.load()
+
+
+def fanout(width=200, accounts=50):
+    """One group with many "or" children, each with their own accounts."""
+    workload = Workload("fanout")
+    top = workload.group("fan")
+    for name in names("fan", width):
+        workload.group(name)
+        workload.edge(top, name)
+        workload.add_accounts(name, accounts)
+    return workload.load()
+
+
+def dag(layers=6, width=20, accounts=30, seed=1):
+    """Layered groups joined by a random mix of or/and/not edges."""
+    rng = random.Random(seed)
+    workload = Workload("dag")
+    top = workload.group("dag")
+    above = [top]
+    for layer in range(layers):
+        row = [
+            workload.group(name)
+            for name in names("dag-" + letters(layer), width)
+        ]
+        for parent in above:
+            for child in rng.sample(row, min(4, width)):
+                edgetype = rng.choice(["or"] * 6 + ["and"] * 2 + ["not"])
+                workload.edge(parent, child, edgetype)
+        above = row
+    for name in above:
+        workload.add_accounts(name, accounts)
+    return workload.load()
+
+
+def large(accounts=20000):
+    """One group with a great many direct accounts."""
+    workload = Workload("large")
+    workload.add_accounts(workload.group("large"), accounts)
+    return workload.load()
+
+
+WORKLOADS = [chain, fanout, dag, large]
@@ -1,24 +1,34 @@
+import sqlalchemy
+
+from . import metrics
 from .db import accounts
 from .db import authenticators
+from .db import execute
 from .db import transaction
 
 
 class Failure(Exception): pass
 
 
+INSERT_ACCOUNT = accounts.insert()
+DELETE_ACCOUNT = accounts.delete().where(
+    accounts.c.id == sqlalchemy.bindparam("account_id"),
+)
+DELETE_ACCOUNT_AUTHENTICATORS = authenticators.delete().where(
+    authenticators.c.account == sqlalchemy.bindparam("account_id"),
+)
+
+
+@metrics.instrumented
 def create_account():
     """Create a new account and return its ID."""
-    query = accounts.insert()
-    account_id = query.execute().inserted_primary_key[0]
+    account_id = execute(INSERT_ACCOUNT).inserted_primary_key[0]
     return account_id
 
 
+@metrics.instrumented
 def drop_account(account_id):
     """Remove an account by id."""
-    delete_account = accounts.delete().where(accounts.c.id == account_id)
-    delete_auths = authenticators.delete().where(
-        authenticators.c.account == account_id,
-    )
     with transaction() as t:
-        t.execute(delete_account)
-        t.execute(delete_auths)
+        t.execute(DELETE_ACCOUNT, account_id=account_id)
+        t.execute(DELETE_ACCOUNT_AUTHENTICATORS, account_id=account_id)
@@ -0,0 +1,313 @@
+"""Compact sets of account IDs.
+
+An AccountSet holds its accounts as a single sorted array of machine
+integers, 4 or 8 bytes per account, where a frozenset of ints needs
+several times that. Membership is a binary search.
+
+With NumPy installed, the arrays are NumPy arrays and union, intersection
+and difference run vectorized over them. Without it they are stdlib
+arrays: the memory saving is the same, but set algebra is done in
+Python and is slower than with frozensets.
+
+AccountSets compare equal to sets of the same accounts and can be mixed
+with them in set operations, so they can stand in for the frozensets that
+soundauth.group caches; see soundauth.group.use_compact_accounts().
+
+iter_union(), iter_intersection() and iter_difference() do the same
+algebra on ascending streams of accounts, for sets too big to hold.
+"""
+import array
+import bisect
+import heapq
+import itertools
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Set to None to use the stdlib arrays even when NumPy is installed.
+NUMPY = numpy
+
+
+class AccountSet(object):
+    """An immutable, sorted set of account IDs."""
+
+    __slots__ = ("_items",)
+
+    def __init__(self, accounts=()):
+        if isinstance(accounts, AccountSet):
+            self._items = accounts._items
+        else:
+            self._items = pack(sorted(set(int(a) for a in accounts)))
+
+    @classmethod
+    def _wrap(cls, items):
+        """Make an AccountSet from an array that is already sorted and unique."""
+        accounts = cls.__new__(cls)
+        accounts._items = items
+        return accounts
+
+    def __len__(self):
+        return len(self._items)
+
+    def __nonzero__(self):
+        return len(self._items) > 0
+
+    __bool__ = __nonzero__
+
+    def __iter__(self):
+        if NUMPY is not None and isinstance(self._items, NUMPY.ndarray):
+            return iter(self._items.tolist())
+        return iter(self._items)
+
+    def __contains__(self, account):
+        items = self._items
+        if NUMPY is not None and isinstance(items, NUMPY.ndarray):
+            i = int(items.searchsorted(account))
+        else:
+            i = bisect.bisect_left(items, account)
+        return i < len(items) and items[i] == account
+
+    def above(self, account=None):
+        """Iterate, in order, over the accounts greater than account."""
+        items = self._items
+        if account is None:
+            return iter(self)
+        if NUMPY is not None and isinstance(items, NUMPY.ndarray):
+            start = int(items.searchsorted(account, side="right"))
+            return (int(a) for a in items[start:])
+        start = bisect.bisect_right(items, account)
+        return itertools.islice(items, start, None)
+
+    def contains_each(self, accounts):
+        """Return a list saying, for each account in turn, if it is here."""
+        accounts = list(accounts)
+        if NUMPY is None or not accounts:
+            return [account in self for account in accounts]
+        items = self._items
+        if not len(items):
+            return [False] * len(accounts)
+        wanted = NUMPY.array(accounts, dtype=NUMPY.int64)
+        # One vectorized binary search for all of them.
+        places = NUMPY.minimum(items.searchsorted(wanted), len(items) - 1)
+        return (items[places] == wanted).tolist()
+
+    def __eq__(self, other):
+        if isinstance(other, AccountSet):
+            return (len(self) == len(other) and
+                    all_equal(self._items, other._items))
+        if isinstance(other, (set, frozenset)):
+            return len(self) == len(other) and frozenset(self) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        # Equal to the hash of a frozenset of the same accounts.
+        return hash(frozenset(self))
+
+    def __or__(self, other):
+        return union([self, other])
+
+    def __and__(self, other):
+        return intersection([self, other])
+
+    def __sub__(self, other):
+        return difference(self, other)
+
+    def __xor__(self, other):
+        return (self - other) | (other - self)
+
+    __ror__ = __or__
+    __rand__ = __and__
+
+    def __rsub__(self, other):
+        return difference(other, self)
+
+    def __rxor__(self, other):
+        return self ^ other
+
+    def __sizeof__(self):
+        items = self._items
+        if NUMPY is not None and isinstance(items, NUMPY.ndarray):
+            return object.__sizeof__(self) + items.nbytes
+        return object.__sizeof__(self) + sys.getsizeof(items)
+
+    def __repr__(self):
+        return "AccountSet({!r})".format(list(self))
+
+
+# A stdlib array typecode for 64-bit integers.
+INT64 = "l" if array.array("l").itemsize == 8 else "q"
+
+
+def dump(accounts):
+    """Return some accounts, sorted, as little-endian 64-bit integers."""
+    accounts = as_account_set(accounts)
+    if NUMPY is not None:
+        return NUMPY.asarray(accounts._items, dtype="<i8").tobytes()
+    items = array.array(INT64, accounts._items)
+    if sys.byteorder == "big":
+        items.byteswap()
+    if hasattr(items, "tobytes"):
+        return items.tobytes()
+    return items.tostring()
+
+
+def from_buffer(buffer, offset, count):
+    """Read an AccountSet of count accounts written by dump() at offset.
+
+    With NumPy the set is a view of buffer rather than a copy, so the
+    buffer must outlive it and not change.
+    """
+    if not count:
+        return AccountSet()
+    if NUMPY is not None:
+        return AccountSet._wrap(NUMPY.frombuffer(
+            buffer, dtype="<i8", count=count, offset=offset))
+    items = array.array(INT64)
+    data = buffer[offset:offset + count * 8]
+    if hasattr(items, "frombytes"):
+        items.frombytes(data)
+    else:
+        items.fromstring(data)
+    if sys.byteorder == "big":
+        items.byteswap()
+    return AccountSet._wrap(items)
+
+
+def pack(accounts):
+    """Store sorted, unique accounts in the smallest array that fits them."""
+    small = not accounts or (
+        accounts[0] >= -2 ** 31 and accounts[-1] < 2 ** 31)
+    if NUMPY is not None:
+        return NUMPY.array(
+            accounts, dtype=NUMPY.int32 if small else NUMPY.int64)
+    return array.array("i" if small else "l", accounts)
+
+
+def all_equal(a, b):
+    if NUMPY is not None:
+        return bool(NUMPY.array_equal(a, b))
+    return list(a) == list(b)
+
+
+def as_account_set(accounts):
+    if isinstance(accounts, AccountSet):
+        return accounts
+    return AccountSet(accounts)
+
+
+def union(sets):
+    """Return the accounts in any of some sets."""
+    sets = [as_account_set(s) for s in sets]
+    sets = [s for s in sets if s]
+    if not sets:
+        return AccountSet()
+    if len(sets) == 1:
+        return sets[0]
+    # Each array is already sorted, so a stable sort of them all just
+    # merges the runs, and duplicates end up next to each other.
+    if NUMPY is not None:
+        merged = NUMPY.concatenate([s._items for s in sets])
+        merged.sort(kind="mergesort")
+        keep = NUMPY.empty(len(merged), dtype=bool)
+        keep[0] = True
+        NUMPY.not_equal(merged[1:], merged[:-1], out=keep[1:])
+        return AccountSet._wrap(merged[keep])
+    merged = []
+    for s in sets:
+        merged.extend(s._items)
+    merged.sort()
+    return AccountSet._wrap(
+        pack([account for account, _ in itertools.groupby(merged)]))
+
+
+def intersection(sets):
+    """Return the accounts in every one of some sets, smallest first."""
+    sets = sorted((as_account_set(s) for s in sets), key=len)
+    if not sets:
+        return AccountSet()
+    result = sets[0]
+    for other in sets[1:]:
+        if not result:
+            break
+        if NUMPY is not None:
+            result = AccountSet._wrap(NUMPY.intersect1d(
+                result._items, other._items, assume_unique=True))
+        else:
+            # Filtering keeps the smaller array's order.
+            found = set(other._items)
+            result = AccountSet._wrap(pack(
+                [account for account in result._items if account in found]))
+    return result
+
+
+def difference(accounts, removed):
+    """Return the accounts not in removed."""
+    accounts = as_account_set(accounts)
+    removed = as_account_set(removed)
+    if not accounts or not removed:
+        return accounts
+    if NUMPY is not None:
+        return AccountSet._wrap(NUMPY.setdiff1d(
+            accounts._items, removed._items, assume_unique=True))
+    removed = set(removed._items)
+    return AccountSet._wrap(pack(
+        [account for account in accounts._items if account not in removed]))
+
+
+def combine(direct, union_sets, intersect_sets, prune_sets):
+    """Evaluate a group from its direct accounts and its children's sets.
+
+    The result is everything in direct or any union set, or in all of the
+    intersect sets if there are any, minus everything in a prune set.
+    """
+    sets = [AccountSet(direct)] + list(union_sets)
+    if intersect_sets:
+        sets.append(intersection(intersect_sets))
+    accounts = union(sets)
+    if prune_sets:
+        accounts = difference(accounts, union(prune_sets))
+    return accounts
+
+
+def iter_union(streams):
+    """Merge ascending streams of accounts into one, without duplicates."""
+    merged = heapq.merge(*streams)
+    return (account for account, _ in itertools.groupby(merged))
+
+
+def iter_intersection(streams):
+    """Yield the accounts found in every one of some ascending streams."""
+    streams = [iter(stream) for stream in streams]
+    try:
+        heads = [next(stream) for stream in streams]
+        while True:
+            top = max(heads)
+            for i, stream in enumerate(streams):
+                while heads[i] < top:
+                    heads[i] = next(stream)
+            if max(heads) == top:
+                yield top
+                heads = [next(stream) for stream in streams]
+    except StopIteration:
+        return
+
+
+def iter_difference(stream, removed):
+    """Yield the accounts of an ascending stream not in another one."""
+    removed = iter(removed)
+    skip = next(removed, None)
+    for account in stream:
+        while skip is not None and skip < account:
+            skip = next(removed, None)
+        if account != skip:
+            yield account
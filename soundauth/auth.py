@@ -1,72 +1,420 @@
+import hashlib
+import hmac
+import random
+import time
+import timeit
+
 import bcrypt
 import sqlalchemy
 
+from . import metrics
 from .db import authenticators
+from .db import execute
+from .workers import Result
+from .workers import WorkerPool
+from .workers import to_asyncio
 
 
 class Failure(Exception): pass
 
 
+# A WorkerPool that the pooled and async functions run bcrypt on. Created
+# with default settings on first use unless configure_pool() is called.
+POOL = None
+
+
+def configure_pool(workers=4, processes=False, max_pending=None):
+    """Set up the pool that bcrypt work is handed to.
+
+    With processes=True the hashing runs in separate processes. Once
+    max_pending operations are queued, submitting more blocks until
+    there is room. By default that's a fixed number per worker; see
+    WorkerPool.
+    """
+    global POOL
+    shutdown_pool()
+    POOL = WorkerPool(workers, processes, max_pending)
+
+
+def shutdown_pool():
+    """Stop the bcrypt pool after it finishes any queued work."""
+    global POOL
+    if POOL is not None:
+        POOL.shutdown()
+        POOL = None
+
+
+def get_pool():
+    if POOL is None:
+        configure_pool()
+    return POOL
+
+
+INSERT_AUTHENTICATOR = authenticators.insert()
+DELETE_AUTHENTICATOR = authenticators.delete().where(
+    authenticators.c.name == sqlalchemy.bindparam("name"),
+)
+SELECT_VERIFIER = sqlalchemy.select([authenticators.c.verifier]).where(
+    authenticators.c.name == sqlalchemy.bindparam("name"),
+)
+SELECT_ACCOUNT = sqlalchemy.select([authenticators.c.account]).where(
+    authenticators.c.name == sqlalchemy.bindparam("name"),
+)
+# Only replaces the verifier it was given, so that a password change made
+# in the meantime isn't undone.
+UPDATE_VERIFIER = authenticators.update().where(
+    (authenticators.c.name == sqlalchemy.bindparam("authenticator")) &
+    (authenticators.c.verifier == sqlalchemy.bindparam("old_verifier")),
+).values(verifier=sqlalchemy.bindparam("new_verifier"))
+
+
+# The work factor for new bcrypt verifiers. Verifiers with a lower one are
+# rehashed the next time they're verified. See calibrate_bcrypt_cost().
+BCRYPT_COST = 12
+
+
+def calibrate_bcrypt_cost(target=0.25, minimum=10, maximum=16):
+    """Set BCRYPT_COST so that hashing takes about target seconds here.
+
+    Picks the highest cost from minimum to maximum whose hash is expected
+    to fit in target, timing one hash at minimum and doubling from there.
+    Returns the chosen cost. Call this before configure_pool() when using
+    processes, so that the workers see it.
+    """
+    global BCRYPT_COST
+    start = timeit.default_timer()
+    bcrypt.hashpw(b"calibration", bcrypt.gensalt(minimum))
+    elapsed = timeit.default_timer() - start
+    cost = minimum
+    # Each step up doubles the work.
+    while cost < maximum and elapsed * 2 <= target:
+        cost += 1
+        elapsed *= 2
+    BCRYPT_COST = cost
+    return cost
+
+
+@metrics.instrumented
 def create_authenticator(name, verifier, account):
     """Create a new authenticator.
 
     Most of the time you don't need to call this directly,
     and instead should call the creator for a specific type
-    of authenticator, such as create_bcrypt_authenticator().
+    of authenticator, such as create_bcrypt_authenticator(). Names
+    starting with "session:" are reserved for session tokens.
     """
-    query = authenticators.insert().values(
-        name=name,
-        verifier=verifier,
-        account=account,
-    )
+    if name.startswith(SESSION_PREFIX):
+        raise Failure(
+            "Names starting with '{}' are reserved.".format(SESSION_PREFIX))
+    insert_authenticator(name, verifier, account)
+
+
+def insert_authenticator(name, verifier, account):
     try:
-        query.execute()
+        execute(
+            INSERT_AUTHENTICATOR,
+            name=name,
+            verifier=verifier,
+            account=account,
+        )
     except sqlalchemy.exc.IntegrityError:
         raise Failure("The name '{}' is already in use.".format(name))
 
 
+@metrics.instrumented
 def drop_authenticator(name):
     """Remove an existing authenticator."""
-    query = authenticators.delete().where(
-        authenticators.c.name == name,
-    )
-    query.execute()
+    execute(DELETE_AUTHENTICATOR, name=name)
+
+
+@metrics.instrumented
+def find_verifier(name):
+    """Return the stored verifier for an authenticator, or None."""
+    auth = execute(SELECT_VERIFIER, name=name).first()
+    if not auth:
+        return None
+    return auth.verifier
 
 
+@metrics.instrumented
 def verify_authenticator(name, secret):
     """Verify credentials for an authenticator.
 
-    Returns True if verification is successful, False otherwise.
+    Returns True if verification is successful, False otherwise. On
+    success an outdated verifier is replaced with a current one.
+    """
+    verifier = find_verifier(name)
+    if verifier is None:
+        return False
+    if not check_verifier(verifier, secret):
+        return False
+    if verifier_outdated(verifier):
+        replace_verifier(name, verifier, make_bcrypt_verifier(secret))
+    return True
+
+
+@metrics.instrumented
+def verify_authenticator_pooled(name, secret):
+    """Like verify_authenticator(), but checks the secret on the pool.
+
+    The lookup still happens on the calling thread. Returns a
+    Result whose get() gives True or False. Outdated verifiers are left
+    as they are, since nothing runs on the calling thread afterwards.
     """
-    query = sqlalchemy.select([authenticators.c.verifier]).where(
-        authenticators.c.name == name,
+    verifier = find_verifier(name)
+    if verifier is None:
+        return Result.of(False)
+    return get_pool().submit(check_verifier, verifier, secret)
+
+
+def verify_authenticator_async(name, secret, loop=None):
+    """Like verify_authenticator(), but returns an asyncio future.
+
+    Checking and any rehashing happen on the pool; an upgraded verifier
+    is written from the event loop's thread.
+    """
+    verifier = find_verifier(name)
+    if verifier is None:
+        return to_asyncio(Result.of(False), loop)
+
+    def finish(outcome):
+        matched, upgraded = outcome
+        if upgraded is not None:
+            replace_verifier(name, verifier, upgraded)
+        return matched
+    return to_asyncio(
+        get_pool().submit(check_and_rehash, verifier, secret, BCRYPT_COST),
+        loop,
+        then=finish,
     )
-    auth = query.execute().first()
-    if not auth:
-            return False
-    verifier = auth.verifier
+
+
+def check_verifier(verifier, secret):
+    """Check a secret against a stored verifier."""
     prefix, _, data = verifier.partition(":")
     if prefix == "bcrypt":
         return verify_bcrypt(secret, data)
     elif prefix == "plaintext":
         # ONLY FOR TESTING, DO NOT USE IN PROD
         return secret == data
+    elif prefix == "session":
+        account, _, generation = data.partition(":")
+        return check_session_token(secret, int(generation)) == int(account)
     else:
         # If no type prefix, assume this was an unprefixed password.
         return verify_bcrypt(secret, verifier)
 
 
+@metrics.instrumented
+def check_and_rehash(verifier, secret, cost):
+    """Check a secret, and make a new verifier if the old one is outdated.
+
+    Returns (matched, new verifier or None), for running on the pool.
+    """
+    if not check_verifier(verifier, secret):
+        return False, None
+    if not verifier_outdated(verifier, cost):
+        return True, None
+    return True, make_bcrypt_verifier(secret, cost)
+
+
+def verifier_outdated(verifier, cost=None):
+    """Whether a verifier should be rehashed once its secret is known.
+
+    Unprefixed legacy hashes always are, and bcrypt verifiers are when
+    their cost is below cost (BCRYPT_COST by default). Higher costs are
+    never lowered.
+    """
+    if cost is None:
+        cost = BCRYPT_COST
+    prefix, _, data = verifier.partition(":")
+    if prefix == "bcrypt":
+        return int(data.split("$")[2]) < cost
+    # Anything without a known prefix is a legacy bcrypt hash.
+    return prefix not in ("plaintext", "session")
+
+
+def replace_verifier(name, old_verifier, new_verifier):
+    """Replace an authenticator's verifier, unless it changed meanwhile."""
+    execute(
+        UPDATE_VERIFIER,
+        authenticator=name,
+        old_verifier=old_verifier,
+        new_verifier=new_verifier,
+    )
+
+
 def create_bcrypt_authenticator(name, password, *args):
     """Create a new authenticator using a bcrypt'd password."""
-    hashed = bcrypt.hashpw(password, bcrypt.gensalt())
-    verifier = "bcrypt:{}".format(hashed)
-    create_authenticator(name, verifier, *args)
+    create_authenticator(name, make_bcrypt_verifier(password), *args)
+
+
+def create_bcrypt_authenticator_async(name, password, account, loop=None):
+    """Like create_bcrypt_authenticator(), but returns an asyncio future.
+
+    The password is hashed on the pool; the authenticator is then
+    written from the event loop's thread.
+    """
+    return to_asyncio(
+        get_pool().submit(make_bcrypt_verifier, password, BCRYPT_COST),
+        loop,
+        then=lambda verifier: create_authenticator(name, verifier, account),
+    )
+
+
+def make_bcrypt_verifier(password, cost=None):
+    """Hash a password into a verifier for a bcrypt authenticator.
+
+    cost defaults to BCRYPT_COST.
+    """
+    hashed = hash_bcrypt(password, bcrypt.gensalt(cost or BCRYPT_COST))
+    return "bcrypt:{}".format(hashed)
+
+
+@metrics.timed("auth.bcrypt")
+def hash_bcrypt(password, salt):
+    return bcrypt.hashpw(password, salt)
 
 
 def verify_bcrypt(secret, data):
     """Verify a bcrypt-hashed password."""
     data = data.encode("utf-8")
     try:
-        return bcrypt.hashpw(secret, data) == data
+        return hash_bcrypt(secret, data) == data
     except Exception as e:
         raise Failure("Bcrypt error: {}".format(e))
+
+
+# Authenticators named with this prefix hold session generations.
+SESSION_PREFIX = "session:"
+
+# Picks the first generation of an account's sessions.
+SESSION_RANDOM = random.SystemRandom()
+
+# The key that session tokens are signed with, and how many seconds they
+# last. Set them with configure_sessions().
+SESSION_KEY = None
+SESSION_TTL = 3600
+
+
+def configure_sessions(key, ttl=3600):
+    """Set the secret key for signing session tokens, and their lifetime.
+
+    Every process that issues or checks tokens needs the same key.
+    Changing it ends every session.
+    """
+    global SESSION_KEY
+    global SESSION_TTL
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    SESSION_KEY = key
+    SESSION_TTL = ttl
+
+
+def session_name(account):
+    """The name of the authenticator that holds an account's sessions.
+
+    Its verifier is "session:<account>:<generation>", and moving to a
+    new generation revokes every token issued for the old one.
+    """
+    return "{}{}".format(SESSION_PREFIX, account)
+
+
+@metrics.instrumented
+def issue_session_token(name, secret, ttl=None):
+    """Verify credentials once and return a session token for them.
+
+    Returns None if the credentials are wrong. The token stands in for
+    the credentials for ttl seconds (SESSION_TTL by default) and is
+    checked by verify_session_token() without bcrypt.
+    """
+    if SESSION_KEY is None:
+        raise Failure("Session tokens need configure_sessions() first.")
+    if not verify_authenticator(name, secret):
+        return None
+    account = execute(SELECT_ACCOUNT, name=name).scalar()
+    expiry = int(time.time()) + (SESSION_TTL if ttl is None else ttl)
+    payload = "{}:{}:{}".format(account, session_generation(account), expiry)
+    return "{}:{}".format(payload, sign_session(payload))
+
+
+def session_generation(account):
+    """Return an account's session generation, starting one if needed.
+
+    New generations start at random rather than at 0, so that tokens
+    from before the row was dropped (with its account, say, whose id may
+    since have been reused) don't match the new one.
+    """
+    name = session_name(account)
+    verifier = find_verifier(name)
+    if verifier is None:
+        generation = SESSION_RANDOM.getrandbits(62)
+        try:
+            insert_authenticator(
+                name, "session:{}:{}".format(account, generation), account)
+            return generation
+        except Failure:
+            # Created by someone else in the meantime.
+            verifier = find_verifier(name)
+    return int(verifier.rpartition(":")[2])
+
+
+def sign_session(payload):
+    return hmac.new(SESSION_KEY, payload, hashlib.sha256).hexdigest()
+
+
+@metrics.instrumented
+def check_session_token(token, generation=None):
+    """Return the account a session token is for, or None.
+
+    Only the signature, the expiry and, if given, the generation are
+    checked, so this needs no db access at all. Without a generation,
+    revoked tokens pass until they expire; verify_session_token() checks
+    for revocation too.
+    """
+    if SESSION_KEY is None:
+        return None
+    if isinstance(token, unicode):
+        token = token.encode("utf-8")
+    payload, _, signature = token.rpartition(":")
+    try:
+        account, token_generation, expiry = [
+            int(part) for part in payload.split(":")]
+    except ValueError:
+        return None
+    if not hmac.compare_digest(sign_session(payload), signature):
+        return None
+    if expiry <= time.time():
+        return None
+    if generation is not None and token_generation != generation:
+        return None
+    return account
+
+
+@metrics.instrumented
+def verify_session_token(token):
+    """Return the account a current session token is for, or None.
+
+    Costs one lookup of the account's session generation and no bcrypt.
+    """
+    account = check_session_token(token)
+    if account is None:
+        return None
+    verifier = find_verifier(session_name(account))
+    if verifier is None or not verifier.startswith("session:"):
+        return None
+    if not check_verifier(verifier, token):
+        return None
+    return account
+
+
+@metrics.instrumented
+def revoke_sessions(account):
+    """End every session of an account by moving to a new generation."""
+    name = session_name(account)
+    verifier = find_verifier(name)
+    if verifier is None:
+        return
+    generation = int(verifier.rpartition(":")[2])
+    replace_verifier(
+        name, verifier, "session:{}:{}".format(account, generation + 1))
@@ -0,0 +1,276 @@
+"""Bulk loading and dumping of accounts, authenticators and groups.
+
+Records are dicts with a "type" and type-specific fields:
+
+    {"type": "account", "id": 1}
+    {"type": "authenticator", "name": "alice", "account": 1,
+     "password": "..."}            (or "verifier": "bcrypt:..." as stored)
+    {"type": "group", "name": "admins"}
+    {"type": "member", "group": "admins", "member": "1",
+     "edgetype": "account"}        (edgetype defaults to "or")
+
+They are read and written as JSON lines or CSV with a column per field.
+From the command line:
+
+    python -m soundauth.bulk load tenant.jsonl --url sqlite:///auth.db
+    python -m soundauth.bulk dump tenant.csv --url sqlite:///auth.db
+"""
+import argparse
+import csv
+import json
+import re
+import sys
+
+import sqlalchemy
+
+from . import auth
+from . import db
+from . import group
+from . import metrics
+from .db import accounts
+from .db import authenticators
+from .db import execute
+from .db import group_members
+from .db import groups
+from .db import transaction
+
+
+class Failure(Exception): pass
+
+
+CSV_FIELDS = (
+    "type", "id", "name", "account", "password", "verifier",
+    "group", "member", "edgetype",
+)
+
+
+def read_jsonl(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_csv(stream):
+    for row in csv.DictReader(stream):
+        yield dict((key, value) for key, value in row.items() if value)
+
+
+def write_jsonl(stream, records):
+    for record in records:
+        stream.write(json.dumps(record, sort_keys=True))
+        stream.write("\n")
+
+
+def write_csv(stream, records):
+    writer = csv.DictWriter(stream, CSV_FIELDS)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+
+
+# The verifier of an account's session generation, as made by auth.
+SESSION_VERIFIER_PATTERN = r"^session:[0-9]+:[0-9]+$"
+
+
+FORMATS = {
+    "jsonl": (read_jsonl, write_jsonl),
+    "csv": (read_csv, write_csv),
+}
+
+
+@metrics.instrumented
+def load(records, batch_size=1000):
+    """Insert a stream of records in a single transaction.
+
+    Rows are written with executemany in batches of batch_size, with
+    each batch's passwords hashed in parallel on the auth pool. The
+    group caches are reset once at the end. Nothing is written if any
+    record is invalid or conflicts with existing rows. Accounts keep
+    their ids, and the db's id sequence is moved past them.
+    """
+    loader = Loader(batch_size)
+    with transaction() as t:
+        for record in records:
+            loader.add(t, record)
+        loader.finish(t)
+        if loader.counts["account"]:
+            db.reset_sequence(t, accounts)
+        group.record_change(t, "reload")
+    group.reload_state()
+    return loader.counts
+
+
+class Loader(object):
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.pending = dict(
+            account=[], authenticator=[], group=[], member=[])
+        self.counts = dict(
+            account=0, authenticator=0, group=0, member=0)
+        self.groups = set()
+        self.parents = set()
+
+    def add(self, t, record):
+        kind = record.get("type")
+        if kind not in self.pending:
+            raise Failure("Unknown record type '{}'.".format(kind))
+        try:
+            row = getattr(self, "make_" + kind)(record)
+        except (KeyError, ValueError) as e:
+            raise Failure("Invalid {} record {!r}: {}".format(kind, record, e))
+        batch = self.pending[kind]
+        batch.append(row)
+        if len(batch) >= self.batch_size:
+            self.flush(t, kind)
+
+    def make_account(self, record):
+        return dict(id=int(record["id"]))
+
+    def make_authenticator(self, record):
+        row = dict(name=record["name"], account=int(record["account"]))
+        if row["name"].startswith(auth.SESSION_PREFIX):
+            # Only session generations, as dumped, may use the reserved names.
+            verifier = record.get("verifier", "")
+            if (row["name"] != auth.session_name(row["account"]) or
+                    not re.match(SESSION_VERIFIER_PATTERN, verifier) or
+                    verifier.split(":")[1] != str(row["account"])):
+                raise ValueError("the authenticator name is reserved")
+        if "verifier" in record:
+            row["verifier"] = record["verifier"]
+        else:
+            row["password"] = record["password"]
+        return row
+
+    def make_group(self, record):
+        name = record["name"]
+        if not re.match(group.GROUP_NAME_PATTERN, name):
+            raise ValueError("the group name is invalid")
+        self.groups.add(name)
+        return dict(name=name)
+
+    def make_member(self, record):
+        edgetype = record.get("edgetype", "or")
+        if edgetype not in ("account", "or", "and", "not"):
+            raise ValueError("unknown edge type")
+        self.parents.add(record["group"])
+        return dict(
+            parent=record["group"],
+            child=unicode(record["member"]),
+            edgetype=edgetype,
+        )
+
+    def flush(self, t, kind):
+        rows = self.pending[kind]
+        if not rows:
+            return
+        self.pending[kind] = []
+        if kind == "authenticator":
+            rows = self.hash_passwords(rows)
+        table = {
+            "account": accounts,
+            "authenticator": authenticators,
+            "group": groups,
+            "member": group_members,
+        }[kind]
+        try:
+            t.execute(table.insert(), rows)
+        except sqlalchemy.exc.IntegrityError as e:
+            raise Failure("Conflicting {} records: {}".format(kind, e))
+        self.counts[kind] += len(rows)
+
+    def hash_passwords(self, rows):
+        hashing = [row for row in rows if "password" in row]
+        if hashing:
+            passwords = [row.pop("password") for row in hashing]
+            passwords = [
+                p.encode("utf-8") if isinstance(p, unicode) else p
+                for p in passwords
+            ]
+            verifiers = auth.get_pool().map(
+                auth.make_bcrypt_verifier, passwords)
+            for row, verifier in zip(hashing, verifiers):
+                row["verifier"] = verifier
+        return rows
+
+    def finish(self, t):
+        # Groups go first so that memberships can be checked against them.
+        for kind in ("account", "group", "authenticator", "member"):
+            self.flush(t, kind)
+        missing = self.parents - self.groups
+        if missing:
+            query = sqlalchemy.select([groups.c.name]).where(
+                groups.c.name.in_(missing),
+            )
+            missing -= set(row.name for row in t.execute(query))
+        if missing:
+            raise Failure("No groups named {} exist.".format(
+                ", ".join(sorted(missing))))
+
+
+def dump():
+    """Yield every account, authenticator, group and membership as records."""
+    for row in execute(accounts.select().order_by(accounts.c.id)):
+        yield dict(type="account", id=row.id)
+    for row in execute(authenticators.select().order_by(
+            authenticators.c.name)):
+        yield dict(
+            type="authenticator",
+            name=row.name,
+            account=row.account,
+            verifier=row.verifier,
+        )
+    for row in execute(groups.select().order_by(groups.c.name)):
+        yield dict(type="group", name=row.name)
+    for row in execute(group_members.select().order_by(
+            group_members.c.parent, group_members.c.child)):
+        yield dict(
+            type="member",
+            group=row.parent,
+            member=row.child,
+            edgetype=row.edgetype,
+        )
+
+
+def guess_format(path):
+    if path.endswith(".csv"):
+        return "csv"
+    return "jsonl"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m soundauth.bulk")
+    parser.add_argument("command", choices=["load", "dump"])
+    parser.add_argument("path", help="file to read or write, or - for stdio")
+    parser.add_argument("--format", choices=sorted(FORMATS))
+    parser.add_argument("--url", default=db.DEFAULT_URL)
+    parser.add_argument("--create-schema", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    reader, writer = FORMATS[args.format or guess_format(args.path)]
+    db.init(args.url, create_schema=args.create_schema)
+    auth.configure_pool(workers=args.workers)
+    try:
+        if args.command == "load":
+            stream = sys.stdin if args.path == "-" else open(args.path)
+            with stream:
+                counts = load(reader(stream), batch_size=args.batch_size)
+            for kind in sorted(counts):
+                sys.stderr.write("{}: {}\n".format(kind, counts[kind]))
+        else:
+            stream = sys.stdout if args.path == "-" else open(args.path, "w")
+            with stream:
+                writer(stream, dump())
+    except Failure as e:
+        sys.stderr.write("{}\n".format(e))
+        return 1
+    finally:
+        auth.shutdown_pool()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
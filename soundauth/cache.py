@@ -0,0 +1,199 @@
+import collections
+import contextlib
+import sys
+import threading
+import time
+
+from . import metrics
+
+
+class CacheVersion(object):
+    """A version number that lets readers fill caches that writers change.
+
+    It's odd while a writer is changing the caches, and bumped back to
+    even when it's done. Readers note it before they start reading, and
+    only keep what they cache if it was even then and hasn't changed
+    since; see store(). Writers hold a lock, but readers never wait.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._lock = threading.RLock()
+        self._writer = threading.local()
+
+    @contextlib.contextmanager
+    def changing(self):
+        """Mark the caches as being changed by this thread."""
+        with self._lock:
+            depth = getattr(self._writer, "depth", 0)
+            self._writer.depth = depth + 1
+            if not depth:
+                self.version += 1
+            try:
+                yield
+            finally:
+                if not depth:
+                    self.version += 1
+                self._writer.depth = depth
+
+    def store(self, cache, entries, version):
+        """Cache (key, value) entries that were computed since version.
+
+        Entries computed while a writer ran might already be out of date,
+        so they aren't kept. A writer's own entries always are.
+        """
+        if getattr(self._writer, "depth", 0):
+            for key, value in entries:
+                cache[key] = value
+            return
+        if version % 2:
+            return
+        for key, value in entries:
+            cache[key] = value
+        # A writer that started since may have missed these; take them back.
+        if self.version != version:
+            for key, value in entries:
+                cache.pop(key, None)
+
+
+class ExpansionCache(object):
+    """A dict-like cache for group expansions.
+
+    Entries can be bounded by count (max_entries) and by total weight
+    (max_weight, where an entry weighs the number of items in its set),
+    evicting the least recently used entries first. Entries older than
+    ttl seconds are treated as missing. With no limits given this behaves
+    like a plain dict that keeps counters.
+
+    Anything with get(), pop(), clear(), __getitem__ and __setitem__ can
+    stand in for this class; see soundauth.group.configure_caches(). It
+    must be safe to use from several threads at once, as this class is.
+    """
+
+    def __init__(self, max_entries=None, max_weight=None, ttl=None,
+                 clock=time.time):
+        self.max_entries = max_entries
+        self.max_weight = max_weight
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        # key -> (value, weight, expiry)
+        self._entries = collections.OrderedDict()
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._get(key, default)
+
+    def _get(self, key, default):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            if metrics.SINK is not None:
+                metrics.count("misses")
+            return default
+        value, weight, expiry = entry
+        if expiry is not None and expiry <= self.clock():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            if metrics.SINK is not None:
+                metrics.count("misses")
+            return default
+        # Mark as most recently used.
+        del self._entries[key]
+        self._entries[key] = entry
+        self.hits += 1
+        if metrics.SINK is not None:
+            metrics.count("hits")
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        weight = len(value)
+        expiry = None
+        if self.ttl is not None:
+            expiry = self.clock() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.max_weight is not None and weight > self.max_weight:
+                # Too big to ever fit; don't flush everything else for it.
+                return
+            self._entries[key] = (value, weight, expiry)
+            self.weight += weight
+            self._evict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+    def _remove(self, key):
+        value, weight, expiry = self._entries.pop(key)
+        self.weight -= weight
+
+    def _evict(self):
+        while self._entries and (
+            (self.max_entries is not None and
+             len(self._entries) > self.max_entries) or
+            (self.max_weight is not None and self.weight > self.max_weight)
+        ):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def memory_usage(self):
+        """Approximate the bytes held by cached keys and values."""
+        with self._lock:
+            entries = list(self._entries.items())
+        total = sys.getsizeof(self._entries)
+        for key, (value, weight, expiry) in entries:
+            total += sys.getsizeof(key) + sys.getsizeof(value)
+            if weight and isinstance(value, (set, frozenset)):
+                # Assume every item is about the size of the first one.
+                # Other values, like AccountSets, count their own items.
+                total += weight * sys.getsizeof(next(iter(value)))
+        return total
+
+    def stats(self):
+        """Return counters and sizes, for monitoring and sizing."""
+        return {
+            "entries": len(self._entries),
+            "weight": self.weight,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "memory": self.memory_usage(),
+        }
@@ -0,0 +1,92 @@
+"""Single-query transitive closures over group_members.
+
+These use WITH RECURSIVE, so they need a db that supports recursive
+common table expressions (SQLite 3.8.3+, PostgreSQL). UNION rather than
+UNION ALL is used for the recursive step so that the queries terminate
+even if the stored graph contains a cycle.
+"""
+import sqlalchemy
+
+from .db import GROUP_EDGE
+from .db import execute
+from .db import group_members
+
+
+def rows(query):
+    """Execute a query, treating a result without rows as empty.
+
+    Python 2's sqlite3 module leaves cursor.description unset for
+    statements that don't start with SELECT when they match nothing,
+    which SQLAlchemy reports as a result that doesn't return rows.
+    """
+    result = execute(query)
+    if not result.returns_rows:
+        return []
+    return result
+
+
+def descendants(group):
+    """Return everything reachable below a group, in one query."""
+    base = sqlalchemy.select([
+        group_members.c.child.label("node"),
+    ]).where(
+        group_members.c.parent == group,
+    ).cte("descendants", recursive=True)
+    step = sqlalchemy.select([
+        group_members.c.child,
+    ]).where(
+        group_members.c.parent == base.c.node,
+    )
+    closure = base.union(step)
+    query = sqlalchemy.select([closure.c.node])
+    return frozenset(row.node for row in rows(query))
+
+
+def ancestors(member):
+    """Return every group that something is reachable from, in one query."""
+    base = sqlalchemy.select([
+        group_members.c.parent.label("node"),
+    ]).where(
+        group_members.c.child == member,
+    ).cte("ancestors", recursive=True)
+    step = sqlalchemy.select([
+        group_members.c.parent,
+    ]).where(
+        group_members.c.child == base.c.node,
+    )
+    closure = base.union(step)
+    query = sqlalchemy.select([closure.c.node])
+    return frozenset(row.node for row in rows(query))
+
+
+def reachable_members(names, accounts=True):
+    """Return the top-level members of every group reachable from groups.
+
+    The result maps each reachable parent to a set of (edgetype, child),
+    the same shape list_members() returns, so that the whole expansion
+    can be evaluated locally after a single query. Without accounts,
+    only the edges to subgroups are returned.
+    """
+    base = sqlalchemy.select([
+        group_members.c.child.label("node"),
+    ]).where(
+        group_members.c.parent.in_(names) &
+        (group_members.c.edgetype != "account"),
+    ).cte("reachable", recursive=True)
+    step = sqlalchemy.select([
+        group_members.c.child,
+    ]).where(
+        (group_members.c.parent == base.c.node) &
+        (group_members.c.edgetype != "account"),
+    )
+    closure = base.union(step)
+    query = group_members.select().where(
+        group_members.c.parent.in_(names) |
+        group_members.c.parent.in_(sqlalchemy.select([closure.c.node])),
+    )
+    if not accounts:
+        query = query.where(GROUP_EDGE)
+    members = {}
+    for row in rows(query):
+        members.setdefault(row.parent, set()).add((row.edgetype, row.child))
+    return members
@@ -1,17 +1,28 @@
+import os
+import threading
+
 import sqlalchemy
 # Grab some specific symbols for the table definition DSL
 from sqlalchemy import Column
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import String
 from sqlalchemy import Table
 from sqlalchemy import PrimaryKeyConstraint
 
+from . import metrics
+
 
 METADATA_SINGLETON = sqlalchemy.MetaData()
 
 
 def transaction():
-    return ENGINE_SINGLETON.begin()
+    return get_engine().begin()
+
+
+def execute(statement, *multiparams, **params):
+    """Execute a statement on soundauth's engine."""
+    return get_engine().execute(statement, *multiparams, **params)
 
 
 authenticators = Table("authenticators", METADATA_SINGLETON,
@@ -40,22 +51,304 @@ group_members = Table("group_members", METADATA_SINGLETON,
     Column("edgetype", String(100), nullable=False),
     PrimaryKeyConstraint("parent", "child", name="edge")
 )
+# Partial indexes for reading a group's accounts or its subgroups alone.
+# The edge type is a literal, not a bound parameter, so that queries
+# filtering on these same expressions can be matched to the indexes.
+ACCOUNT_EDGE = (
+    group_members.c.edgetype == sqlalchemy.literal_column("'account'"))
+GROUP_EDGE = (
+    group_members.c.edgetype != sqlalchemy.literal_column("'account'"))
+# Accounts in numeric order, so they can be paged through.
+Index("member_accounts",
+    group_members.c.parent,
+    sqlalchemy.cast(group_members.c.child, sqlalchemy.BigInteger),
+    sqlite_where=ACCOUNT_EDGE,
+    postgresql_where=ACCOUNT_EDGE,
+)
+Index("member_groups",
+    group_members.c.parent,
+    sqlite_where=GROUP_EDGE,
+    postgresql_where=GROUP_EDGE,
+)
+
+
+# A single row counting writes to the group tables. Writers bump it in
+# the same transaction as their change, which also orders their commits.
+group_generation = Table("group_generation", METADATA_SINGLETON,
+    Column("id", Integer, primary_key=True),
+    Column("generation", Integer, nullable=False),
+    # Changes up to this generation have been removed from the log.
+    Column("pruned", Integer, nullable=False),
+)
+sqlalchemy.event.listen(group_generation, "after_create", sqlalchemy.DDL(
+    "INSERT INTO group_generation (id, generation, pruned) VALUES (1, 0, 0)"))
+
+
+# What each generation changed, so other processes can update their caches.
+group_changes = Table("group_changes", METADATA_SINGLETON,
+    Column("generation", Integer, nullable=False, index=True),
+    # One of 'create', 'drop-group', 'add', 'drop', 'reload'
+    Column("op", String(20), nullable=False),
+    Column("parent", String(120)),
+    Column("child", String(120)),
+    Column("edgetype", String(100)),
+)
 
 
 rules = Table("rules", METADATA_SINGLETON,
     Column("id", Integer, primary_key=True),
-    Column("group", String(100), index=True),
+    Column("group", String(100)),
     # One of 'deny', 'grant',
     Column("action", String(100), nullable=False),
     # E.g. "alliance", "!corp", etc...
     Column("condition", String(100)),
     Column("argument", String(100)),
+    # Gapped, so rules can be placed between others without renumbering.
     Column("order", Integer, nullable=False),
+    Index("rule_order", "group", "order"),
+)
+
+
+# A single row counting writes to the rules table, bumped in the same
+# transaction, so other processes know when compiled rules are stale.
+rule_generation = Table("rule_generation", METADATA_SINGLETON,
+    Column("id", Integer, primary_key=True),
+    Column("generation", Integer, nullable=False),
+)
+sqlalchemy.event.listen(rule_generation, "after_create", sqlalchemy.DDL(
+    "INSERT INTO rule_generation (id, generation) VALUES (1, 0)"))
+
+
+DEFAULT_URL = "sqlite:///:memory:"
+
+
+# Settings suited to production use, e.g.
+#
+#     configure("postgresql://auth@db/auth", **PRODUCTION_PROFILE)
+#
+# Statements aren't logged, connections are pooled, recycled hourly and
+# checked before use, and file-backed SQLite databases use WAL with
+# relaxed syncing and a 64MB page cache. Pool sizes are ignored by the
+# pools SQLite uses.
+PRODUCTION_PROFILE = dict(
+    echo=False,
+    pool_size=10,
+    max_overflow=20,
+    pool_timeout=30,
+    pool_recycle=3600,
+    pool_pre_ping=True,
+    sqlite_pragmas=[
+        ("journal_mode", "WAL"),
+        ("synchronous", "NORMAL"),
+        ("cache_size", -64000),
+    ],
 )
 
 
-# TODO: Move the database connection string to configuration,
-#       and optionally make this only trigger when requested.
-ENGINE_SINGLETON = sqlalchemy.create_engine("sqlite:///:memory:", echo=True)
-METADATA_SINGLETON.bind = ENGINE_SINGLETON
-METADATA_SINGLETON.create_all()
+# Per-dialect tuning hooks, keyed by dialect name. Each is called as
+# hook(engine, tuning) when an engine for that dialect is created, where
+# tuning holds the dialect-specific settings passed to configure().
+DIALECT_HOOKS = {}
+
+
+def dialect_hook(name, *settings):
+    """Register a function as a tuning hook for a dialect.
+
+    settings names the settings it reads. create_engine() rejects any
+    setting that no hook, for any dialect, reads.
+    """
+    def register(hook):
+        hook.settings = settings
+        DIALECT_HOOKS.setdefault(name, []).append(hook)
+        return hook
+    return register
+
+
+def check_settings(settings):
+    """Fail on settings that neither SQLAlchemy nor any hook would read."""
+    known = set(ENGINE_OPTIONS) | set(["echo", "pool_pre_ping"])
+    for hooks in DIALECT_HOOKS.values():
+        for hook in hooks:
+            known.update(hook.settings)
+    unknown = set(settings) - known
+    if unknown:
+        raise TypeError("Unknown engine settings: {}".format(
+            ", ".join(sorted(unknown))))
+
+
+@dialect_hook("sqlite", "sqlite_pragmas")
+def tune_sqlite(engine, tuning):
+    """Apply sqlite_pragmas, as (name, value) pairs, to new connections."""
+    pragmas = tuning.get("sqlite_pragmas")
+    if not pragmas:
+        return
+    if engine.url.database in (None, "", ":memory:"):
+        # WAL and friends don't apply to in-memory databases.
+        return
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+        cursor.close()
+
+
+# Per-dialect statements that move a table's id sequence past rows that
+# were inserted with explicit ids, so that new rows don't collide with
+# them. SQLite numbers new rows from the largest id, so needs none.
+SEQUENCE_RESETS = {
+    "postgresql":
+        "SELECT setval(pg_get_serial_sequence('{table}', '{column}'), "
+        "coalesce(max({column}), 0) + 1, false) FROM {table}",
+}
+
+
+def reset_sequence(t, table, column="id"):
+    """Move the sequence behind a table's id column past its largest id."""
+    statement = SEQUENCE_RESETS.get(t.dialect.name)
+    if statement is not None:
+        t.execute(sqlalchemy.text(
+            statement.format(table=table.name, column=column)))
+
+
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+
+
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    """Keep a forked process from using connections its parent opened."""
+    pid = os.getpid()
+    if connection_record.info["pid"] != pid:
+        # Detach rather than close, since the parent still owns it.
+        connection_record.connection = connection_proxy.connection = None
+        raise sqlalchemy.exc.DisconnectionError(
+            "Connection belongs to pid {}, not {}.".format(
+                connection_record.info["pid"], pid))
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if metrics.SINK is not None:
+        metrics.count("queries")
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Check that a pooled connection still works before handing it out."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        # The pool will throw this connection away and try another.
+        raise sqlalchemy.exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+ENGINE_OPTIONS = (
+    "pool_size",
+    "max_overflow",
+    "pool_timeout",
+    "pool_recycle",
+    "isolation_level",
+)
+
+
+# SQLite engines use pools that aren't sized, and reject these.
+POOL_SIZE_OPTIONS = (
+    "pool_size",
+    "max_overflow",
+    "pool_timeout",
+)
+
+
+# How many compiled statements each engine keeps. Statements that are
+# built once and executed with bound parameters (see the module-level
+# queries in auth, account, group and rule) are compiled to SQL once and
+# then found here by identity on every later call.
+COMPILED_CACHE_SIZE = 500
+
+
+def create_engine(url=DEFAULT_URL, echo=False, pool_pre_ping=False,
+                  **settings):
+    """Create an engine with soundauth's connection settings applied.
+
+    url is any SQLAlchemy database URL. Besides echo, the settings
+    pool_size, max_overflow, pool_timeout, pool_recycle and
+    isolation_level are passed on to sqlalchemy.create_engine() when
+    given. pool_pre_ping checks each connection as it leaves the pool.
+    Any other settings go to the tuning hooks for the url's dialect,
+    such as sqlite_pragmas for SQLite, and must be read by a hook for
+    some dialect. See PRODUCTION_PROFILE for a starting point.
+    """
+    check_settings(settings)
+    url = sqlalchemy.engine.url.make_url(url)
+    options = dict(
+        (name, settings.pop(name))
+        for name in ENGINE_OPTIONS
+        if settings.get(name) is not None
+    )
+    if url.get_backend_name() == "sqlite":
+        for name in POOL_SIZE_OPTIONS:
+            options.pop(name, None)
+    engine = sqlalchemy.create_engine(url, echo=echo, **options)
+    sqlalchemy.event.listen(engine, "connect", remember_pid)
+    sqlalchemy.event.listen(engine, "checkout", check_pid)
+    sqlalchemy.event.listen(engine, "before_cursor_execute", count_query)
+    if pool_pre_ping:
+        sqlalchemy.event.listen(engine, "checkout", ping_connection)
+    for hook in DIALECT_HOOKS.get(engine.dialect.name, ()):
+        hook(engine, settings)
+    return engine.execution_options(
+        compiled_cache=sqlalchemy.util.LRUCache(COMPILED_CACHE_SIZE),
+    )
+
+
+# The engine is created from ENGINE_SETTINGS on first use, so that
+# importing soundauth doesn't touch the database.
+ENGINE_SINGLETON = None
+ENGINE_SETTINGS = dict(url=DEFAULT_URL)
+ENGINE_LOCK = threading.Lock()
+
+
+def configure(url=DEFAULT_URL, **settings):
+    """Set the database that soundauth uses.
+
+    Takes the same arguments as create_engine(). The engine itself is
+    created on first use, or by init().
+    """
+    global ENGINE_SINGLETON
+    global ENGINE_SETTINGS
+    check_settings(settings)
+    with ENGINE_LOCK:
+        ENGINE_SETTINGS = dict(settings, url=url)
+        if ENGINE_SINGLETON is not None:
+            ENGINE_SINGLETON.dispose()
+            ENGINE_SINGLETON = None
+            METADATA_SINGLETON.bind = None
+
+
+def get_engine():
+    """Return soundauth's engine, creating it if needed."""
+    global ENGINE_SINGLETON
+    engine = ENGINE_SINGLETON
+    if engine is None:
+        with ENGINE_LOCK:
+            if ENGINE_SINGLETON is None:
+                ENGINE_SINGLETON = create_engine(**ENGINE_SETTINGS)
+                METADATA_SINGLETON.bind = ENGINE_SINGLETON
+            engine = ENGINE_SINGLETON
+    return engine
+
+
+def init(url=None, create_schema=False, **settings):
+    """Connect now instead of on first use.
+
+    If a url or settings are given, configure() is called with them
+    first. The tables are only created if create_schema is set.
+    """
+    if url is not None or settings:
+        configure(url or DEFAULT_URL, **settings)
+    engine = get_engine()
+    if create_schema:
+        METADATA_SINGLETON.create_all(engine)
+    return engine
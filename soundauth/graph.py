@@ -0,0 +1,188 @@
+import bisect
+
+from .db import execute
+from .db import groups
+from .db import group_members
+
+
+class GroupGraph(object):
+    """An in-memory copy of the group membership graph.
+
+    Keeps adjacency indexes in both directions (parent to children with
+    their edge types, and child to parents) so that group expansions can
+    be answered without a round trip to the db for every edge.
+    """
+
+    def __init__(self):
+        self._groups = set()
+        # parent -> {child: edgetype}
+        self._children = {}
+        # parent -> {child: edgetype}, leaving out accounts
+        self._subgroups = {}
+        # parent -> [account, ...], ascending
+        self._accounts = {}
+        # child -> set([parent, ...])
+        self._parents = {}
+
+    @classmethod
+    def load(cls):
+        """Build a graph from the current contents of the db."""
+        graph = cls()
+        for row in execute(groups.select()):
+            graph.add_group(row.name)
+        for row in execute(group_members.select()):
+            graph.add_edge(row.parent, row.child, row.edgetype, keep_order=False)
+        for accounts in graph._accounts.values():
+            accounts.sort()
+        return graph
+
+    def add_group(self, name):
+        self._groups.add(name)
+
+    def drop_group(self, name):
+        """Forget a group along with every edge into or out of it."""
+        self._groups.discard(name)
+        for child in list(self._children.get(name, ())):
+            self.drop_edge(name, child)
+        for parent in list(self._parents.get(name, ())):
+            self.drop_edge(parent, name)
+
+    def add_edge(self, parent, child, edgetype, keep_order=True):
+        """Add an edge parent -> child of some type.
+
+        Unless keep_order is false, in which case the caller sorts them
+        afterwards, a group's accounts are kept in ascending order.
+        """
+        edges = self._children.setdefault(parent, {})
+        if child in edges:
+            # Mirrors the (parent, child) primary key on group_members.
+            return
+        edges[child] = edgetype
+        self._parents.setdefault(child, set()).add(parent)
+        if edgetype != "account":
+            self._subgroups.setdefault(parent, {})[child] = edgetype
+            return
+        account = int(child)
+        accounts = self._accounts.setdefault(parent, [])
+        if not keep_order or not accounts or account > accounts[-1]:
+            accounts.append(account)
+        else:
+            bisect.insort(accounts, account)
+
+    def drop_edge(self, parent, child, edgetype=None):
+        """Remove an edge, optionally only if it has the given type."""
+        edges = self._children.get(parent)
+        if not edges or child not in edges:
+            return
+        if edgetype is not None and edges[child] != edgetype:
+            return
+        if edges.pop(child) != "account":
+            subgroups = self._subgroups[parent]
+            del subgroups[child]
+            if not subgroups:
+                del self._subgroups[parent]
+        else:
+            accounts = self._accounts[parent]
+            del accounts[bisect.bisect_left(accounts, int(child))]
+            if not accounts:
+                del self._accounts[parent]
+        if not edges:
+            del self._children[parent]
+        parents = self._parents[child]
+        parents.discard(parent)
+        if not parents:
+            del self._parents[child]
+
+    def exists(self, name):
+        return name in self._groups
+
+    def groups(self):
+        return set(self._groups)
+
+    def members(self, group):
+        """Return the top-level members of a group as (edgetype, child)."""
+        edges = self._children.get(group, {})
+        return set((edgetype, child) for child, edgetype in edges.items())
+
+    def subgroups(self, group):
+        """Return the members of a group that aren't accounts."""
+        edges = self._subgroups.get(group, {})
+        return set((edgetype, child) for child, edgetype in edges.items())
+
+    def accounts(self, group, after=None, limit=None):
+        """Return a group's own accounts above after, ascending.
+
+        At most limit are returned if it's given.
+        """
+        accounts = self._accounts.get(group, ())
+        start = 0 if after is None else bisect.bisect_right(accounts, after)
+        end = len(accounts) if limit is None else start + limit
+        return list(accounts[start:end])
+
+    def is_member(self, group, member):
+        return member in self._children.get(group, ())
+
+    def edgetype(self, group, member):
+        """Return the type of the edge group -> member, or None."""
+        return self._children.get(group, {}).get(member)
+
+    def parents(self, member):
+        """Return the groups that directly contain a member."""
+        return set(self._parents.get(member, ()))
+
+    def edges(self):
+        """Return every edge as (parent, child, edgetype)."""
+        return [
+            (parent, child, edgetype)
+            for parent, edges in self._children.items()
+            for child, edgetype in edges.items()
+        ]
+
+
+def components(root, neighbours, done=lambda name: False):
+    """Yield the strongly connected components reachable from root.
+
+    This is Tarjan's algorithm with an explicit stack, so any depth of
+    hierarchy can be walked. neighbours(name) lists the names to follow
+    from name, and names for which done(name) is true are not followed
+    (the root always is). Components are yielded children first, each as
+    (names, cyclic) where cyclic says whether the names form a cycle.
+    """
+    index = {}
+    lowlink = {}
+    following = {}
+    path = []
+    on_path = set()
+
+    def visit(name):
+        index[name] = lowlink[name] = len(index)
+        path.append(name)
+        on_path.add(name)
+        following[name] = list(neighbours(name))
+        return iter(following[name])
+
+    work = [(root, visit(root))]
+    while work:
+        name, pending = work[-1]
+        for other in pending:
+            if other in index:
+                if other in on_path:
+                    lowlink[name] = min(lowlink[name], index[other])
+            elif not done(other):
+                work.append((other, visit(other)))
+                break
+        else:
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[name])
+            if lowlink[name] == index[name]:
+                component = []
+                while True:
+                    other = path.pop()
+                    on_path.discard(other)
+                    component.append(other)
+                    if other == name:
+                        break
+                cyclic = len(component) > 1 or name in following[name]
+                yield component, cyclic
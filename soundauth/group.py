@@ -1,200 +1,1115 @@
+import functools
+import itertools
 import re
+import threading
+import time
 
 import sqlalchemy
 
+from . import accountset
+from . import closure
+from . import metrics
+from .accountset import AccountSet
+from .cache import CacheVersion
+from .cache import ExpansionCache
+from .db import ACCOUNT_EDGE
+from .db import GROUP_EDGE
+from .db import execute
 from .db import groups
+from .db import group_changes
+from .db import group_generation
 from .db import group_members
 from .db import transaction
+from .graph import GroupGraph
+from .graph import components
+from .index import MembershipIndex
 
 
 class Failure(Exception): pass
 
 
-ACCOUNT_EXPANSIONS_CACHE = {}
-DESCENDANT_EXPANSIONS_CACHE = {}
-ANCESTOR_EXPANSIONS_CACHE = {}
+# Raised when evaluate_account() comes back to a group it's still deciding.
+class CycleFound(Exception): pass
+
+
+ACCOUNT_EXPANSIONS_CACHE = ExpansionCache()
+DESCENDANT_EXPANSIONS_CACHE = ExpansionCache()
+ANCESTOR_EXPANSIONS_CACHE = ExpansionCache()
+
+
+# Keeps readers from caching what a writer is changing at the same time.
+CACHES = CacheVersion()
+
+
+def changing_caches():
+    """Mark the caches as being changed by this thread."""
+    return CACHES.changing()
+
+
+def configure_caches(factory=ExpansionCache, **options):
+    """Replace the expansion caches with new, empty ones.
+
+    Each cache is created by calling factory(**options); with the default
+    factory the options are max_entries, max_weight and ttl. Any object
+    with a dict's get/pop/clear and item access can be used instead.
+    """
+    global ACCOUNT_EXPANSIONS_CACHE
+    global DESCENDANT_EXPANSIONS_CACHE
+    global ANCESTOR_EXPANSIONS_CACHE
+    with changing_caches():
+        ACCOUNT_EXPANSIONS_CACHE = factory(**options)
+        DESCENDANT_EXPANSIONS_CACHE = factory(**options)
+        ANCESTOR_EXPANSIONS_CACHE = factory(**options)
+
+
+def cache_stats():
+    """Return the stats of each expansion cache, keyed by cache.
+
+    Caches without a stats() method, such as plain dicts, are left out.
+    """
+    caches = {
+        "accounts": ACCOUNT_EXPANSIONS_CACHE,
+        "descendants": DESCENDANT_EXPANSIONS_CACHE,
+        "ancestors": ANCESTOR_EXPANSIONS_CACHE,
+    }
+    return dict(
+        (name, cache.stats()) for name, cache in caches.items()
+        if hasattr(cache, "stats"))
+
+# When loaded, an in-memory GroupGraph that answers reads instead of the db.
+GRAPH = None
+
+
+def load_graph():
+    """Load the group graph into memory and answer reads from it.
+
+    Write functions keep the loaded graph current, so this only needs
+    to be called once per process.
+    """
+    global GRAPH
+    GRAPH = GroupGraph.load()
+
+
+def unload_graph():
+    """Go back to answering reads with db queries."""
+    global GRAPH
+    GRAPH = None
+
+
+# When set (and no graph is loaded), expansions are computed with a single
+# recursive query each instead of one query per level.
+RECURSIVE_QUERIES = False
+
+
+def use_recursive_queries(enabled=True):
+    """Toggle single-query recursive expansion against the db."""
+    global RECURSIVE_QUERIES
+    RECURSIVE_QUERIES = enabled
+
+
+# When built, a MembershipIndex kept current by every membership change and
+# used to answer list_account_memberships() directly.
+MEMBERSHIP_INDEX = None
+
+
+def build_membership_index():
+    """Index every group's accounts by account, and keep it maintained."""
+    global MEMBERSHIP_INDEX
+    with changing_caches():
+        index = MembershipIndex()
+        for name in list_groups():
+            index.update(name, list_accounts(name))
+        MEMBERSHIP_INDEX = index
+
+
+def drop_membership_index():
+    """Stop maintaining the account -> groups index."""
+    global MEMBERSHIP_INDEX
+    MEMBERSHIP_INDEX = None
+
+
+def refresh_membership_index(names, accounts=None):
+    """Re-index the accounts of some groups after they may have changed.
+
+    If given, accounts are the only accounts whose membership can have
+    changed, and only they are checked again, as point queries; else each
+    group is expanded and indexed afresh.
+    """
+    if MEMBERSHIP_INDEX is None:
+        return
+    with changing_caches():
+        for name in names:
+            if accounts is None:
+                MEMBERSHIP_INDEX.update(name, list_accounts(name))
+                continue
+            added = set()
+            removed = set()
+            for account in accounts:
+                if is_member_account(name, account):
+                    added.add(account)
+                else:
+                    removed.add(account)
+            MEMBERSHIP_INDEX.change(name, added, removed)
 
 
 def clear_account_cache(items=None):
     global ACCOUNT_EXPANSIONS_CACHE
-    if items is None:
-        ACCOUNT_EXPANSIONS_CACHE.clear()
-    else:
-        for item in items:
-            ACCOUNT_EXPANSIONS_CACHE.pop(item, None)
+    with changing_caches():
+        if items is None:
+            ACCOUNT_EXPANSIONS_CACHE.clear()
+        else:
+            for item in items:
+                ACCOUNT_EXPANSIONS_CACHE.pop(item, None)
 
 
 def clear_descendant_cache(items=None):
     global DESCENDANT_EXPANSIONS_CACHE
-    if items is None:
-        DESCENDANT_EXPANSIONS_CACHE.clear()
-    else:
-        for item in items:
-            DESCENDANT_EXPANSIONS_CACHE.pop(item, None)
+    with changing_caches():
+        if items is None:
+            DESCENDANT_EXPANSIONS_CACHE.clear()
+        else:
+            for item in items:
+                DESCENDANT_EXPANSIONS_CACHE.pop(item, None)
 
 
 def clear_ancestor_cache(items=None):
     global ANCESTOR_EXPANSIONS_CACHE
-    if items is None:
-        ANCESTOR_EXPANSIONS_CACHE.clear()
-    else:
-        for item in items:
-            ANCESTOR_EXPANSIONS_CACHE.pop(item, None)
+    with changing_caches():
+        if items is None:
+            ANCESTOR_EXPANSIONS_CACHE.clear()
+        else:
+            for item in items:
+                ANCESTOR_EXPANSIONS_CACHE.pop(item, None)
 
 
 def clear_caches(parent=None, child=None):
-    if parent is None or child is None:
+    with changing_caches():
+        if parent is None or child is None:
+            clear_account_cache()
+            clear_ancestor_cache()
+            clear_descendant_cache()
+        else:
+            upwards = list_ancestors(parent) | set([parent])
+            downwards = list_descendants(child) | set([child])
+            clear_account_cache(upwards)
+            clear_ancestor_cache(downwards)
+            clear_descendant_cache(upwards)
+
+
+# When set, membership edits update cached account expansions in place,
+# pushing the change up through ancestor groups, rather than throwing
+# away every affected entry.
+INCREMENTAL_CACHES = False
+
+
+def use_incremental_caches(enabled=True):
+    """Toggle incremental maintenance of the account expansion cache."""
+    global INCREMENTAL_CACHES
+    INCREMENTAL_CACHES = enabled
+
+
+# When set, account expansions are kept as AccountSets, sorted arrays that
+# take a fraction of the memory of frozensets and, with NumPy, combine
+# much faster. See soundauth.accountset.
+COMPACT_ACCOUNTS = False
+
+
+def use_compact_accounts(enabled=True):
+    """Toggle compact storage of account expansions.
+
+    Cached expansions are dropped, so that they all use the same form.
+    """
+    global COMPACT_ACCOUNTS
+    with changing_caches():
+        COMPACT_ACCOUNTS = enabled
         clear_account_cache()
-        clear_ancestor_cache()
-        clear_descendant_cache()
-    else:
-        upwards = list_ancestors(parent) | set([parent])
-        downwards = list_descendants(child) | set([child])
+
+
+def account_set(accounts):
+    """Make a set of accounts in the form expansions are kept in."""
+    if COMPACT_ACCOUNTS:
+        return AccountSet(accounts)
+    return frozenset(accounts)
+
+
+def update_caches(parent, child, accounts=None):
+    """Bring the caches up to date after the edge parent -> child changed.
+
+    This must be called after the change has been written. Unless
+    incremental mode is on, this is the same as clear_caches(). If given,
+    accounts are the only accounts whose membership in parent can have
+    changed.
+    """
+    with changing_caches():
+        if not INCREMENTAL_CACHES:
+            clear_caches(parent=parent, child=child)
+        else:
+            clear_ancestor_cache(list_descendants(child) | set([child]))
+            clear_descendant_cache(list_ancestors(parent) | set([parent]))
+            propagate_accounts(parent, accounts)
+        if MEMBERSHIP_INDEX is not None:
+            refresh_membership_index(
+                list_ancestors(parent) | set([parent]), accounts)
+
+
+def propagate_accounts(group, accounts=None):
+    """Update the cached accounts of a group and of everything above it.
+
+    Only the accounts that actually changed are pushed to each parent,
+    and propagation stops wherever a group's accounts don't change.
+    Cycles can't be updated this way, so if the group or anything above
+    it is on one, their cached accounts are dropped instead.
+    """
+    upwards = list_ancestors(group) | set([group])
+    if any(name in list_ancestors(name) for name in upwards):
         clear_account_cache(upwards)
+        return
+    old = ACCOUNT_EXPANSIONS_CACHE.get(group)
+    if old is None:
+        # Nothing to update in place here; fall back to dropping
+        # anything cached above this group.
+        clear_account_cache(list_ancestors(group))
+        return
+    if accounts is None:
+        clear_account_cache([group])
+        changed = old ^ list_accounts(group)
+    else:
+        new, added, removed = recheck_accounts(group, old, accounts)
+        ACCOUNT_EXPANSIONS_CACHE[group] = new
+        changed = added | removed
+    pending = [(group, changed)]
+    while pending:
+        member, changed = pending.pop()
+        if not changed:
+            continue
+        for parent in list_parents(member):
+            old = ACCOUNT_EXPANSIONS_CACHE.get(parent)
+            if old is None:
+                clear_account_cache(list_ancestors(parent))
+                continue
+            new, added, removed = recheck_accounts(parent, old, changed)
+            if added or removed:
+                ACCOUNT_EXPANSIONS_CACHE[parent] = new
+                pending.append((parent, added | removed))
+
+
+def recheck_accounts(group, accounts, candidates):
+    """Re-evaluate membership of some candidate accounts in a group.
+
+    Returns (accounts, added, removed): the group's accounts with each
+    candidate added or removed according to the group's current members,
+    and the candidates that were added and removed. Only the candidates'
+    own edges and the group's subgroups are read.
+    """
+    direct, edges = recheck_edges(group, candidates)
+    union = []
+    intersect = []
+    prune = []
+    for edgetype, member in edges:
+        if edgetype == "or":
+            union.append(list_accounts(member))
+        elif edgetype == "and":
+            intersect.append(list_accounts(member))
+        elif edgetype == "not":
+            prune.append(list_accounts(member))
+        else:
+            raise Failure("Unknown edge type '{}' for member.".format(edgetype))
+    added = set()
+    removed = set()
+    for account in candidates:
+        member = (
+            account in direct or
+            any(account in s for s in union) or
+            (bool(intersect) and all(account in s for s in intersect))
+        ) and not any(account in s for s in prune)
+        if member and account not in accounts:
+            added.add(account)
+        elif not member and account in accounts:
+            removed.add(account)
+    if added:
+        accounts = accounts | added
+    if removed:
+        accounts = accounts - removed
+    return account_set(accounts), added, removed
+
+
+def recheck_edges(group, accounts):
+    """Return those of some accounts that are direct members of a group,
+    and the group's members that aren't accounts, read together."""
+    if GRAPH is not None:
+        return set(
+            account for account in accounts
+            if GRAPH.edgetype(group, unicode(account)) == "account"
+        ), GRAPH.subgroups(group)
+    accounts = [unicode(account) for account in accounts]
+    if not accounts:
+        rows = execute(SELECT_SUBGROUPS, parent=group)
+    elif len(accounts) == 1:
+        rows = execute(SELECT_SUBGROUPS_OR_EDGE, parent=group, child=accounts[0])
+    else:
+        rows = execute(SELECT_MEMBERS.where(
+            GROUP_EDGE |
+            group_members.c.child.in_(accounts[:MEMBER_QUERY_CHUNK]) & ACCOUNT_EDGE,
+        ), parent=group)
+    direct = set()
+    edges = set()
+    for row in rows:
+        if row.edgetype == "account":
+            direct.add(int(row.child))
+        else:
+            edges.add((row.edgetype, row.child))
+    for i in range(MEMBER_QUERY_CHUNK, len(accounts), MEMBER_QUERY_CHUNK):
+        query = sqlalchemy.select([group_members.c.child]).where(
+            (group_members.c.parent == group) &
+            group_members.c.child.in_(accounts[i:i + MEMBER_QUERY_CHUNK]) &
+            ACCOUNT_EDGE,
+        )
+        direct.update(int(row.child) for row in execute(query))
+    return direct, edges
+
+
+def subgroup_edges(group):
+    """Return a group's members that aren't accounts, as (edgetype, child)."""
+    if GRAPH is not None:
+        return GRAPH.subgroups(group)
+    return set(
+        (row.edgetype, row.child)
+        for row in execute(SELECT_SUBGROUPS, parent=group))
+
+
+def reload_state():
+    """Rebuild all in-memory state after the tables changed underneath it.
+
+    Caches are emptied, and a loaded graph or built membership index is
+    rebuilt from the db.
+    """
+    with changing_caches():
+        clear_caches()
+        if GRAPH is not None:
+            load_graph()
+        if MEMBERSHIP_INDEX is not None:
+            build_membership_index()
+
+
+BUMP_GENERATION = group_generation.update().values(
+    generation=group_generation.c.generation + 1,
+)
+SELECT_GENERATION = sqlalchemy.select([
+    group_generation.c.generation,
+    group_generation.c.pruned,
+])
+INSERT_CHANGE = group_changes.insert().values(
+    generation=sqlalchemy.select([group_generation.c.generation]).as_scalar(),
+)
+SELECT_CHANGES = group_changes.select().where(
+    (group_changes.c.generation > sqlalchemy.bindparam("since")) &
+    (group_changes.c.generation <= sqlalchemy.bindparam("until")),
+).order_by(group_changes.c.generation)
+
+
+def record_change(t, op, parent=None, child=None, edgetype=None):
+    """Log a write to the group tables as part of transaction t."""
+    record_changes(t, [(op, parent, child, edgetype)])
+
+
+def record_changes(t, changes):
+    """Log (op, parent, child, edgetype) writes as a single generation."""
+    t.execute(BUMP_GENERATION)
+    t.execute(INSERT_CHANGE, [
+        dict(op=op, parent=parent, child=child, edgetype=edgetype)
+        for op, parent, child, edgetype in changes
+    ])
+
+
+def export_state():
+    """Return (generation, graph, {group: accounts}) for a snapshot.
+
+    The graph is read from the db after the generation, and the accounts
+    from the caches once synced, so both are at least that new. Replaying
+    the log from the generation onto them is then harmless.
+    """
+    generation = execute(SELECT_GENERATION).first().generation
+    graph = GroupGraph.load()
+    if SYNC_INTERVAL is not None:
+        sync_caches()
+    expansions = dict(
+        (name, list_accounts(name)) for name in graph.groups())
+    return generation, graph, expansions
+
+
+def restore_state(generation, expansions, graph=None):
+    """Install state from export_state(), then catch up from the log.
+
+    The expansions replace the account cache, and a given graph is used
+    to answer reads as if by load_graph(). Fails, changing nothing, if the
+    log no longer has every change since generation, or if the db isn't
+    that far along yet.
+    """
+    global GRAPH
+    global SYNC_GENERATION
+    current = execute(SELECT_GENERATION).first()
+    if not current.pruned <= generation <= current.generation:
+        raise Failure(
+            "State from generation {} can't be brought up to date with "
+            "the db at generation {}.".format(generation, current.generation))
+    with changing_caches():
+        clear_caches()
+        if graph is not None:
+            GRAPH = graph
+        for name, accounts in expansions.items():
+            ACCOUNT_EXPANSIONS_CACHE[name] = accounts
+        SYNC_GENERATION = generation
+        replay_changes()
+        if MEMBERSHIP_INDEX is not None:
+            build_membership_index()
+
+
+# How many seconds may pass between checks of the change log for writes
+# made by other processes; 0 checks before every call. None (the default)
+# never checks, which is only safe with a single process.
+SYNC_INTERVAL = None
+# The generation this process's caches are known to be up to date with.
+SYNC_GENERATION = None
+SYNC_TIME = 0
+# More changes than this since the last check are handled with a reload.
+SYNC_REPLAY_LIMIT = 100
+SYNC_STATE = threading.local()
+
+
+def configure_sync(interval):
+    """Check for other processes' writes at most every interval seconds.
+
+    Caches are emptied, since they may already be out of date. Pass None
+    to stop checking.
+    """
+    global SYNC_INTERVAL
+    global SYNC_GENERATION
+    global SYNC_TIME
+    SYNC_INTERVAL = interval
+    SYNC_GENERATION = execute(SELECT_GENERATION).first().generation
+    SYNC_TIME = time.time()
+    reload_state()
+
+
+def synced(func):
+    """Bring the caches up to date before func runs, when it's time to.
+
+    Calls made while another synced call or a sync is running on the
+    same thread don't check again, so that caches can't change halfway
+    through an expansion.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if SYNC_INTERVAL is None or getattr(SYNC_STATE, "active", False):
+            return func(*args, **kwargs)
+        SYNC_STATE.active = True
+        try:
+            if time.time() - SYNC_TIME >= SYNC_INTERVAL:
+                apply_changes()
+            return func(*args, **kwargs)
+        finally:
+            SYNC_STATE.active = False
+    return wrapper
+
+
+def sync_caches():
+    """Update the caches for every write logged since they were last synced.
+
+    Writes made by this process are applied again, which is harmless.
+    """
+    active = getattr(SYNC_STATE, "active", False)
+    SYNC_STATE.active = True
+    try:
+        apply_changes()
+    finally:
+        SYNC_STATE.active = active
+
+
+def apply_changes():
+    with changing_caches():
+        replay_changes()
+
+
+def replay_changes():
+    global SYNC_GENERATION
+    global SYNC_TIME
+    SYNC_TIME = time.time()
+    current = execute(SELECT_GENERATION).first()
+    if SYNC_GENERATION is None or SYNC_GENERATION < current.pruned:
+        # The changes we'd need are gone from the log.
+        SYNC_GENERATION = current.generation
+        reload_state()
+        return
+    if current.generation == SYNC_GENERATION:
+        return
+    changes = execute(
+        SELECT_CHANGES, since=SYNC_GENERATION, until=current.generation,
+    ).fetchall()
+    SYNC_GENERATION = current.generation
+    if len(changes) > SYNC_REPLAY_LIMIT or any(
+            change.op == "reload" for change in changes):
+        reload_state()
+        return
+    refresh_after([
+        (change.op, change.parent, change.child, change.edgetype)
+        for change in changes
+    ])
+
+
+def refresh_after(changes):
+    """Bring the graph, caches and index up to date after many writes.
+
+    changes are (op, parent, child, edgetype) tuples as in the change
+    log. A group drop must come after drops of all of its edges, as
+    drop_group() logs them. Everything affected is worked out once for
+    all of them, rather than once per change.
+    """
+    with changing_caches():
+        upwards = set()
+        downwards = set()
+        dropped = set()
+        # parent -> accounts that may have changed, or None for any
+        candidates = {}
+        for op, parent, child, edgetype in changes:
+            if GRAPH is not None:
+                if op == "create":
+                    GRAPH.add_group(parent)
+                elif op == "drop-group":
+                    GRAPH.drop_group(parent)
+                elif op == "add":
+                    GRAPH.add_edge(parent, child, edgetype)
+                else:
+                    GRAPH.drop_edge(parent, child, edgetype)
+            if op == "drop-group":
+                dropped.add(parent)
+            if op in ("create", "drop-group"):
+                continue
+            upwards.add(parent)
+            downwards.add(child)
+            if edgetype == "account":
+                accounts = candidates.setdefault(parent, set())
+                if accounts is not None:
+                    accounts.add(int(child))
+            else:
+                candidates[parent] = None
+        # Groups above a subgroup edit, where any account may have changed.
+        restructured = set()
+        for parent in list(upwards):
+            ancestors = list_ancestors(parent)
+            upwards |= ancestors
+            if candidates.get(parent, ()) is None:
+                restructured |= ancestors | set([parent])
+        for child in list(downwards):
+            # Accounts have nothing below them.
+            if not child.isdigit():
+                downwards |= list_descendants(child)
         clear_ancestor_cache(downwards)
         clear_descendant_cache(upwards)
+        if not INCREMENTAL_CACHES:
+            clear_account_cache(upwards)
+        else:
+            for parent, accounts in candidates.items():
+                propagate_accounts(parent, accounts)
+        if dropped:
+            clear_account_cache(dropped)
+            clear_ancestor_cache(dropped)
+            clear_descendant_cache(dropped)
+            if MEMBERSHIP_INDEX is not None:
+                for name in dropped:
+                    MEMBERSHIP_INDEX.discard(name)
+        changed = set()
+        for accounts in candidates.values():
+            changed |= accounts or set()
+        refresh_membership_index(restructured - dropped)
+        refresh_membership_index(upwards - restructured - dropped, changed)
+
+
+def prune_changes(keep=1000):
+    """Remove all but the last keep generations from the change log.
+
+    Processes that haven't synced since before then reload everything
+    on their next sync.
+    """
+    with transaction() as t:
+        current = t.execute(SELECT_GENERATION).first()
+        pruned = max(current.pruned, current.generation - keep)
+        t.execute(group_changes.delete().where(
+            group_changes.c.generation <= pruned))
+        t.execute(group_generation.update().values(pruned=pruned))
+
+
+GROUP_NAME_PATTERN = "^[a-z-]+$"
 
 
+INSERT_GROUP = groups.insert()
+DELETE_GROUP = groups.delete().where(
+    groups.c.name == sqlalchemy.bindparam("name"),
+)
+DELETE_GROUP_EDGES = group_members.delete().where(
+    (group_members.c.parent == sqlalchemy.bindparam("name")) |
+    (group_members.c.child == sqlalchemy.bindparam("name")),
+)
+SELECT_GROUP_EDGES = group_members.select().where(
+    (group_members.c.parent == sqlalchemy.bindparam("name")) |
+    (group_members.c.child == sqlalchemy.bindparam("name")),
+)
+SELECT_GROUPS = sqlalchemy.select([groups.c.name])
+SELECT_GROUP = sqlalchemy.select([groups.c.name]).where(
+    groups.c.name == sqlalchemy.bindparam("name"),
+)
+INSERT_EDGE = group_members.insert()
+DELETE_EDGE = group_members.delete().where(
+    (group_members.c.parent == sqlalchemy.bindparam("parent")) &
+    (group_members.c.child == sqlalchemy.bindparam("child")) &
+    (group_members.c.edgetype == sqlalchemy.bindparam("edgetype")),
+)
+SELECT_EDGE = sqlalchemy.select([group_members.c.parent]).where(
+    (group_members.c.parent == sqlalchemy.bindparam("parent")) &
+    (group_members.c.child == sqlalchemy.bindparam("child")),
+)
+SELECT_MEMBERS = sqlalchemy.select([
+    group_members.c.edgetype,
+    group_members.c.child,
+]).where(
+    group_members.c.parent == sqlalchemy.bindparam("parent"),
+)
+SELECT_SUBGROUPS = SELECT_MEMBERS.where(GROUP_EDGE)
+SELECT_SUBGROUPS_OR_EDGE = SELECT_MEMBERS.where(
+    GROUP_EDGE |
+    (group_members.c.child == sqlalchemy.bindparam("child")) & ACCOUNT_EDGE,
+)
+SELECT_PARENTS = sqlalchemy.select([group_members.c.parent]).where(
+    group_members.c.child == sqlalchemy.bindparam("child"),
+)
+
+
+@metrics.instrumented
+@synced
 def create_group(name):
     """Create a new group."""
-    if not re.match("^[a-z-]+$", name):
+    if not re.match(GROUP_NAME_PATTERN, name):
         raise Failure("The group name '{}' is invalid.".format(name))
-    query = groups.insert().values(
-        name=name,
-    )
     try:
-        query.execute()
+        with transaction() as t:
+            t.execute(INSERT_GROUP, name=name)
+            record_change(t, "create", name)
     except sqlalchemy.exc.IntegrityError:
         raise Failure("The group '{}' already exists.".format(name))
+    if GRAPH is not None:
+        GRAPH.add_group(name)
 
 
+@metrics.instrumented
+@synced
 def drop_group(name):
     """Remove an existing group."""
-    delete_group = groups.delete().where(
-        groups.c.name == name,
-    )
-    delete_members = group_members.delete().where(
-        (group_members.c.parent == name) |
-        (group_members.c.child == name),
-    )
-    clear_caches(parent=name, child=name)
     with transaction() as t:
-        t.execute(delete_group)
-        t.execute(delete_members)
+        dropped = t.execute(DELETE_GROUP, name=name).rowcount
+        edges = t.execute(SELECT_GROUP_EDGES, name=name).fetchall()
+        if not dropped and not edges:
+            return
+        t.execute(DELETE_GROUP_EDGES, name=name)
+        # Logged edge by edge, so other processes can refresh only what
+        # the group was connected to rather than reloading everything.
+        changes = [
+            ("drop", edge.parent, edge.child, edge.edgetype) for edge in edges
+        ]
+        if dropped:
+            changes.append(("drop-group", name, None, None))
+        record_changes(t, changes)
+    refresh_after(changes)
+
+
+@metrics.instrumented
+@synced
+def list_groups():
+    """List the names of every group."""
+    if GRAPH is not None:
+        return GRAPH.groups()
+    return set(row.name for row in execute(SELECT_GROUPS))
 
 
+@metrics.instrumented
+@synced
 def group_exists(name):
     """Returns whether or not a group exists."""
-    query = groups.select().where(
-        groups.c.name == name,
-    )
-    if query.execute().first():
+    if GRAPH is not None:
+        return GRAPH.exists(name)
+    if execute(SELECT_GROUP, name=name).first():
         return True
     return False
 
 
+@metrics.instrumented
+@synced
 def add_subgroup(group, member, edgetype="or"):
-    """Add a group as a member to another group."""
+    """Add a group as a member to another group.
+
+    Fails if the group is already below the member, since that would
+    make a cycle.
+    """
     if not group_exists(group):
         raise Failure("No group named '{}' exists.".format(group))
-    query = group_members.insert().values(
-        parent=group,
-        child=member,
-        edgetype=edgetype,
-    )
-    clear_caches(parent=group, child=member)
+    if member == group or group in list_descendants(member):
+        raise Failure("Adding '{}' to '{}' would make a cycle.".format(
+            member, group))
     try:
-        query.execute()
+        with transaction() as t:
+            t.execute(
+                INSERT_EDGE, parent=group, child=member, edgetype=edgetype)
+            record_change(t, "add", group, member, edgetype)
     except sqlalchemy.exc.IntegrityError:
         # If the membership already exists, nothing more to do.
-        pass
+        return
+    if GRAPH is not None:
+        GRAPH.add_edge(group, member, edgetype)
+    update_caches(group, member)
 
 
+@metrics.instrumented
+@synced
 def drop_subgroup(group, member, edgetype="or"):
     """Remove a group from membership in another group."""
-    query = group_members.delete().where(
-        (group_members.c.parent == group) &
-        (group_members.c.child == member) &
-        (group_members.c.edgetype == edgetype),
-    )
-    clear_caches(parent=group, child=member)
-    query.execute()
+    with transaction() as t:
+        deleted = t.execute(
+            DELETE_EDGE, parent=group, child=member, edgetype=edgetype)
+        if not deleted.rowcount:
+            return
+        record_change(t, "drop", group, member, edgetype)
+    if GRAPH is not None:
+        GRAPH.drop_edge(group, member, edgetype)
+    update_caches(group, member)
 
 
+@metrics.instrumented
+@synced
 def list_members(group):
     """List all of the top-level members of a group.
 
     Note: will return an empty list for groups that do not exist.
     """
-    query = group_members.select().where(
-        group_members.c.parent == group,
-    )
-    result = query.execute()
+    if GRAPH is not None:
+        return GRAPH.members(group)
+    result = execute(SELECT_MEMBERS, parent=group)
     return set((row.edgetype, row.child) for row in result)
 
 
+@metrics.instrumented
+@synced
 def list_descendants(group):
     """Recursively list anything that could affect membership in this group."""
     descendants = DESCENDANT_EXPANSIONS_CACHE.get(group)
     if descendants is not None:
         return descendants
-    descendants = set()
-    query = group_members.select().where(
-        group_members.c.parent == group,
+    if GRAPH is None and RECURSIVE_QUERIES:
+        version = CACHES.version
+        descendants = closure.descendants(group)
+        CACHES.store(
+            DESCENDANT_EXPANSIONS_CACHE, [(group, descendants)], version)
+        return descendants
+    # Accounts have no members, so there's no need to look below them.
+    return collect(
+        group,
+        lambda name: [
+            (child, edgetype != "account")
+            for edgetype, child in list_members(name)
+        ],
+        DESCENDANT_EXPANSIONS_CACHE,
     )
-    for result in query.execute():
-        child = result.child
-        descendants.add(child)
-        descendants |= list_descendants(child)
-    descendants = frozenset(descendants)
-    DESCENDANT_EXPANSIONS_CACHE[group] = descendants
-    return descendants
 
 
+def collect(root, edges, cache):
+    """Gather everything reachable from root, without recursion.
+
+    edges(name) lists (other, follow) pairs; each other is gathered, and
+    also looked beyond if follow is true. The answer for root and for
+    everything looked beyond on the way is cached. Anything on a cycle
+    gathers itself.
+    """
+    version = CACHES.version
+    found = {}
+    following = {}
+    entries = []
+
+    def neighbours(name):
+        following[name] = edges(name)
+        return [other for other, follow in following[name] if follow]
+
+    def done(name):
+        cached = cache.get(name)
+        if cached is None:
+            return False
+        found[name] = cached
+        return True
+
+    for component, cyclic in components(root, neighbours, done):
+        inside = set(component)
+        reach = set(inside) if cyclic else set()
+        for name in component:
+            for other, follow in following[name]:
+                reach.add(other)
+                if follow and other not in inside:
+                    reach |= found[other]
+        reach = frozenset(reach)
+        for name in component:
+            found[name] = reach
+            entries.append((name, reach))
+    CACHES.store(cache, entries, version)
+    return found[root]
+
+
+@metrics.instrumented
+@synced
 def is_member(group, member):
     """Check for a top-level group membership.
 
     Note: this membership might be a negative edgetype.
     """
-    query = group_members.select().where(
-        (group_members.c.parent == group) &
-        (group_members.c.child == member),
-    )
-    if query.execute().first():
+    if GRAPH is not None:
+        return GRAPH.is_member(group, member)
+    if execute(SELECT_EDGE, parent=group, child=member).first():
         return True
     return False
 
 
+@metrics.instrumented
+@synced
 def add_member_account(group, account):
     """Add an account as a member to an existing group."""
     if not group_exists(group):
         raise Failure("No group named '{}' exists.".format(group))
     member = unicode(account)
-    query = group_members.insert().values(
-        parent=group,
-        child=member,
-        edgetype="account",
-    )
-    clear_caches(parent=group, child=member)
     try:
-        query.execute()
+        with transaction() as t:
+            t.execute(
+                INSERT_EDGE, parent=group, child=member, edgetype="account")
+            record_change(t, "add", group, member, "account")
     except sqlalchemy.exc.IntegrityError:
         # If the membership already exists, nothing more to do.
-        pass
+        return
+    if GRAPH is not None:
+        GRAPH.add_edge(group, member, "account")
+    update_caches(group, member, accounts=[int(account)])
 
 
+@metrics.instrumented
+@synced
 def drop_member_account(group, account):
     """Remove an account from membership in a group."""
     member = unicode(account)
-    query = group_members.delete().where(
-        (group_members.c.parent == group) &
-        (group_members.c.child == member) &
-        (group_members.c.edgetype == "account"),
-    )
-    clear_caches(parent=group, child=member)
-    query.execute()
+    with transaction() as t:
+        deleted = t.execute(
+            DELETE_EDGE, parent=group, child=member, edgetype="account")
+        if not deleted.rowcount:
+            return
+        record_change(t, "drop", group, member, "account")
+    if GRAPH is not None:
+        GRAPH.drop_edge(group, member, "account")
+    update_caches(group, member, accounts=[int(account)])
+
+
+class Batch(object):
+    """Membership edits queued up to be applied together.
+
+    Use it through batch(). The add/drop methods mirror the functions of
+    the same name, and nothing is written until commit().
+    """
+
+    def __init__(self):
+        self.edits = []
+        self.changes = None
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.commit()
+
+    def add_subgroup(self, group, member, edgetype="or"):
+        self.edits.append(("add", group, member, edgetype))
+
+    def drop_subgroup(self, group, member, edgetype="or"):
+        self.edits.append(("drop", group, member, edgetype))
+
+    def add_member_account(self, group, account):
+        self.edits.append(("add", group, unicode(account), "account"))
+
+    def drop_member_account(self, group, account):
+        self.edits.append(("drop", group, unicode(account), "account"))
+
+    def commit(self):
+        """Apply the queued edits; see apply_edits()."""
+        edits, self.edits = self.edits, []
+        self.changes = apply_edits(edits)
+        return self.changes
+
+
+def batch():
+    """Queue membership edits and apply them all when the block ends.
+
+        with group.batch() as edits:
+            edits.add_subgroup("staff", "admins")
+            edits.add_member_account("admins", 42)
+
+    Nothing is applied if the block raises.
+    """
+    return Batch()
+
+
+@metrics.instrumented
+@synced
+def apply_edits(edits):
+    """Apply many membership edits in one transaction.
+
+    edits are ("add" or "drop", group, member, edgetype) tuples, applied
+    in order with the same meaning as the single edit functions; account
+    members have the edgetype "account". Everything is checked first and
+    nothing is written if any edit would fail. Caches are brought up to
+    date once at the end rather than after every edit.
+
+    Returns the (op, group, member, edgetype) changes that were actually
+    made, as edits that cancel out or change nothing are left out.
+    """
+    edits = [
+        (op, parent, unicode(child), edgetype)
+        for op, parent, child, edgetype in edits
+    ]
+    for op, parent, child, edgetype in edits:
+        if op not in ("add", "drop"):
+            raise Failure("Unknown membership edit '{}'.".format(op))
+    missing = missing_groups(
+        set(parent for op, parent, _, _ in edits if op == "add"))
+    if missing:
+        raise Failure("No group named '{}' exists.".format(min(missing)))
+    existing = load_edges(set((parent, child) for _, parent, child, _ in edits))
+    wanted = dict(existing)
+    for op, parent, child, edgetype in edits:
+        if op == "add":
+            # Like add_subgroup(), an existing edge of any type is kept.
+            wanted.setdefault((parent, child), edgetype)
+        elif wanted.get((parent, child)) == edgetype:
+            del wanted[parent, child]
+    drops = []
+    adds = []
+    for parent, child in sorted(set(existing) | set(wanted)):
+        before = existing.get((parent, child))
+        after = wanted.get((parent, child))
+        if before == after:
+            continue
+        if before is not None:
+            drops.append(("drop", parent, child, before))
+        if after is not None:
+            adds.append(("add", parent, child, after))
+    check_cycles(adds, drops)
+    changes = drops + adds
+    if not changes:
+        return []
+    try:
+        with transaction() as t:
+            if drops:
+                t.execute(DELETE_EDGE, [
+                    dict(parent=parent, child=child, edgetype=edgetype)
+                    for _, parent, child, edgetype in drops
+                ])
+            if adds:
+                t.execute(INSERT_EDGE, [
+                    dict(parent=parent, child=child, edgetype=edgetype)
+                    for _, parent, child, edgetype in adds
+                ])
+            record_changes(t, changes)
+    except sqlalchemy.exc.IntegrityError:
+        raise Failure("Memberships changed while the edits were applied.")
+    refresh_after(changes)
+    return changes
 
+
+def missing_groups(names):
+    """Return which of some group names don't exist, in few queries."""
+    if GRAPH is not None:
+        return set(name for name in names if not GRAPH.exists(name))
+    names = list(names)
+    found = set()
+    for i in range(0, len(names), MEMBER_QUERY_CHUNK):
+        query = sqlalchemy.select([groups.c.name]).where(
+            groups.c.name.in_(names[i:i + MEMBER_QUERY_CHUNK]))
+        found.update(row.name for row in execute(query))
+    return set(names) - found
+
+
+def load_edges(pairs):
+    """Fetch {(parent, child): edgetype} for whichever pairs are edges.
+
+    Only the edges asked about are read, so touching a huge group is
+    cheap.
+    """
+    edges = {}
+    if GRAPH is not None:
+        for parent, child in pairs:
+            edgetype = GRAPH.edgetype(parent, child)
+            if edgetype is not None:
+                edges[parent, child] = edgetype
+        return edges
+    parents = sorted(set(parent for parent, _ in pairs))
+    children = sorted(set(child for _, child in pairs))
+    for i in range(0, len(parents), MEMBER_QUERY_CHUNK):
+        for j in range(0, len(children), MEMBER_QUERY_CHUNK):
+            query = group_members.select().where(
+                group_members.c.parent.in_(
+                    parents[i:i + MEMBER_QUERY_CHUNK]) &
+                group_members.c.child.in_(
+                    children[j:j + MEMBER_QUERY_CHUNK]),
+            )
+            for row in execute(query):
+                if (row.parent, row.child) in pairs:
+                    edges[row.parent, row.child] = row.edgetype
+    return edges
+
+
+def check_cycles(adds, drops):
+    """Fail if making some changes to the edges would make a cycle."""
+    subgroups = [
+        (parent, child) for _, parent, child, edgetype in adds
+        if edgetype != "account"
+    ]
+    if not subgroups:
+        return
+    dropped = set((parent, child) for _, parent, child, _ in drops)
+
+    def children(name):
+        found = [
+            child for edgetype, child in list_members(name)
+            if edgetype != "account" and (name, child) not in dropped
+        ]
+        return found + [child for parent, child in subgroups if parent == name]
+
+    for parent, child in subgroups:
+        # The cached descendants ignore the edits, but they are usually
+        # enough to show that no cycle is possible.
+        reach = set([child]) | list_descendants(child)
+        pending = [c for p, c in subgroups if p in reach and c not in reach]
+        while pending:
+            name = pending.pop()
+            reach.add(name)
+            reach |= list_descendants(name)
+            pending.extend(
+                c for p, c in subgroups if p in reach and c not in reach)
+        if parent not in reach:
+            continue
+        seen = set()
+        pending = [child]
+        while pending:
+            name = pending.pop()
+            if name == parent:
+                raise Failure("Adding '{}' to '{}' would make a cycle.".format(
+                    child, parent))
+            if name not in seen:
+                seen.add(name)
+                pending.extend(children(name))
+
+
+@metrics.instrumented
+@synced
 def list_accounts(group):
     """List all of the accounts that are a member of a group.
 
@@ -203,58 +1118,538 @@ def list_accounts(group):
     accounts = ACCOUNT_EXPANSIONS_CACHE.get(group)
     if accounts is not None:
         return accounts
+    if GRAPH is None and RECURSIVE_QUERIES:
+        version = CACHES.version
+        edges = closure.reachable_members([group])
+        return evaluate_accounts(group, lambda g: edges.get(g, ()), version)
+    return evaluate_accounts(group, list_members)
+
+
+def expand_accounts(group, members, version=None):
+    """Evaluate a group's accounts, reading top-level members via members().
+
+    Results for the group and everything below it are cached once they
+    are computed.
+    """
+    accounts = ACCOUNT_EXPANSIONS_CACHE.get(group)
+    if accounts is not None:
+        return accounts
+    return evaluate_accounts(group, members, version)
 
-    union = set()
-    prune = set()
-    intersect = None
-    for edgetype, member in list_members(group):
+
+def evaluate_accounts(group, members, version=None):
+    """Compute and cache a group's accounts, ignoring its cached value.
+
+    Anything below the group that isn't cached is evaluated too, children
+    first and without recursion. Groups on a cycle are solved together:
+    "or" edges between them give the smallest answer consistent with
+    all of them, and "and" and "not" edges between them are ignored, as
+    those have no consistent answer in general.
+
+    If members() answers from data fetched earlier, version must be the
+    CACHES.version from before it was fetched.
+    """
+    if version is None:
+        version = CACHES.version
+    found = {}
+    edges = {}
+    computed = []
+
+    def neighbours(name):
+        edges[name] = list(members(name))
+        return [child for edgetype, child in edges[name]
+                if edgetype != "account"]
+
+    def done(name):
+        accounts = ACCOUNT_EXPANSIONS_CACHE.get(name)
+        if accounts is None:
+            return False
+        found[name] = accounts
+        return True
+
+    for component, cyclic in components(group, neighbours, done):
+        inside = set(component) if cyclic else set()
+        for name in component:
+            found[name] = account_set(())
+        changed = True
+        while changed:
+            changed = False
+            for name in component:
+                accounts = combine_accounts(edges[name], found, inside)
+                if accounts != found[name]:
+                    found[name] = accounts
+                    changed = cyclic
+        computed.extend((name, found[name]) for name in component)
+    CACHES.store(ACCOUNT_EXPANSIONS_CACHE, computed, version)
+    return found[group]
+
+
+def combine_accounts(edges, found, inside):
+    """Apply a group's edges to the accounts found for its children.
+
+    "and" and "not" edges to groups in inside are skipped.
+    """
+    direct = []
+    union = []
+    intersect = []
+    prune = []
+    for edgetype, member in edges:
         if edgetype == "account":
-            union.add(int(member))
+            direct.append(int(member))
+        elif edgetype not in ("or", "and", "not"):
+            raise Failure("Unknown edge type '{}' for member.".format(edgetype))
         elif edgetype == "or":
-            union |= list_accounts(member)
+            union.append(found[member])
+        elif member in inside:
+            continue
         elif edgetype == "and":
-            if intersect is None:
-                intersect = set(list_accounts(member))
-            else:
-                intersect &= list_accounts(member)
-        elif edgetype == "not":
-            prune |= list_accounts(member)
+            intersect.append(found[member])
         else:
-            raise Failure("Unknown edge type '{}' for member.".format(edgetype))
-    intersect = intersect or set()
-    accounts = frozenset((union | intersect) - prune)
-    ACCOUNT_EXPANSIONS_CACHE[group] = accounts
-    return accounts
+            prune.append(found[member])
+    if COMPACT_ACCOUNTS:
+        return accountset.combine(direct, union, intersect, prune)
+    accounts = set(direct).union(*union)
+    if intersect:
+        accounts |= set(intersect[0]).intersection(*intersect[1:])
+    return frozenset(accounts.difference(*prune))
 
 
+@metrics.instrumented
+@synced
 def is_member_account(group, account):
     """Returns whether or not an account is a member of a group.
 
-    This function checks both direct and indirect memberships.
+    This function checks both direct and indirect memberships. Unless
+    the group's accounts are already cached, only the parts of the group
+    that can affect this one account are looked at.
+    """
+    accounts = ACCOUNT_EXPANSIONS_CACHE.get(group)
+    if accounts is not None:
+        return account in accounts
+    # The groups the account is directly in come from one indexed query,
+    # so no group's other accounts are read.
+    direct = list_parents(unicode(account))
+    try:
+        return evaluate_account(group, account, subgroup_edges, {}, direct)
+    except CycleFound:
+        return account in list_accounts(group)
+
+
+def check_account(group, account, members, seen, direct):
+    """Decide whether an account is in a group, using cached expansions.
+
+    seen maps groups already decided during this check to the answer.
     """
-    return account in list_accounts(group)
+    found = seen.get(group)
+    if found is not None:
+        return found
+    accounts = ACCOUNT_EXPANSIONS_CACHE.get(group)
+    if accounts is not None:
+        found = account in accounts
+        seen[group] = found
+        return found
+    return evaluate_account(group, account, members, seen, direct)
+
 
+def evaluate_account(group, account, members, seen, direct):
+    """Decide whether an account is in a group without expanding it.
+
+    direct holds the groups the account is a direct member of, and
+    members(name) gives at least each group's edges to its subgroups.
+    Stops at the first \"or\" child that has the account, checks \"and\"
+    children smallest-first and stops at the first miss, and only checks
+    \"not\" children once the account has been found. Children are
+    decided with an explicit stack rather than recursion. Raises
+    CycleFound on a cycle, which evaluate_accounts() can handle instead.
+    """
+    stack = [(group, account_steps(group, account, members, direct))]
+    deciding = set([group])
+    answer = None
+    while stack:
+        name, steps = stack[-1]
+        step = steps.send(answer)
+        if isinstance(step, bool):
+            # The group is decided; hand the answer to its parent.
+            stack.pop()
+            deciding.discard(name)
+            seen[name] = answer = step
+            continue
+        answer = seen.get(step)
+        if answer is None:
+            accounts = ACCOUNT_EXPANSIONS_CACHE.get(step)
+            if accounts is not None:
+                answer = seen[step] = account in accounts
+        if answer is None:
+            if step in deciding:
+                raise CycleFound(step)
+            deciding.add(step)
+            stack.append((step, account_steps(step, account, members, direct)))
+    return answer
+
+
+def account_steps(group, account, members, direct):
+    """Decide one group for evaluate_account(), as a generator.
+
+    Yields each child that needs deciding and is sent back its answer,
+    then yields the group's own answer as a bool.
+    """
+    found = group in direct
+    union = []
+    intersect = []
+    prune = []
+    for edgetype, member in members(group):
+        if edgetype == "account":
+            continue
+        elif edgetype == "or":
+            union.append(member)
+        elif edgetype == "and":
+            intersect.append(member)
+        elif edgetype == "not":
+            prune.append(member)
+        else:
+            raise Failure("Unknown edge type '{}' for member.".format(edgetype))
+    if not found:
+        for member in union:
+            found = yield member
+            if found:
+                break
+    if not found and intersect:
+        intersect.sort(key=expansion_size)
+        found = True
+        for member in intersect:
+            if not (yield member):
+                found = False
+                break
+    if found:
+        for member in prune:
+            if (yield member):
+                found = False
+                break
+    yield found
+
+
+def expansion_size(group):
+    """Estimate how costly a group is to check, from whatever is cached."""
+    # Cached groups are a single lookup, so they always go first.
+    if group in ACCOUNT_EXPANSIONS_CACHE:
+        return (0, len(ACCOUNT_EXPANSIONS_CACHE.get(group, ())))
+    if group in DESCENDANT_EXPANSIONS_CACHE:
+        return (1, len(DESCENDANT_EXPANSIONS_CACHE.get(group, ())))
+    return (2, 0)
+
+
+@metrics.instrumented
+@synced
+def check_member_accounts(group, accounts):
+    """Check many accounts for membership in one group.
+
+    Returns a dict mapping each account to whether it is a member. The
+    group is expanded once, with as few queries as possible, and every
+    account is tested against that.
+    """
+    expanded = ACCOUNT_EXPANSIONS_CACHE.get(group)
+    if expanded is None:
+        version = CACHES.version
+        expanded = evaluate_accounts(group, load_members([group]), version)
+    accounts = list(accounts)
+    if isinstance(expanded, AccountSet):
+        return dict(zip(accounts, expanded.contains_each(accounts)))
+    return dict((account, account in expanded) for account in accounts)
+
+
+@metrics.instrumented
+@synced
+def check_account_memberships(account, names):
+    """Check one account for membership in many groups.
+
+    Returns a dict mapping each group to whether the account is a member.
+    Groups that aren't cached share one fetch of the hierarchy below them
+    and one set of intermediate answers.
+    """
+    result = {}
+    pending = []
+    for name in names:
+        accounts = ACCOUNT_EXPANSIONS_CACHE.get(name)
+        if accounts is not None:
+            result[name] = account in accounts
+        else:
+            pending.append(name)
+    if pending:
+        members = load_members(pending, accounts=False)
+        direct = list_parents(unicode(account))
+        seen = {}
+        for name in pending:
+            try:
+                result[name] = check_account(
+                    name, account, members, seen, direct)
+            except CycleFound:
+                result[name] = account in list_accounts(name)
+    return result
+
+
+# Upper bound on the number of names in a single IN clause.
+MEMBER_QUERY_CHUNK = 500
+
+
+def load_members(names, accounts=True):
+    """Fetch the top-level members of everything reachable from some groups.
+
+    Returns a function like list_members() that answers from what was
+    fetched. Without a loaded graph or recursive queries, this runs one
+    query per level of the hierarchy rather than one per group. Groups
+    whose accounts are already cached are not descended into. Without
+    accounts, only the edges to subgroups are fetched, as with
+    subgroup_edges().
+    """
+    read = list_members if accounts else subgroup_edges
+    if GRAPH is not None:
+        return read
+    if RECURSIVE_QUERIES:
+        # Everything reachable was fetched, so missing means no members.
+        fetched = closure.reachable_members(names, accounts)
+        return lambda group: fetched.get(group, ())
+    fetched = {}
+    frontier = set(names)
+    while frontier:
+        for name in frontier:
+            fetched[name] = set()
+        frontier = list(frontier)
+        for i in range(0, len(frontier), MEMBER_QUERY_CHUNK):
+            query = group_members.select().where(
+                group_members.c.parent.in_(
+                    frontier[i:i + MEMBER_QUERY_CHUNK]),
+            )
+            if not accounts:
+                query = query.where(GROUP_EDGE)
+            for row in execute(query):
+                fetched[row.parent].add((row.edgetype, row.child))
+        frontier = set(
+            child
+            for name in frontier
+            for edgetype, child in fetched[name]
+            if edgetype != "account" and
+            child not in fetched and
+            child not in ACCOUNT_EXPANSIONS_CACHE
+        )
 
+    def members(group):
+        edges = fetched.get(group)
+        if edges is None:
+            # Not fetched up front, e.g. it was cached and then evicted.
+            return read(group)
+        return edges
+    return members
+
+
+# How many of a group's own accounts are read per query when streaming.
+STREAM_CHUNK = 10000
+
+# Groups more than this many levels below the streamed one are expanded
+# in full instead, which bounds how deeply streams are nested.
+STREAM_DEPTH = 50
+
+# Matches the member_accounts index, so pages are read off it in order.
+ACCOUNT_ID = sqlalchemy.cast(group_members.c.child, sqlalchemy.BigInteger)
+SELECT_FIRST_ACCOUNTS = sqlalchemy.select([ACCOUNT_ID.label("account")]).where(
+    (group_members.c.parent == sqlalchemy.bindparam("parent")) & ACCOUNT_EDGE,
+).order_by(ACCOUNT_ID).limit(sqlalchemy.bindparam("limit"))
+SELECT_NEXT_ACCOUNTS = SELECT_FIRST_ACCOUNTS.where(
+    ACCOUNT_ID > sqlalchemy.bindparam("after"),
+)
+
+
+@synced
+def iter_accounts(group, after=None, chunk_size=1000):
+    """Yield a group's accounts in ascending order, chunk_size at a time.
+
+    Gives the same accounts as list_accounts(), but merges them from
+    sorted streams over the group's members rather than building the
+    whole set, so memory stays bounded for huge groups. Only accounts
+    above after are given; pass the last one seen to carry on later.
+    """
+    accounts = stream_accounts(group, after)
+    while True:
+        chunk = list(itertools.islice(accounts, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@metrics.instrumented
+@synced
+def page_accounts(group, after=None, limit=1000):
+    """Return one page of a group's accounts, and a cursor for the next.
+
+    Returns (accounts, cursor), where accounts are the first limit
+    accounts above after, ascending, and cursor is the after for the next
+    page, or None if there are no more. Each page is read afresh, so
+    edits made between pages show up in the pages after them.
+    """
+    if limit < 1:
+        raise Failure("Page limit must be at least 1, not {}.".format(limit))
+    # No stream can contribute more than a page, so none reads more.
+    accounts = stream_accounts(group, after, read_size=limit + 1)
+    page = list(itertools.islice(accounts, limit + 1))
+    if len(page) > limit:
+        return page[:limit], page[limit - 1]
+    return page, None
+
+
+def stream_accounts(group, after=None, read_size=None):
+    """Return an ascending iterator over a group's accounts above after.
+
+    Cached expansions are read in order. Otherwise, the subgroups below
+    the group are fetched without their accounts, and each group's own
+    accounts are read from the db in chunks of read_size (STREAM_CHUNK
+    by default) and merged with its children's streams. Children that
+    are shared, on a cycle or deeper than STREAM_DEPTH are expanded in
+    full and cached instead.
+    """
+    cached = ACCOUNT_EXPANSIONS_CACHE.get(group)
+    if cached is not None:
+        return accounts_above(cached, after)
+    subgroups = load_subgroups(group)
+    parents = dict.fromkeys(subgroups, 0)
+    for name, edges in subgroups.items():
+        for _, child in edges:
+            if child in parents:
+                parents[child] += 1
+    cyclic = set()
+    for component, is_cyclic in components(
+            group,
+            lambda name: [child for _, child in subgroups.get(name, ())],
+            lambda name: name not in subgroups):
+        if is_cyclic:
+            cyclic.update(component)
+
+    def build(name, depth):
+        accounts = ACCOUNT_EXPANSIONS_CACHE.get(name)
+        if accounts is not None:
+            return accounts_above(accounts, after)
+        if (name not in subgroups or name in cyclic or
+                depth >= STREAM_DEPTH or parents[name] > 1):
+            return accounts_above(list_accounts(name), after)
+        union = [direct_accounts(name, after, read_size)]
+        intersect = []
+        prune = []
+        for edgetype, child in subgroups[name]:
+            if edgetype == "or":
+                union.append(build(child, depth + 1))
+            elif edgetype == "and":
+                intersect.append(build(child, depth + 1))
+            elif edgetype == "not":
+                prune.append(build(child, depth + 1))
+            else:
+                raise Failure(
+                    "Unknown edge type '{}' for member.".format(edgetype))
+        if intersect:
+            union.append(accountset.iter_intersection(intersect))
+        accounts = accountset.iter_union(union)
+        if prune:
+            accounts = accountset.iter_difference(
+                accounts, accountset.iter_union(prune))
+        return accounts
+    return build(group, 0)
+
+
+def accounts_above(accounts, after):
+    """Iterate, in order, over the members of a set of accounts above after."""
+    if isinstance(accounts, AccountSet):
+        return accounts.above(after)
+    return iter(sorted(
+        account for account in accounts if after is None or account > after))
+
+
+def direct_accounts(group, after, read_size=None):
+    """Yield a group's own accounts above after, in order.
+
+    They're read from the graph or the db read_size at a time,
+    STREAM_CHUNK by default.
+    """
+    read_size = read_size or STREAM_CHUNK
+    while True:
+        if GRAPH is not None:
+            accounts = GRAPH.accounts(group, after, read_size)
+        elif after is None:
+            accounts = [int(row.account) for row in execute(
+                SELECT_FIRST_ACCOUNTS, parent=group, limit=read_size)]
+        else:
+            accounts = [int(row.account) for row in execute(
+                SELECT_NEXT_ACCOUNTS, parent=group, after=after,
+                limit=read_size)]
+        for account in accounts:
+            yield account
+        if len(accounts) < read_size:
+            return
+        after = accounts[-1]
+
+
+def load_subgroups(group):
+    """Fetch the subgroups of a group and everything below it, level by level.
+
+    Returns {name: [(edgetype, child)]}, leaving accounts out. Groups
+    whose accounts are cached are not descended into.
+    """
+    fetched = {}
+    frontier = set([group])
+    while frontier:
+        for name in frontier:
+            fetched[name] = []
+        frontier = list(frontier)
+        if GRAPH is not None:
+            for name in frontier:
+                fetched[name] = list(GRAPH.subgroups(name))
+        else:
+            for i in range(0, len(frontier), MEMBER_QUERY_CHUNK):
+                query = group_members.select().where(
+                    group_members.c.parent.in_(
+                        frontier[i:i + MEMBER_QUERY_CHUNK]) & GROUP_EDGE,
+                )
+                for row in execute(query):
+                    fetched[row.parent].append((row.edgetype, row.child))
+        frontier = set(
+            child
+            for name in frontier
+            for _, child in fetched[name]
+            if child not in fetched and child not in ACCOUNT_EXPANSIONS_CACHE
+        )
+    return fetched
+
+
+@metrics.instrumented
+@synced
+def list_parents(member):
+    """List the groups that something is a direct member of."""
+    if GRAPH is not None:
+        return GRAPH.parents(member)
+    return set(row.parent for row in execute(SELECT_PARENTS, child=member))
+
+
+@metrics.instrumented
+@synced
 def list_ancestors(member):
     """List all of the groups that something is a member of, directly or indirectly."""
     ancestors = ANCESTOR_EXPANSIONS_CACHE.get(member)
     if ancestors is not None:
         return ancestors
-    ancestors = set()
-    query = group_members.select().where(
-        group_members.c.child == member,
+    if GRAPH is None and RECURSIVE_QUERIES:
+        version = CACHES.version
+        ancestors = closure.ancestors(member)
+        CACHES.store(ANCESTOR_EXPANSIONS_CACHE, [(member, ancestors)], version)
+        return ancestors
+    return collect(
+        member,
+        lambda name: [(parent, True) for parent in list_parents(name)],
+        ANCESTOR_EXPANSIONS_CACHE,
     )
-    for result in query.execute():
-        ancestor = result.parent
-        ancestors.add(ancestor)
-        ancestors |= list_ancestors(ancestor)
-    ancestors = frozenset(ancestors)
-    ANCESTOR_EXPANSIONS_CACHE[member] = ancestors
-    return ancestors
 
 
+@metrics.instrumented
+@synced
 def list_account_memberships(account):
     """List all groups that an account is a member of, directly or indirectly."""
+    if MEMBERSHIP_INDEX is not None:
+        return set(MEMBERSHIP_INDEX.groups(account))
     ancestors = list_ancestors(unicode(account))
     return set(
         a for a in ancestors
@@ -0,0 +1,64 @@
+class MembershipIndex(object):
+    """A reverse index from accounts to the groups they are effectively in.
+
+    Groups are indexed in full with update(), which applies only the
+    difference from what was indexed before, or told which accounts came
+    and went with change().
+    """
+
+    def __init__(self):
+        # group -> accounts, as last indexed. These are the sets given to
+        # update() until change() first needs a set of its own to edit.
+        self._accounts = {}
+        # Groups whose accounts are a set of the index's own.
+        self._owned = set()
+        # account -> set of groups
+        self._groups = {}
+
+    def update(self, group, accounts):
+        """Record the current accounts of a group."""
+        old = self._accounts.get(group, frozenset())
+        if accounts is old:
+            return
+        self._apply(group, accounts - old, old - accounts)
+        self._owned.discard(group)
+        if accounts:
+            self._accounts[group] = accounts
+        else:
+            self._accounts.pop(group, None)
+
+    def change(self, group, added, removed):
+        """Record accounts that joined or left a group."""
+        old = self._accounts.get(group, frozenset())
+        added = set(account for account in added if account not in old)
+        removed = set(account for account in removed if account in old)
+        if not added and not removed:
+            return
+        self._apply(group, added, removed)
+        if group not in self._owned:
+            old = set(old)
+            self._owned.add(group)
+        old |= added
+        old -= removed
+        if old:
+            self._accounts[group] = old
+        else:
+            self._accounts.pop(group, None)
+            self._owned.discard(group)
+
+    def _apply(self, group, added, removed):
+        for account in removed:
+            groups = self._groups[account]
+            groups.discard(group)
+            if not groups:
+                del self._groups[account]
+        for account in added:
+            self._groups.setdefault(account, set()).add(group)
+
+    def discard(self, group):
+        """Forget a group entirely."""
+        self.update(group, frozenset())
+
+    def groups(self, account):
+        """Return the groups an account is effectively a member of."""
+        return frozenset(self._groups.get(account, ()))
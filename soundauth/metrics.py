@@ -0,0 +1,117 @@
+"""Optional instrumentation of soundauth's public functions.
+
+Nothing is measured until a sink is installed with set_sink(). After
+that, each call to an instrumented function ends with
+
+    sink.record(name, seconds, counts)
+
+where name is like "group.list_accounts" and counts holds the number of
+SQL statements ("queries") run during the call and the expansion cache
+"hits" and "misses" it saw. Only the outermost instrumented call on a
+thread is reported, so a check that expands a dozen groups shows up once,
+with the queries of all of them.
+
+bcrypt work is reported on its own as "auth.bcrypt" (with empty counts)
+wherever it runs in this process, including on the auth pool's threads,
+so login time can be split into hashing and lookups.
+
+Recorder is a sink that keeps running totals in memory.
+"""
+import functools
+import threading
+import timeit
+
+
+SINK = None
+
+COUNTERS = ("queries", "hits", "misses")
+
+# Holds the counts of the instrumented call running on this thread, if any.
+LOCAL = threading.local()
+
+
+def set_sink(sink):
+    """Report to sink from now on, or stop measuring if sink is None."""
+    global SINK
+    SINK = sink
+
+
+def count(counter, amount=1):
+    """Add to a counter of the instrumented call on this thread, if any.
+
+    Callers check SINK first, so that this costs nothing when disabled.
+    """
+    counts = getattr(LOCAL, "counts", None)
+    if counts is not None:
+        counts[counter] += amount
+
+
+def instrumented(func):
+    """Report calls to func to the sink, when one is installed."""
+    name = "{}.{}".format(func.__module__.rpartition(".")[2], func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if SINK is None or getattr(LOCAL, "counts", None) is not None:
+            return func(*args, **kwargs)
+        return measure(SINK, name, func, args, kwargs)
+    return wrapper
+
+
+def measure(sink, name, func, args, kwargs):
+    LOCAL.counts = counts = dict.fromkeys(COUNTERS, 0)
+    start = timeit.default_timer()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        seconds = timeit.default_timer() - start
+        LOCAL.counts = None
+        sink.record(name, seconds, counts)
+
+
+def timed(name):
+    """Report every call to the decorated function under name, nested or not."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            sink = SINK
+            if sink is None:
+                return func(*args, **kwargs)
+            start = timeit.default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                sink.record(name, timeit.default_timer() - start, {})
+        return wrapper
+    return decorator
+
+
+class Recorder(object):
+    """A sink that totals calls, time and counts for each name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def record(self, name, seconds, counts):
+        with self._lock:
+            totals = self._totals.get(name)
+            if totals is None:
+                totals = dict.fromkeys(COUNTERS, 0)
+                totals.update(calls=0, seconds=0.0, max_seconds=0.0)
+                self._totals[name] = totals
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["max_seconds"] = max(totals["max_seconds"], seconds)
+            for counter, amount in counts.items():
+                totals[counter] += amount
+
+    def totals(self):
+        """Return {name: {"calls", "seconds", "max_seconds", counters...}}."""
+        with self._lock:
+            return dict(
+                (name, dict(totals)) for name, totals in self._totals.items())
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
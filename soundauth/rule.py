@@ -1,55 +1,384 @@
+import bisect
+import contextlib
+import time
+
+import sqlalchemy
+
+from . import metrics
+from .cache import CacheVersion
+from .db import execute
+from .db import rule_generation
 from .db import rules
+from .db import transaction
 from .group import group_exists
 
 
 class Failure(Exception): pass
 
 
-def create_rule(group, action, condition, argument=None):
+# Compiled RuleProgram for each group, dropped whenever its rules change.
+RULE_PROGRAMS = {}
+
+# Keeps readers from caching programs for rules a writer is changing.
+RULES = CacheVersion()
+
+# How many seconds may pass between checks for rules changed by other
+# processes; 0 checks before every compile. None (the default) never
+# checks, which is only safe with a single process.
+SYNC_INTERVAL = None
+# The rule generation RULE_PROGRAMS are known to be up to date with.
+SYNC_GENERATION = None
+SYNC_TIME = 0
+
+
+def clear_rule_programs(group=None):
+    if group is None:
+        RULE_PROGRAMS.clear()
+    else:
+        RULE_PROGRAMS.pop(group, None)
+
+
+@contextlib.contextmanager
+def changing_rules(group=None):
+    """Mark rules as being written, and drop stale programs once done.
+
+    With no group, every compiled program is dropped.
+    """
+    with RULES.changing():
+        try:
+            yield
+        finally:
+            clear_rule_programs(group)
+
+
+def configure_sync(interval):
+    """Check for other processes' rule writes at most every interval seconds.
+
+    Compiled programs are dropped, since they may already be out of date.
+    Pass None to stop checking.
+    """
+    global SYNC_INTERVAL
+    global SYNC_GENERATION
+    global SYNC_TIME
+    SYNC_INTERVAL = interval
+    with changing_rules():
+        SYNC_GENERATION = execute(SELECT_RULE_GENERATION).scalar()
+        SYNC_TIME = time.time()
+
+
+def sync_rule_programs():
+    """Drop every compiled program if the rules changed since last checked."""
+    global SYNC_GENERATION
+    global SYNC_TIME
+    if SYNC_INTERVAL is None or time.time() - SYNC_TIME < SYNC_INTERVAL:
+        return
+    SYNC_TIME = time.time()
+    generation = execute(SELECT_RULE_GENERATION).scalar()
+    if generation != SYNC_GENERATION:
+        with changing_rules():
+            SYNC_GENERATION = generation
+
+
+BUMP_RULE_GENERATION = rule_generation.update().values(
+    generation=rule_generation.c.generation + 1,
+)
+SELECT_RULE_GENERATION = sqlalchemy.select([rule_generation.c.generation])
+INSERT_RULE = rules.insert()
+SELECT_RULE = rules.select().where(
+    rules.c.id == sqlalchemy.bindparam("rule_id"),
+)
+DELETE_RULE = rules.delete().where(
+    rules.c.id == sqlalchemy.bindparam("rule_id"),
+)
+SELECT_GROUP_RULES = rules.select().where(
+    rules.c.group == sqlalchemy.bindparam("group"),
+).order_by(
+    rules.c.order,
+)
+SELECT_LAST_ORDER = sqlalchemy.select([
+    sqlalchemy.func.max(rules.c.order),
+]).where(
+    rules.c.group == sqlalchemy.bindparam("group"),
+)
+
+
+# Space left between the order keys of neighbouring rules, so that rules
+# can be inserted or moved without renumbering the rest of the group.
+ORDER_GAP = 1024
+
+
+@metrics.instrumented
+def create_rule(group, action, condition, argument=None, before=None):
     """Add a new membership rule for a group and return the id.
 
-    New rules are always added last in the ordering for the group
-    they are modifying.
+    New rules are added last in the ordering for the group they are
+    modifying, unless before names the id of a rule to insert ahead of.
     """
     if not group_exists(group):
         raise Failure("The group '{}' does not exist.".format(group))
-    existing = rules.select().where(
-        rules.c.group == group,
-    ).execute()
-    max_order = max([0] + [row.order for row in existing])
-    query = rules.insert().values(
-        group=group,
-        action=action,
-        condition=condition,
-        argument=argument,
-        order=max_order+1,
+    with changing_rules(group):
+        order = order_before(group, before)
+        with transaction() as t:
+            inserted = t.execute(
+                INSERT_RULE,
+                group=group,
+                action=action,
+                condition=condition,
+                argument=argument,
+                order=order,
+            )
+            t.execute(BUMP_RULE_GENERATION)
+    return inserted.inserted_primary_key[0]
+
+
+@metrics.instrumented
+def move_rule(rule_id, before=None):
+    """Move a rule to just ahead of another rule, or last if before is None."""
+    rule = get_rule(rule_id)
+    if before == rule_id:
+        return
+    with changing_rules(rule.group):
+        query = rules.update().where(
+            rules.c.id == rule_id,
+        ).values(
+            order=order_before(rule.group, before, moving=rule_id),
+        )
+        with transaction() as t:
+            t.execute(query)
+            t.execute(BUMP_RULE_GENERATION)
+
+
+@metrics.instrumented
+def reorder_rules(group, rule_ids):
+    """Put all of a group's rules in the given order.
+
+    Only rules that are out of place are rewritten: the longest run of
+    rules already in the right relative order keeps its order keys.
+    Returns the number of rules that were updated.
+    """
+    current = dict(
+        (row.id, row.order)
+        for row in execute(sqlalchemy.select([
+            rules.c.id, rules.c.order,
+        ]).where(
+            rules.c.group == group,
+        ))
     )
-    rule_id = query.execute().inserted_primary_key[0]
-    return rule_id
+    if sorted(rule_ids) != sorted(current):
+        raise Failure(
+            "The new order must list every rule of group '{}' once.".format(
+                group))
+    orders = [current[rule_id] for rule_id in rule_ids]
+    keep = increasing_run(orders)
+    updates = []
+    lower = None
+    start = 0
+    for position in sorted(keep) + [len(orders)]:
+        upper = orders[position] if position < len(orders) else None
+        moved = rule_ids[start:position]
+        new_orders = spread(lower, upper, len(moved))
+        if new_orders is None:
+            # No room between the neighbours; renumber the whole group.
+            updates = [
+                (rule_id, (i + 1) * ORDER_GAP)
+                for i, rule_id in enumerate(rule_ids)
+                if current[rule_id] != (i + 1) * ORDER_GAP
+            ]
+            break
+        updates.extend(zip(moved, new_orders))
+        lower = upper
+        start = position + 1
+    with changing_rules(group):
+        set_orders(updates)
+    return len(updates)
 
 
+def get_rule(rule_id):
+    rule = execute(SELECT_RULE, rule_id=rule_id).first()
+    if not rule:
+        raise Failure("No rule with id {} exists.".format(rule_id))
+    return rule
+
+
+def order_before(group, before, moving=None):
+    """Pick an order key for a rule placed ahead of another (or last).
+
+    Renumbers the group if there's no room left at that spot. moving is
+    the id of a rule being moved, which is ignored as a neighbour.
+    """
+    if before is None and moving is None:
+        highest = execute(SELECT_LAST_ORDER, group=group).scalar()
+        return (highest or 0) + ORDER_GAP
+    others = rules.c.group == group
+    if moving is not None:
+        others &= rules.c.id != moving
+    if before is None:
+        highest = execute(sqlalchemy.select([
+            sqlalchemy.func.max(rules.c.order),
+        ]).where(others)).scalar()
+        return (highest or 0) + ORDER_GAP
+    upper = get_rule(before)
+    if upper.group != group:
+        raise Failure("Rule {} is not in group '{}'.".format(before, group))
+    lower = execute(sqlalchemy.select([
+        sqlalchemy.func.max(rules.c.order),
+    ]).where(
+        others & (rules.c.order < upper.order),
+    )).scalar()
+    if lower is None:
+        return upper.order - ORDER_GAP
+    if upper.order - lower < 2:
+        respace_rules(group, moving)
+        return order_before(group, before, moving)
+    return (lower + upper.order) // 2
+
+
+def respace_rules(group, skip=None):
+    """Renumber a group's rules ORDER_GAP apart, keeping their order."""
+    rule_ids = [
+        row.id
+        for row in execute(sqlalchemy.select([rules.c.id]).where(
+            rules.c.group == group,
+        ).order_by(rules.c.order))
+        if row.id != skip
+    ]
+    set_orders([
+        (rule_id, (i + 1) * ORDER_GAP) for i, rule_id in enumerate(rule_ids)
+    ])
+
+
+def set_orders(updates):
+    """Write (rule id, order) pairs in a single executemany."""
+    if not updates:
+        return
+    query = rules.update().where(
+        rules.c.id == sqlalchemy.bindparam("rule_id"),
+    ).values(
+        order=sqlalchemy.bindparam("new_order"),
+    )
+    with transaction() as t:
+        t.execute(query, [
+            dict(rule_id=rule_id, new_order=order)
+            for rule_id, order in updates
+        ])
+        t.execute(BUMP_RULE_GENERATION)
+
+
+def spread(lower, upper, count):
+    """Return count increasing integers strictly between lower and upper.
+
+    Either bound may be None for no bound. Returns None if they don't fit.
+    """
+    if not count:
+        return []
+    if lower is None and upper is None:
+        lower = 0
+    if upper is None:
+        return [lower + (i + 1) * ORDER_GAP for i in range(count)]
+    if lower is None:
+        return [upper - (count - i) * ORDER_GAP for i in range(count)]
+    step = (upper - lower) // (count + 1)
+    if step < 1:
+        return None
+    return [lower + (i + 1) * step for i in range(count)]
+
+
+def increasing_run(values):
+    """Return the positions of a longest strictly increasing subsequence."""
+    tails = []
+    tail_positions = []
+    previous = [None] * len(values)
+    for position, value in enumerate(values):
+        i = bisect.bisect_left(tails, value)
+        if i == len(tails):
+            tails.append(value)
+            tail_positions.append(position)
+        else:
+            tails[i] = value
+            tail_positions[i] = position
+        previous[position] = tail_positions[i - 1] if i else None
+    run = set()
+    position = tail_positions[-1] if tail_positions else None
+    while position is not None:
+        run.add(position)
+        position = previous[position]
+    return run
+
+
+@metrics.instrumented
 def drop_rule(rule_id):
     """Remove an existing rule."""
-    query = rules.delete().where(rules.c.id == rule_id)
-    query.execute()
+    rule = execute(SELECT_RULE, rule_id=rule_id).first()
+    if not rule:
+        return
+    with changing_rules(rule.group):
+        with transaction() as t:
+            t.execute(DELETE_RULE, rule_id=rule_id)
+            t.execute(BUMP_RULE_GENERATION)
 
 
+@metrics.instrumented
 def evaluate_rules(group, entity):
     """Evaluate a group's rules for an entity.
 
     Returns one of "grant", "deny", or "ignore".
     """
-    group_rules = rules.select().where(
-        rules.c.group == group,
-    ).order_by(
-        rules.c.order,
-    ).execute()
-    for rule in group_rules:
-        if rule.condition == "always":
-            return rule.action
-        # TODO: add more conditions
-        else:
-            raise Failure(
-                "Unknown condition '{}' for rule.".format(
-                    rule.condition))
-    return "ignore"
+    return compile_rules(group).evaluate(entity)
+
+
+@metrics.instrumented
+def evaluate_rules_many(group, entities):
+    """Evaluate a group's rules for each of several entities, in order."""
+    return compile_rules(group).evaluate_many(entities)
+
+
+def compile_rules(group):
+    """Return the group's rules as a cached RuleProgram."""
+    sync_rule_programs()
+    program = RULE_PROGRAMS.get(group)
+    if program is None:
+        version = RULES.version
+        group_rules = execute(SELECT_GROUP_RULES, group=group)
+        program = RuleProgram(group_rules)
+        RULES.store(RULE_PROGRAMS, [(group, program)], version)
+    return program
+
+
+class RuleProgram(object):
+    """A group's ordered rules, compiled to checks on an entity.
+
+    The first rule whose condition holds decides the result.
+    """
+
+    def __init__(self, group_rules):
+        self.steps = []
+        for rule in group_rules:
+            check = compile_condition(rule.condition, rule.argument)
+            self.steps.append((check, rule.action))
+            if check is always:
+                # Nothing after this rule can ever be reached.
+                break
+
+    def evaluate(self, entity):
+        for check, action in self.steps:
+            if check(entity):
+                return action
+        return "ignore"
+
+    def evaluate_many(self, entities):
+        return [self.evaluate(entity) for entity in entities]
+
+
+def always(entity):
+    return True
+
+
+def compile_condition(condition, argument):
+    """Turn a rule's condition into a function of the entity."""
+    if condition == "always":
+        return always
+    # TODO: add more conditions
+
+    def unknown(entity):
+        raise Failure("Unknown condition '{}' for rule.".format(condition))
+    return unknown
@@ -0,0 +1,122 @@
+"""Snapshot files of the group graph and account expansions.
+
+A freshly started process has empty caches, and warming them takes a
+great many queries. save() writes the groups, their edges and every
+group's accounts to a file stamped with the change log generation they
+are current with. load() installs a snapshot in another process and
+replays the log from the stamp, so that only what changed since is read
+from the db:
+
+    snapshot.save("/var/cache/soundauth/groups")    # once, anywhere
+    snapshot.load("/var/cache/soundauth/groups")    # in every worker
+
+The file is a JSON header followed by sorted arrays of 64-bit account
+IDs, and load() maps it read-only. With compact accounts (see
+soundauth.group.use_compact_accounts()) and NumPy, cached expansions are
+views of the mapping, so every worker that loads the same file shares
+the same pages. Otherwise they are copied out of it.
+"""
+import json
+import mmap
+import os
+import struct
+
+from . import accountset
+from . import group
+from .graph import GroupGraph
+
+
+class Failure(Exception): pass
+
+
+MAGIC = b"soundauth-snapshot-1\n"
+# Followed by the length of the header, which ends 8-byte aligned.
+HEADER_LENGTH = struct.Struct("<Q")
+
+
+def save(path):
+    """Write a snapshot of the groups to path, and return its generation.
+
+    The file is written alongside path and then renamed over it, so a
+    worker loading it never sees part of one.
+    """
+    generation, graph, expansions = group.export_state()
+    edges = []
+    direct = {}
+    for parent, child, edgetype in sorted(graph.edges()):
+        if edgetype == "account":
+            direct.setdefault(parent, []).append(int(child))
+        else:
+            edges.append([parent, child, edgetype])
+    header = {
+        "generation": generation,
+        "groups": sorted(graph.groups()),
+        "edges": edges,
+        "direct": {},
+        "accounts": {},
+    }
+    arrays = []
+    offset = 0
+    for section, sets in (("direct", direct), ("accounts", expansions)):
+        for name in sorted(sets):
+            data = accountset.dump(sets[name])
+            header[section][name] = [offset, len(data) // 8]
+            arrays.append(data)
+            offset += len(data)
+    encoded = json.dumps(header, sort_keys=True).encode("utf-8")
+    # Pad the header so that the arrays start 8-byte aligned.
+    encoded += b" " * (-(len(MAGIC) + HEADER_LENGTH.size + len(encoded)) % 8)
+    partial = path + ".partial"
+    with open(partial, "wb") as f:
+        f.write(MAGIC)
+        f.write(HEADER_LENGTH.pack(len(encoded)))
+        f.write(encoded)
+        for data in arrays:
+            f.write(data)
+    os.rename(partial, path)
+    return generation
+
+
+def load(path, graph=False):
+    """Install the snapshot at path in this process, and return its generation.
+
+    Changes logged since the snapshot was taken are then applied, as by
+    soundauth.group.sync_caches(). With graph=True, the snapshot's graph
+    also answers reads, as with soundauth.group.load_graph(). Fails if
+    the file isn't a snapshot, or is too old or too new for the db, in
+    which case the caches are left as they were.
+    """
+    with open(path, "rb") as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise Failure("The snapshot '{}' is empty.".format(path))
+    start = len(MAGIC) + HEADER_LENGTH.size
+    if mapped[:len(MAGIC)] != MAGIC:
+        raise Failure("'{}' isn't a snapshot.".format(path))
+    length, = HEADER_LENGTH.unpack(mapped[len(MAGIC):start])
+    header = json.loads(mapped[start:start + length].decode("utf-8"))
+    base = start + length
+
+    def accounts(offset, count):
+        return accountset.from_buffer(mapped, base + offset, count)
+
+    expansions = dict(
+        (name, group.account_set(accounts(offset, count)))
+        for name, (offset, count) in header["accounts"].items()
+    )
+    loaded = None
+    if graph:
+        loaded = GroupGraph()
+        for name in header["groups"]:
+            loaded.add_group(name)
+        for parent, child, edgetype in header["edges"]:
+            loaded.add_edge(parent, child, edgetype)
+        for parent, (offset, count) in header["direct"].items():
+            for account in accounts(offset, count):
+                loaded.add_edge(parent, unicode(account), "account")
+    try:
+        group.restore_state(header["generation"], expansions, loaded)
+    except group.Failure as e:
+        raise Failure("The snapshot '{}' is out of date: {}".format(path, e))
+    return header["generation"]
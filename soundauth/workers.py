@@ -0,0 +1,156 @@
+import multiprocessing
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Failure(Exception): pass
+
+
+class Result(object):
+    """The eventual outcome of a call submitted to a WorkerPool."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._value = None
+        self._error = None
+
+    @classmethod
+    def of(cls, value):
+        """Return a Result that is already settled with value."""
+        result = cls()
+        result.set_result(value)
+        return result
+
+    def set_result(self, value):
+        self._value = value
+        self._settle()
+
+    def set_exception(self, error):
+        self._error = error
+        self._settle()
+
+    def _settle(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def get(self, timeout=None):
+        """Wait for the call to finish, then return or raise its outcome."""
+        if not self._done.wait(timeout):
+            raise Failure("Timed out waiting for a result.")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def add_done_callback(self, callback):
+        """Call callback(result) once settled, from the settling thread."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+# Calls queued per worker, when a WorkerPool isn't given max_pending.
+PENDING_PER_WORKER = 16
+
+
+class WorkerPool(object):
+    """Runs calls on background threads, fed from a bounded queue.
+
+    With processes=True each thread hands its call to a process pool
+    instead, for work that holds the GIL. Functions and arguments must
+    then be picklable. When max_pending calls are already queued,
+    submit() blocks until there is room. max_pending defaults to
+    PENDING_PER_WORKER for each worker; pass 0 for no limit.
+    """
+
+    def __init__(self, workers=4, processes=False, max_pending=None):
+        if max_pending is None:
+            max_pending = workers * PENDING_PER_WORKER
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._processes = None
+        if processes:
+            self._processes = multiprocessing.Pool(workers)
+        self._threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args):
+        """Queue func(*args) and return a Result for it."""
+        result = Result()
+        self._queue.put((func, args, result))
+        return result
+
+    def map(self, func, items):
+        """Run func on every item concurrently and return the outcomes."""
+        results = [self.submit(func, item) for item in items]
+        return [result.get() for result in results]
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            func, args, result = item
+            try:
+                if self._processes is not None:
+                    value = self._processes.apply(func, args)
+                else:
+                    value = func(*args)
+            except Exception as e:
+                result.set_exception(e)
+            else:
+                result.set_result(value)
+
+    def shutdown(self):
+        """Finish queued work, then stop the threads and processes."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._processes is not None:
+            self._processes.close()
+            self._processes.join()
+
+
+def to_asyncio(result, loop=None, then=None):
+    """Wrap a Result in an asyncio future settled on the event loop.
+
+    If given, then(value) is called on the event loop's thread and its
+    return value is used for the future instead.
+    """
+    import asyncio
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def settle(result):
+        if future.cancelled():
+            return
+        try:
+            value = result.get()
+            if then is not None:
+                value = then(value)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(value)
+
+    result.add_done_callback(
+        lambda result: loop.call_soon_threadsafe(settle, result))
+    return future
@@ -0,0 +1,4 @@
+from soundauth import db
+
+# The tests all share one in-memory database.
+db.init(create_schema=True)
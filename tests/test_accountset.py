@@ -0,0 +1,108 @@
+import sys
+import unittest
+
+from soundauth import accountset
+from soundauth.accountset import AccountSet
+
+
+class TestAccountSet(unittest.TestCase):
+
+    def test_behaves_like_a_set(self):
+        accounts = AccountSet([3, 1, 2, 3])
+        self.assertEqual(len(accounts), 3)
+        self.assertEqual(list(accounts), [1, 2, 3])
+        self.assertIn(2, accounts)
+        self.assertNotIn(4, accounts)
+        self.assertNotIn(0, accounts)
+        self.assertFalse(AccountSet())
+        self.assertEqual(accounts, set([1, 2, 3]))
+        self.assertEqual(frozenset([1, 2, 3]), accounts)
+        self.assertNotEqual(accounts, set([1, 2]))
+        self.assertEqual(hash(accounts), hash(frozenset([1, 2, 3])))
+
+    def test_algebra(self):
+        a = AccountSet([1, 2, 3, 4])
+        b = AccountSet([3, 4, 5])
+        self.assertEqual(a | b, set([1, 2, 3, 4, 5]))
+        self.assertEqual(a & b, set([3, 4]))
+        self.assertEqual(a - b, set([1, 2]))
+        self.assertEqual(a ^ b, set([1, 2, 5]))
+        self.assertIsInstance(a | b, AccountSet)
+
+    def test_mixes_with_sets(self):
+        a = AccountSet([1, 2, 3])
+        self.assertEqual(a | set([4]), set([1, 2, 3, 4]))
+        self.assertEqual(set([2, 5]) & a, set([2]))
+        self.assertEqual(frozenset([1, 5]) - a, set([5]))
+        self.assertEqual(a - frozenset([1, 5]), set([2, 3]))
+        self.assertEqual(set([1, 5]) ^ a, set([2, 3, 5]))
+
+    def test_combine(self):
+        accounts = accountset.combine(
+            [1],
+            [AccountSet([2, 3])],
+            [AccountSet([4, 5, 6]), set([5, 6, 7])],
+            [AccountSet([3, 6])],
+        )
+        self.assertEqual(accounts, set([1, 2, 5]))
+        self.assertEqual(accountset.combine([], [], [], []), set())
+
+    def test_contains_each(self):
+        accounts = AccountSet([10, 20, 30])
+        self.assertEqual(
+            accounts.contains_each([20, 25, 30, 40]),
+            [True, False, True, False])
+        self.assertEqual(accounts.contains_each([]), [])
+
+    def test_above(self):
+        accounts = AccountSet([5, 1, 3])
+        self.assertEqual(list(accounts.above()), [1, 3, 5])
+        self.assertEqual(list(accounts.above(1)), [3, 5])
+        self.assertEqual(list(accounts.above(4)), [5])
+        self.assertEqual(list(accounts.above(5)), [])
+
+    def test_stream_algebra(self):
+        self.assertEqual(
+            list(accountset.iter_union([[1, 3, 5], [2, 3], []])),
+            [1, 2, 3, 5])
+        self.assertEqual(
+            list(accountset.iter_intersection([[1, 3, 5, 7], [3, 4, 7], [0, 3, 7, 9]])),
+            [3, 7])
+        self.assertEqual(list(accountset.iter_intersection([[1], []])), [])
+        self.assertEqual(
+            list(accountset.iter_difference([1, 2, 3, 5, 8], [2, 4, 5])),
+            [1, 3, 8])
+
+    def test_large_ids(self):
+        accounts = AccountSet([2 ** 40, 1])
+        self.assertIn(2 ** 40, accounts)
+        self.assertEqual(accounts & set([2 ** 40]), set([2 ** 40]))
+
+    def test_smaller_than_frozenset(self):
+        accounts = range(10000)
+        self.assertLess(
+            sys.getsizeof(AccountSet(accounts)),
+            sys.getsizeof(frozenset(accounts)) / 2)
+
+
+class TestAccountSetWithoutNumpy(TestAccountSet):
+    """Runs the account set tests on stdlib arrays."""
+
+    def setUp(self):
+        self.numpy = accountset.NUMPY
+        accountset.NUMPY = None
+
+    def tearDown(self):
+        accountset.NUMPY = self.numpy
+
+
+@unittest.skipIf(accountset.numpy is None, "NumPy is not installed")
+class TestAccountSetWithNumpy(TestAccountSet):
+    """Runs the account set tests on NumPy arrays."""
+
+    def setUp(self):
+        self.numpy = accountset.NUMPY
+        accountset.NUMPY = accountset.numpy
+
+    def tearDown(self):
+        accountset.NUMPY = self.numpy
@@ -1,8 +1,15 @@
 import unittest
 
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+import bcrypt
 
 from soundauth import account
 from soundauth import auth
+from soundauth import workers
 
 
 class TestAuth(unittest.TestCase):
@@ -62,3 +69,199 @@ class TestBcrypt(unittest.TestCase):
 
     def test_verify_missing_fails(self):
         self.assertFalse(auth.verify_authenticator("qux", "bar"))
+
+
+class TestBcryptUpgrade(unittest.TestCase):
+
+    def setUp(self):
+        self.account = account.create_account()
+        self.cost = auth.BCRYPT_COST
+        auth.BCRYPT_COST = 5
+
+    def tearDown(self):
+        auth.BCRYPT_COST = self.cost
+        auth.drop_authenticator("foo")
+        account.drop_account(self.account)
+
+    def cost_of(self, name):
+        verifier = auth.find_verifier(name)
+        self.assertTrue(verifier.startswith("bcrypt:"))
+        return int(verifier.split("$")[2])
+
+    def test_legacy_verifier_is_upgraded(self):
+        legacy = bcrypt.hashpw("bar", bcrypt.gensalt(4))
+        auth.create_authenticator("foo", legacy, self.account)
+        self.assertTrue(auth.verify_authenticator("foo", "bar"))
+        self.assertEqual(self.cost_of("foo"), 5)
+        self.assertTrue(auth.verify_authenticator("foo", "bar"))
+
+    def test_low_cost_is_upgraded_on_success_only(self):
+        auth.create_authenticator(
+            "foo", auth.make_bcrypt_verifier("bar", 4), self.account)
+        self.assertFalse(auth.verify_authenticator("foo", "baz"))
+        self.assertEqual(self.cost_of("foo"), 4)
+        self.assertTrue(auth.verify_authenticator("foo", "bar"))
+        self.assertEqual(self.cost_of("foo"), 5)
+
+    def test_higher_cost_is_kept(self):
+        auth.create_authenticator(
+            "foo", auth.make_bcrypt_verifier("bar", 6), self.account)
+        self.assertTrue(auth.verify_authenticator("foo", "bar"))
+        self.assertEqual(self.cost_of("foo"), 6)
+
+    def test_plaintext_is_kept(self):
+        auth.create_authenticator("foo", "plaintext:bar", self.account)
+        self.assertTrue(auth.verify_authenticator("foo", "bar"))
+        self.assertEqual(auth.find_verifier("foo"), "plaintext:bar")
+
+    def test_changed_verifier_is_not_overwritten(self):
+        auth.create_authenticator("foo", "plaintext:bar", self.account)
+        auth.replace_verifier("foo", "plaintext:old", "plaintext:new")
+        self.assertEqual(auth.find_verifier("foo"), "plaintext:bar")
+
+    @unittest.skipIf(asyncio is None, "asyncio is not available")
+    def test_async_verify_upgrades(self):
+        auth.create_authenticator(
+            "foo", auth.make_bcrypt_verifier("bar", 4), self.account)
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertTrue(loop.run_until_complete(
+                auth.verify_authenticator_async("foo", "bar", loop=loop)))
+        finally:
+            loop.close()
+        self.assertEqual(self.cost_of("foo"), 5)
+
+    def test_calibrate_bcrypt_cost(self):
+        self.assertEqual(
+            auth.calibrate_bcrypt_cost(target=0, minimum=4, maximum=6), 4)
+        self.assertEqual(
+            auth.calibrate_bcrypt_cost(target=60, minimum=4, maximum=6), 6)
+        self.assertEqual(auth.BCRYPT_COST, 6)
+
+
+class TestSessions(unittest.TestCase):
+
+    def setUp(self):
+        self.account = account.create_account()
+        auth.create_authenticator("foo", "plaintext:bar", self.account)
+        auth.configure_sessions("test-key", ttl=60)
+
+    def tearDown(self):
+        auth.SESSION_KEY = None
+        account.drop_account(self.account)
+
+    def test_issue_and_verify(self):
+        token = auth.issue_session_token("foo", "bar")
+        self.assertEqual(auth.verify_session_token(token), self.account)
+        self.assertEqual(auth.check_session_token(token), self.account)
+        self.assertTrue(auth.verify_authenticator(
+            auth.session_name(self.account), token))
+
+    def test_wrong_credentials(self):
+        self.assertIsNone(auth.issue_session_token("foo", "baz"))
+
+    def test_tampered_token_fails(self):
+        token = auth.issue_session_token("foo", "bar")
+        account, rest = token.split(":", 1)
+        forged = "{}:{}".format(int(account) + 1, rest)
+        self.assertIsNone(auth.verify_session_token(forged))
+        self.assertIsNone(auth.verify_session_token("garbage"))
+
+    def test_token_for_another_account_fails(self):
+        other = account.create_account()
+        try:
+            auth.create_authenticator("qux", "plaintext:quux", other)
+            token = auth.issue_session_token("qux", "quux")
+            self.assertFalse(auth.verify_authenticator(
+                auth.session_name(self.account), token))
+        finally:
+            account.drop_account(other)
+
+    def test_expired_token_fails(self):
+        token = auth.issue_session_token("foo", "bar", ttl=-1)
+        self.assertIsNone(auth.check_session_token(token))
+
+    def test_revoke_sessions(self):
+        old = auth.issue_session_token("foo", "bar")
+        auth.revoke_sessions(self.account)
+        self.assertIsNone(auth.verify_session_token(old))
+        # Without a db lookup the revocation can't be seen.
+        self.assertEqual(auth.check_session_token(old), self.account)
+        new = auth.issue_session_token("foo", "bar")
+        self.assertEqual(auth.verify_session_token(new), self.account)
+
+    def test_tokens_of_a_dropped_account_fail(self):
+        token = auth.issue_session_token("foo", "bar")
+        account.drop_account(self.account)
+        self.account = account.create_account()
+        auth.create_authenticator("foo", "plaintext:bar", self.account)
+        auth.issue_session_token("foo", "bar")
+        self.assertIsNone(auth.verify_session_token(token))
+
+    def test_recreated_sessions_stay_revoked(self):
+        token = auth.issue_session_token("foo", "bar")
+        auth.drop_authenticator(auth.session_name(self.account))
+        auth.issue_session_token("foo", "bar")
+        self.assertIsNone(auth.verify_session_token(token))
+
+    def test_session_names_are_reserved(self):
+        with self.assertRaises(auth.Failure):
+            auth.create_authenticator(
+                auth.session_name(self.account), "plaintext:bar", self.account)
+
+    def test_other_key_fails(self):
+        token = auth.issue_session_token("foo", "bar")
+        auth.configure_sessions("other-key")
+        self.assertIsNone(auth.verify_session_token(token))
+
+    def test_unconfigured_fails(self):
+        auth.SESSION_KEY = None
+        with self.assertRaises(auth.Failure):
+            auth.issue_session_token("foo", "bar")
+
+
+class TestPooledBcrypt(unittest.TestCase):
+
+    processes = False
+
+    def setUp(self):
+        self.account = account.create_account()
+        auth.configure_pool(workers=2, processes=self.processes, max_pending=4)
+        auth.create_bcrypt_authenticator("foo", "bar", self.account)
+
+    def tearDown(self):
+        auth.drop_authenticator("foo")
+        auth.shutdown_pool()
+        account.drop_account(self.account)
+
+    def test_pooled_verify(self):
+        results = [
+            auth.verify_authenticator_pooled("foo", secret)
+            for secret in ["bar", "baz", "bar"]
+        ]
+        self.assertEqual([r.get(10) for r in results], [True, False, True])
+
+    def test_pooled_verify_missing(self):
+        self.assertFalse(auth.verify_authenticator_pooled("qux", "bar").get())
+
+    def test_default_queue_is_bounded(self):
+        auth.configure_pool(workers=2, processes=self.processes)
+        self.assertEqual(
+            auth.get_pool()._queue.maxsize, 2 * workers.PENDING_PER_WORKER)
+
+    @unittest.skipIf(asyncio is None, "asyncio is not available")
+    def test_async_create_and_verify(self):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(auth.create_bcrypt_authenticator_async(
+                "qux", "quux", self.account, loop=loop))
+            self.assertTrue(loop.run_until_complete(
+                auth.verify_authenticator_async("qux", "quux", loop=loop)))
+        finally:
+            auth.drop_authenticator("qux")
+            loop.close()
+
+
+class TestProcessPooledBcrypt(TestPooledBcrypt):
+
+    processes = True
@@ -0,0 +1,110 @@
+import io
+import unittest
+
+from soundauth import account
+from soundauth import auth
+from soundauth import bulk
+from soundauth import group
+
+
+RECORDS = [
+    {"type": "account", "id": 1001},
+    {"type": "account", "id": 1002},
+    {"type": "authenticator", "name": "alice", "account": 1001,
+     "password": "secret"},
+    {"type": "authenticator", "name": "bob", "account": 1002,
+     "verifier": "plaintext:hunter"},
+    {"type": "group", "name": "admins"},
+    {"type": "group", "name": "staff"},
+    {"type": "member", "group": "admins", "member": "1001",
+     "edgetype": "account"},
+    {"type": "member", "group": "staff", "member": "admins"},
+    {"type": "member", "group": "staff", "member": "1002",
+     "edgetype": "account"},
+]
+
+
+class TestBulk(unittest.TestCase):
+
+    def tearDown(self):
+        for name in ("alice", "bob"):
+            auth.drop_authenticator(name)
+        for name in ("admins", "staff"):
+            group.drop_group(name)
+        account.drop_account(1001)
+        account.drop_account(1002)
+
+    def test_load(self):
+        counts = bulk.load(iter(RECORDS), batch_size=2)
+        self.assertEqual(counts["member"], 3)
+        self.assertTrue(auth.verify_authenticator("alice", "secret"))
+        self.assertTrue(auth.verify_authenticator("bob", "hunter"))
+        self.assertEqual(group.list_accounts("staff"), set([1001, 1002]))
+
+    def test_new_accounts_follow_loaded_ids(self):
+        bulk.load(iter(RECORDS))
+        created = account.create_account()
+        try:
+            self.assertGreater(created, 1002)
+        finally:
+            account.drop_account(created)
+
+    def test_missing_group_loads_nothing(self):
+        records = RECORDS + [{"type": "member", "group": "nope", "member": "1"}]
+        with self.assertRaises(bulk.Failure):
+            bulk.load(iter(records))
+        self.assertFalse(group.group_exists("admins"))
+        self.assertFalse(auth.verify_authenticator("bob", "hunter"))
+
+    def test_session_names_are_reserved(self):
+        for record in [
+            {"name": "session:1001", "password": "secret"},
+            {"name": "session:1001", "verifier": "plaintext:hunter"},
+            {"name": "session:1002", "verifier": "session:1001:5"},
+            {"name": "session:7", "verifier": "session:7:5"},
+        ]:
+            record.update(type="authenticator", account=1001)
+            with self.assertRaises(bulk.Failure):
+                bulk.load(iter(RECORDS + [record]))
+        self.assertFalse(group.group_exists("admins"))
+
+    def test_round_trip_sessions(self):
+        auth.configure_sessions("key")
+        bulk.load(iter(RECORDS))
+        try:
+            token = auth.issue_session_token("bob", "hunter")
+            dumped = list(bulk.dump())
+            self.tearDown()
+            bulk.load(iter(dumped))
+            self.assertEqual(auth.verify_session_token(token), 1002)
+        finally:
+            auth.SESSION_KEY = None
+            auth.drop_authenticator(auth.session_name(1002))
+
+    def test_unknown_type_fails(self):
+        with self.assertRaises(bulk.Failure):
+            bulk.load(iter([{"type": "nope"}]))
+
+    def test_round_trip_csv(self):
+        bulk.load(iter(RECORDS))
+        out = io.BytesIO()
+        bulk.write_csv(out, [
+            r for r in bulk.dump() if r.get("name") != "alice"])
+        dumped = list(bulk.read_csv(io.BytesIO(out.getvalue())))
+        self.assertIn(
+            {"type": "member", "group": "staff", "member": "admins",
+             "edgetype": "or"},
+            dumped,
+        )
+        self.assertIn(
+            {"type": "authenticator", "name": "bob", "account": "1002",
+             "verifier": "plaintext:hunter"},
+            dumped,
+        )
+
+    def test_read_jsonl(self):
+        stream = io.StringIO(u'{"type": "group", "name": "x"}\n\n')
+        self.assertEqual(
+            list(bulk.read_jsonl(stream)),
+            [{"type": "group", "name": "x"}],
+        )
@@ -0,0 +1,90 @@
+import unittest
+
+from soundauth import cache
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestExpansionCache(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        c = cache.ExpansionCache()
+        self.assertIsNone(c.get("foo"))
+        c["foo"] = frozenset([1, 2])
+        self.assertEqual(c.get("foo"), set([1, 2]))
+        self.assertEqual(c.hits, 1)
+        self.assertEqual(c.misses, 1)
+
+    def test_lru_eviction_by_entries(self):
+        c = cache.ExpansionCache(max_entries=2)
+        c["foo"] = frozenset([1])
+        c["bar"] = frozenset([2])
+        c.get("foo")
+        c["baz"] = frozenset([3])
+        self.assertIn("foo", c)
+        self.assertNotIn("bar", c)
+        self.assertEqual(c.evictions, 1)
+
+    def test_eviction_by_weight(self):
+        c = cache.ExpansionCache(max_weight=3)
+        c["foo"] = frozenset([1, 2])
+        c["bar"] = frozenset([3, 4])
+        self.assertNotIn("foo", c)
+        self.assertEqual(c.weight, 2)
+        c["baz"] = frozenset([1, 2, 3, 4])
+        self.assertNotIn("baz", c)
+        self.assertIn("bar", c)
+
+    def test_ttl(self):
+        clock = FakeClock()
+        c = cache.ExpansionCache(ttl=10, clock=clock)
+        c["foo"] = frozenset([1])
+        clock.now = 5
+        self.assertEqual(c.get("foo"), set([1]))
+        clock.now = 10
+        self.assertIsNone(c.get("foo"))
+        self.assertEqual(c.expirations, 1)
+        self.assertEqual(len(c), 0)
+
+    def test_stats(self):
+        c = cache.ExpansionCache()
+        c["foo"] = frozenset(range(100))
+        stats = c.stats()
+        self.assertEqual(stats["entries"], 1)
+        self.assertEqual(stats["weight"], 100)
+        self.assertGreater(stats["memory"], 100)
+
+
+class TestCacheVersion(unittest.TestCase):
+
+    def test_store(self):
+        versioned = cache.CacheVersion()
+        entries = {}
+        versioned.store(entries, [("a", 1)], versioned.version)
+        self.assertEqual(entries, {"a": 1})
+
+    def test_store_during_a_write_is_not_kept(self):
+        versioned = cache.CacheVersion()
+        entries = {}
+        version = versioned.version
+        with versioned.changing():
+            pass
+        versioned.store(entries, [("a", 1)], version)
+        self.assertEqual(entries, {})
+
+    def test_writer_keeps_its_own_entries(self):
+        versioned = cache.CacheVersion()
+        entries = {}
+        with versioned.changing():
+            with versioned.changing():
+                versioned.store(entries, [("a", 1)], versioned.version)
+            self.assertEqual(versioned.version % 2, 1)
+        self.assertEqual(entries, {"a": 1})
+        self.assertEqual(versioned.version, 2)
@@ -0,0 +1,117 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import sqlalchemy.dialects.postgresql
+
+from soundauth import db
+
+
+class TestCreateEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.url = "sqlite:///" + os.path.join(self.directory, "auth.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_production_profile(self):
+        engine = db.create_engine(self.url, **db.PRODUCTION_PROFILE)
+        self.assertFalse(engine.echo)
+        self.assertEqual(
+            engine.execute("PRAGMA journal_mode").scalar().lower(),
+            "wal",
+        )
+        self.assertEqual(engine.execute("PRAGMA synchronous").scalar(), 1)
+        self.assertEqual(engine.execute("SELECT 1").scalar(), 1)
+
+    def test_dialect_hook_gets_settings(self):
+        seen = []
+        hook = db.dialect_hook("sqlite", "custom")(
+            lambda engine, tuning: seen.append(tuning))
+        try:
+            db.create_engine(self.url, echo=True, custom=1)
+        finally:
+            db.DIALECT_HOOKS["sqlite"].remove(hook)
+        self.assertEqual(seen, [{"custom": 1}])
+
+    def test_unknown_settings_fail(self):
+        with self.assertRaises(TypeError):
+            db.create_engine(self.url, pool_sise=10)
+
+    def test_other_dialects_settings_are_allowed(self):
+        hook = db.dialect_hook("postgresql", "postgresql_custom")(
+            lambda engine, tuning: None)
+        try:
+            db.create_engine(self.url, postgresql_custom=1)
+        finally:
+            db.DIALECT_HOOKS["postgresql"].remove(hook)
+
+    def test_forked_child_gets_fresh_connection(self):
+        engine = db.create_engine(self.url)
+        engine.execute("CREATE TABLE t (x INTEGER)")
+        connection = engine.connect()
+        parent_connection = connection.connection.connection
+        connection.close()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                connection = engine.connect()
+                if connection.connection.connection is not parent_connection:
+                    status = 0
+                connection.close()
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(engine.execute("SELECT count(*) FROM t").scalar(), 0)
+
+
+class TestLazyInit(unittest.TestCase):
+
+    def test_import_does_not_connect(self):
+        code = (
+            "from soundauth import auth, account, group, rule, db\n"
+            "assert db.ENGINE_SINGLETON is None\n"
+        )
+        self.assertEqual(subprocess.call([sys.executable, "-c", code]), 0)
+
+
+class TestCompiledCache(unittest.TestCase):
+
+    def test_prepared_statements_compile_once(self):
+        from soundauth import group
+        cache = db.get_engine()._execution_options["compiled_cache"]
+        group.group_exists("foo")
+        size = len(cache)
+        for name in ("foo", "bar", "baz"):
+            group.group_exists(name)
+            group.is_member(name, "qux")
+        group.group_exists("foo")
+        self.assertLessEqual(len(cache), size + 1)
+
+
+class TestResetSequence(unittest.TestCase):
+
+    def test_postgresql_moves_past_largest_id(self):
+        executed = []
+
+        class Postgres(object):
+            dialect = sqlalchemy.dialects.postgresql.dialect()
+
+            def execute(self, statement):
+                executed.append(str(statement))
+        db.reset_sequence(Postgres(), db.accounts)
+        self.assertEqual(executed, [
+            "SELECT setval(pg_get_serial_sequence('accounts', 'id'), "
+            "coalesce(max(id), 0) + 1, false) FROM accounts",
+        ])
+
+    def test_sqlite_needs_nothing(self):
+        with db.transaction() as t:
+            db.reset_sequence(t, db.accounts)
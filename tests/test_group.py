@@ -1,6 +1,10 @@
+import threading
 import unittest
 
+from soundauth import bulk
+from soundauth import db
 from soundauth import group
+from soundauth.accountset import AccountSet
 
 
 class TestGroup(unittest.TestCase):
@@ -79,6 +83,22 @@ class TestComplexGroup(unittest.TestCase):
         self.assertTrue(group.is_member_account("foo", 2))
         self.assertFalse(group.is_member_account("foo", 3))
 
+    def test_point_checks_skip_other_accounts(self):
+        group.clear_caches()
+        list_members = group.list_members
+
+        def fail(name):
+            self.fail("Read every member of '{}'.".format(name))
+        group.list_members = fail
+        try:
+            self.assertTrue(group.is_member_account("foo", 2))
+            self.assertFalse(group.is_member_account("foo", 3))
+            self.assertEqual(
+                group.check_account_memberships(3, ["foo", "bar", "qux"]),
+                {"foo": False, "bar": True, "qux": True})
+        finally:
+            group.list_members = list_members
+
     def test_dropping_group_drops_members(self):
         group.drop_group("bar")
         self.assertFalse(group.is_member("foo", "bar"))
@@ -117,3 +137,905 @@ class TestComplexGroup(unittest.TestCase):
             group.list_accounts("qux"),
             set([3]),
         )
+
+    def test_iter_accounts(self):
+        for name in ("foo", "bar", "baz", "qux"):
+            group.clear_account_cache()
+            streamed = list(group.iter_accounts(name, chunk_size=1))
+            expected = sorted(group.list_accounts(name))
+            self.assertEqual(streamed, [[a] for a in expected], name)
+            self.assertEqual(list(group.iter_accounts(name)), [expected])
+
+    def test_page_accounts(self):
+        group.clear_account_cache()
+        self.assertEqual(group.page_accounts("bar", limit=1), ([2], 2))
+        self.assertEqual(group.page_accounts("bar", after=2, limit=1), ([3], None))
+        self.assertEqual(group.page_accounts("foo", after=1), ([2], None))
+        self.assertEqual(group.page_accounts("qux", after=3), ([], None))
+
+
+class TestComplexGroupGraph(TestComplexGroup):
+    """Runs the complex group tests against the in-memory graph."""
+
+    def setUp(self):
+        group.load_graph()
+        super(TestComplexGroupGraph, self).setUp()
+
+    def tearDown(self):
+        super(TestComplexGroupGraph, self).tearDown()
+        group.unload_graph()
+
+    def test_graph_matches_db(self):
+        graph = group.GRAPH
+        group.unload_graph()
+        try:
+            expected = group.list_members("foo")
+        finally:
+            group.GRAPH = graph
+        self.assertEqual(group.list_members("foo"), expected)
+
+    def test_graph_loaded_after_writes(self):
+        group.unload_graph()
+        group.load_graph()
+        self.assertTrue(group.group_exists("qux"))
+        self.assertEqual(group.list_parents("bar"), set(["foo", "qux"]))
+        self.assertEqual(group.list_accounts("qux"), set([3]))
+
+
+class TestComplexGroupRecursive(TestComplexGroup):
+    """Runs the complex group tests using recursive queries."""
+
+    def setUp(self):
+        group.use_recursive_queries()
+        super(TestComplexGroupRecursive, self).setUp()
+        group.clear_caches()
+
+    def tearDown(self):
+        super(TestComplexGroupRecursive, self).tearDown()
+        group.use_recursive_queries(False)
+
+    def test_list_descendants(self):
+        self.assertEqual(
+            group.list_descendants("qux"),
+            set(["bar", "baz", "2", "3", "4"]),
+        )
+
+    def test_expansion_caches_subgroups(self):
+        group.list_accounts("foo")
+        self.assertEqual(group.ACCOUNT_EXPANSIONS_CACHE["bar"], set([2, 3]))
+
+
+class TestComplexGroupIncremental(TestComplexGroup):
+    """Runs the complex group tests with incremental cache maintenance."""
+
+    def setUp(self):
+        group.use_incremental_caches()
+        super(TestComplexGroupIncremental, self).setUp()
+
+    def tearDown(self):
+        super(TestComplexGroupIncremental, self).tearDown()
+        group.use_incremental_caches(False)
+
+    def assertCachesFresh(self):
+        cached = dict(group.ACCOUNT_EXPANSIONS_CACHE)
+        group.clear_account_cache()
+        for name, accounts in cached.items():
+            self.assertEqual(accounts, group.list_accounts(name), name)
+
+    def test_account_edits_update_ancestors(self):
+        self.assertEqual(group.list_accounts("qux"), set([3]))
+        self.assertEqual(group.list_accounts("foo"), set([1, 2]))
+        group.add_member_account("bar", 4)
+        self.assertEqual(group.ACCOUNT_EXPANSIONS_CACHE["qux"], set([3, 4]))
+        self.assertEqual(group.ACCOUNT_EXPANSIONS_CACHE["foo"], set([1, 2]))
+        group.drop_member_account("baz", 3)
+        self.assertEqual(group.ACCOUNT_EXPANSIONS_CACHE["foo"], set([1, 2, 3]))
+        self.assertEqual(group.ACCOUNT_EXPANSIONS_CACHE["qux"], set([4]))
+        self.assertCachesFresh()
+        group.drop_member_account("bar", 4)
+
+    def test_account_edits_skip_other_accounts(self):
+        self.assertEqual(group.list_accounts("qux"), set([3]))
+        self.assertEqual(group.list_accounts("foo"), set([1, 2]))
+        list_members = group.list_members
+
+        def fail(name):
+            self.fail("Read every member of '{}'.".format(name))
+        group.list_members = fail
+        try:
+            group.add_member_account("bar", 4)
+            group.drop_member_account("bar", 4)
+        finally:
+            group.list_members = list_members
+        self.assertCachesFresh()
+
+    def test_subgroup_edits_update_ancestors(self):
+        group.create_group("quux")
+        try:
+            group.add_member_account("quux", 3)
+            group.add_member_account("quux", 5)
+            self.assertEqual(group.list_accounts("foo"), set([1, 2]))
+            self.assertEqual(group.list_accounts("qux"), set([3]))
+            group.add_subgroup("bar", "quux")
+            self.assertEqual(
+                group.ACCOUNT_EXPANSIONS_CACHE["foo"],
+                set([1, 2, 5]),
+            )
+            group.add_subgroup("foo", "qux", edgetype="and")
+            self.assertCachesFresh()
+            group.drop_subgroup("foo", "qux", edgetype="and")
+            group.drop_subgroup("bar", "quux")
+            self.assertEqual(group.list_accounts("qux"), set([3]))
+            self.assertCachesFresh()
+        finally:
+            group.drop_group("quux")
+
+
+class TestComplexGroupCompact(TestComplexGroup):
+    """Runs the complex group tests with compact account sets."""
+
+    def setUp(self):
+        group.use_compact_accounts()
+        super(TestComplexGroupCompact, self).setUp()
+
+    def tearDown(self):
+        super(TestComplexGroupCompact, self).tearDown()
+        group.use_compact_accounts(False)
+
+    def test_expansions_are_compact(self):
+        self.assertIsInstance(group.list_accounts("qux"), AccountSet)
+        self.assertEqual(
+            group.check_member_accounts("foo", [1, 3, 5]),
+            {1: True, 3: False, 5: False})
+
+
+class TestComplexGroupCompactIncremental(TestComplexGroupIncremental):
+    """Runs the incremental cache tests with compact account sets."""
+
+    def setUp(self):
+        group.use_compact_accounts()
+        super(TestComplexGroupCompactIncremental, self).setUp()
+
+    def tearDown(self):
+        super(TestComplexGroupCompactIncremental, self).tearDown()
+        group.use_compact_accounts(False)
+
+
+class TestComplexGroupBoundedCaches(TestComplexGroup):
+    """Runs the complex group tests with tiny expansion caches."""
+
+    def setUp(self):
+        group.configure_caches(max_entries=1)
+        super(TestComplexGroupBoundedCaches, self).setUp()
+
+    def tearDown(self):
+        super(TestComplexGroupBoundedCaches, self).tearDown()
+        group.configure_caches()
+
+    def test_cache_stats(self):
+        group.list_accounts("foo")
+        group.list_accounts("foo")
+        stats = group.cache_stats()["accounts"]
+        self.assertEqual(stats["entries"], 1)
+        self.assertGreater(stats["evictions"], 0)
+        self.assertGreater(stats["hits"], 0)
+
+
+class TestComplexGroupDictCaches(TestComplexGroup):
+    """Runs the complex group tests with plain dicts as caches."""
+
+    def setUp(self):
+        group.configure_caches(factory=dict)
+        super(TestComplexGroupDictCaches, self).setUp()
+
+    def tearDown(self):
+        super(TestComplexGroupDictCaches, self).tearDown()
+        group.configure_caches()
+
+    def test_cache_stats(self):
+        group.list_accounts("foo")
+        self.assertEqual(group.cache_stats(), {})
+
+
+class TestPointQueries(TestComplexGroup):
+    """Checks is_member_account() against a cold expansion cache."""
+
+    def setUp(self):
+        super(TestPointQueries, self).setUp()
+        group.clear_caches()
+
+    def test_point_query_does_not_expand(self):
+        self.assertTrue(group.is_member_account("foo", 2))
+        self.assertFalse(group.is_member_account("foo", 3))
+        self.assertFalse(group.is_member_account("foo", 5))
+        self.assertNotIn("foo", group.ACCOUNT_EXPANSIONS_CACHE)
+
+    def test_point_query_uses_cache(self):
+        group.list_accounts("bar")
+        group.ACCOUNT_EXPANSIONS_CACHE["bar"] = frozenset([2, 3, 5])
+        self.assertTrue(group.is_member_account("foo", 5))
+
+    def test_point_query_intersection(self):
+        for account in range(6):
+            self.assertEqual(
+                group.is_member_account("qux", account),
+                account == 3,
+            )
+
+
+class TestComplexGroupIndexed(TestComplexGroup):
+    """Runs the complex group tests with the account -> groups index."""
+
+    def setUp(self):
+        group.build_membership_index()
+        super(TestComplexGroupIndexed, self).setUp()
+
+    def tearDown(self):
+        super(TestComplexGroupIndexed, self).tearDown()
+        group.drop_membership_index()
+
+    def test_index_follows_edits(self):
+        group.drop_member_account("baz", 3)
+        self.assertEqual(
+            group.list_account_memberships(3),
+            set(["foo", "bar"]),
+        )
+        group.drop_group("foo")
+        self.assertEqual(group.list_account_memberships(3), set(["bar"]))
+        self.assertEqual(group.list_account_memberships(1), set())
+
+    def test_account_edits_are_indexed_without_expanding(self):
+        list_accounts = group.list_accounts
+
+        def fail(name):
+            self.fail("Expanded '{}'.".format(name))
+        group.list_accounts = fail
+        try:
+            group.add_member_account("bar", 4)
+            group.add_member_account("baz", 2)
+        finally:
+            group.list_accounts = list_accounts
+        try:
+            self.assertEqual(
+                group.list_account_memberships(4),
+                set(["bar", "baz", "qux"]),
+            )
+            self.assertEqual(
+                group.list_account_memberships(2),
+                set(["bar", "baz", "qux"]),
+            )
+        finally:
+            group.drop_member_account("bar", 4)
+            group.drop_member_account("baz", 2)
+        self.assertEqual(group.list_account_memberships(4), set(["baz"]))
+
+    def test_index_built_from_existing_groups(self):
+        group.build_membership_index()
+        self.assertEqual(
+            group.list_account_memberships(3),
+            set(["bar", "baz", "qux"]),
+        )
+
+
+class TestBatchQueries(TestComplexGroup):
+    """Checks the batch membership functions against a cold cache."""
+
+    def setUp(self):
+        super(TestBatchQueries, self).setUp()
+        group.clear_caches()
+
+    def test_check_member_accounts(self):
+        self.assertEqual(
+            group.check_member_accounts("foo", [1, 2, 3, 4, 5]),
+            {1: True, 2: True, 3: False, 4: False, 5: False},
+        )
+
+    def test_check_account_memberships(self):
+        self.assertEqual(
+            group.check_account_memberships(3, ["foo", "bar", "qux", "x"]),
+            {"foo": False, "bar": True, "qux": True, "x": False},
+        )
+
+    def test_load_members_batches_levels(self):
+        members = group.load_members(["foo", "qux"])
+        self.assertEqual(members("foo"), group.list_members("foo"))
+        self.assertEqual(members("bar"), set([("account", "2"), ("account", "3")]))
+
+
+class TestBatchQueriesRecursive(TestBatchQueries):
+
+    def setUp(self):
+        group.use_recursive_queries()
+        super(TestBatchQueriesRecursive, self).setUp()
+
+    def tearDown(self):
+        super(TestBatchQueriesRecursive, self).tearDown()
+        group.use_recursive_queries(False)
+
+
+def group_name(i):
+    """Spell i with letters only, since group names can't have digits."""
+    name = ""
+    while True:
+        i, letter = divmod(i, 26)
+        name += chr(ord("a") + letter)
+        if not i:
+            return "deep-" + name
+
+
+def remove_groups(names):
+    db.execute(db.group_members.delete().where(
+        db.group_members.c.parent.in_(names)))
+    db.execute(db.groups.delete().where(db.groups.c.name.in_(names)))
+    group.reload_state()
+
+
+class TestCyclicGroups(unittest.TestCase):
+    """Cycles can't be made with add_subgroup(), but may already exist."""
+
+    NAMES = ["cyc-a", "cyc-b", "cyc-c", "excluded"]
+
+    def setUp(self):
+        group.clear_caches()
+        records = [dict(type="group", name=name) for name in self.NAMES]
+        for parent, member, edgetype in [
+                ("cyc-a", "cyc-b", "or"),
+                ("cyc-a", "1", "account"),
+                ("cyc-b", "cyc-c", "or"),
+                ("cyc-b", "2", "account"),
+                ("cyc-b", "excluded", "not"),
+                ("cyc-c", "cyc-a", "or"),
+                ("cyc-c", "cyc-b", "not"),
+                ("excluded", "2", "account")]:
+            records.append(dict(
+                type="member", group=parent, member=member, edgetype=edgetype))
+        bulk.load(records)
+
+    def tearDown(self):
+        remove_groups(self.NAMES)
+
+    def test_list_accounts(self):
+        # The "not" edge inside the cycle is ignored; the one out isn't.
+        self.assertEqual(group.list_accounts("cyc-a"), set([1]))
+        self.assertEqual(group.list_accounts("cyc-b"), set([1]))
+        self.assertEqual(group.list_accounts("cyc-c"), set([1]))
+
+    def test_is_member_account(self):
+        self.assertTrue(group.is_member_account("cyc-b", 1))
+        self.assertFalse(group.is_member_account("cyc-a", 2))
+
+    def test_iter_accounts(self):
+        self.assertEqual(list(group.iter_accounts("cyc-c")), [[1]])
+
+    def test_check_account_memberships(self):
+        self.assertEqual(
+            group.check_account_memberships(1, ["cyc-a", "cyc-c"]),
+            {"cyc-a": True, "cyc-c": True},
+        )
+
+    def test_list_descendants(self):
+        self.assertEqual(
+            group.list_descendants("cyc-a"),
+            set(["cyc-a", "cyc-b", "cyc-c", "excluded", "1", "2"]),
+        )
+
+    def test_list_ancestors(self):
+        self.assertEqual(
+            group.list_ancestors("1"),
+            set(["cyc-a", "cyc-b", "cyc-c"]),
+        )
+        self.assertEqual(
+            group.list_account_memberships(1),
+            set(["cyc-a", "cyc-b", "cyc-c"]),
+        )
+
+    def test_add_subgroup_rejects_cycles(self):
+        with self.assertRaises(group.Failure):
+            group.add_subgroup("excluded", "cyc-a")
+        with self.assertRaises(group.Failure):
+            group.add_subgroup("excluded", "excluded", edgetype="not")
+        self.assertFalse(group.is_member("excluded", "cyc-a"))
+
+    def test_incremental_edits(self):
+        group.use_incremental_caches()
+        try:
+            group.list_accounts("cyc-a")
+            group.add_member_account("cyc-c", 5)
+            self.assertEqual(group.list_accounts("cyc-a"), set([1, 5]))
+            group.drop_member_account("cyc-a", 1)
+            self.assertEqual(group.list_accounts("cyc-b"), set([5]))
+        finally:
+            group.use_incremental_caches(False)
+
+
+class TestCyclicGroupsGraph(TestCyclicGroups):
+
+    def setUp(self):
+        group.load_graph()
+        super(TestCyclicGroupsGraph, self).setUp()
+
+    def tearDown(self):
+        super(TestCyclicGroupsGraph, self).tearDown()
+        group.unload_graph()
+
+
+class TestCyclicGroupsRecursive(TestCyclicGroups):
+
+    def setUp(self):
+        group.use_recursive_queries()
+        super(TestCyclicGroupsRecursive, self).setUp()
+
+    def tearDown(self):
+        super(TestCyclicGroupsRecursive, self).tearDown()
+        group.use_recursive_queries(False)
+
+
+class TestCyclicGroupsCompact(TestCyclicGroups):
+
+    def setUp(self):
+        group.use_compact_accounts()
+        super(TestCyclicGroupsCompact, self).setUp()
+
+    def tearDown(self):
+        super(TestCyclicGroupsCompact, self).tearDown()
+        group.use_compact_accounts(False)
+
+
+class TestDeepGroups(unittest.TestCase):
+    """A chain of groups deeper than Python's recursion limit."""
+
+    DEPTH = 1500
+
+    def setUp(self):
+        group.clear_caches()
+        self.names = [group_name(i) for i in range(self.DEPTH)]
+        records = [dict(type="group", name=name) for name in self.names]
+        for parent, child in zip(self.names, self.names[1:]):
+            records.append(dict(type="member", group=parent, member=child))
+        records.append(dict(
+            type="member", group=self.names[-1], member="1",
+            edgetype="account"))
+        bulk.load(records)
+
+    def tearDown(self):
+        remove_groups(self.names)
+
+    def test_list_accounts(self):
+        self.assertEqual(group.list_accounts(self.names[0]), set([1]))
+
+    def test_is_member_account(self):
+        self.assertTrue(group.is_member_account(self.names[0], 1))
+        self.assertFalse(group.is_member_account(self.names[0], 2))
+
+    def test_list_descendants(self):
+        self.assertEqual(
+            len(group.list_descendants(self.names[0])), self.DEPTH)
+
+    def test_iter_accounts(self):
+        self.assertEqual(list(group.iter_accounts(self.names[0])), [[1]])
+
+    def test_list_account_memberships(self):
+        self.assertEqual(
+            group.list_account_memberships(1), set(self.names))
+
+
+class TestDeepGroupsGraph(TestDeepGroups):
+
+    def setUp(self):
+        group.load_graph()
+        super(TestDeepGroupsGraph, self).setUp()
+
+    def tearDown(self):
+        super(TestDeepGroupsGraph, self).tearDown()
+        group.unload_graph()
+
+
+class TestDeepGroupsRecursive(TestDeepGroups):
+
+    def setUp(self):
+        group.use_recursive_queries()
+        super(TestDeepGroupsRecursive, self).setUp()
+
+    def tearDown(self):
+        super(TestDeepGroupsRecursive, self).tearDown()
+        group.use_recursive_queries(False)
+
+
+def write_elsewhere(op, parent, child, edgetype):
+    """Change an edge the way another process would, behind our caches."""
+    with db.transaction() as t:
+        if op == "add":
+            t.execute(group.INSERT_EDGE,
+                      parent=parent, child=child, edgetype=edgetype)
+        else:
+            t.execute(group.DELETE_EDGE,
+                      parent=parent, child=child, edgetype=edgetype)
+        group.record_change(t, op, parent, child, edgetype)
+
+
+class TestSync(unittest.TestCase):
+
+    def setUp(self):
+        group.create_group("foo")
+        group.create_group("bar")
+        group.add_subgroup("foo", "bar")
+        group.add_member_account("bar", 1)
+        group.configure_sync(0)
+
+    def tearDown(self):
+        group.SYNC_INTERVAL = None
+        group.drop_group("foo")
+        group.drop_group("bar")
+
+    def test_sees_other_writes(self):
+        self.assertEqual(group.list_accounts("foo"), set([1]))
+        write_elsewhere("add", "bar", "2", "account")
+        self.assertEqual(group.list_accounts("foo"), set([1, 2]))
+        write_elsewhere("drop", "bar", "1", "account")
+        self.assertFalse(group.is_member_account("foo", 1))
+        self.assertEqual(group.list_account_memberships(2), set(["foo", "bar"]))
+
+    def test_interval(self):
+        group.configure_sync(3600)
+        self.assertEqual(group.list_accounts("foo"), set([1]))
+        write_elsewhere("add", "bar", "2", "account")
+        self.assertEqual(group.list_accounts("foo"), set([1]))
+        group.sync_caches()
+        self.assertEqual(group.list_accounts("foo"), set([1, 2]))
+
+    def test_pruned_log_reloads(self):
+        self.assertEqual(group.list_accounts("foo"), set([1]))
+        group.SYNC_INTERVAL = 3600
+        write_elsewhere("add", "bar", "2", "account")
+        group.prune_changes(keep=0)
+        group.sync_caches()
+        self.assertEqual(group.list_accounts("foo"), set([1, 2]))
+
+    def test_graph_follows_other_writes(self):
+        group.load_graph()
+        try:
+            write_elsewhere("add", "foo", "3", "account")
+            self.assertTrue(group.is_member("foo", "3"))
+            self.assertEqual(group.list_accounts("foo"), set([1, 3]))
+        finally:
+            group.unload_graph()
+            group.drop_member_account("foo", 3)
+
+    def test_dropping_nothing_logs_nothing(self):
+        generation = db.execute(group.SELECT_GENERATION).first().generation
+        group.drop_group("quux")
+        after = db.execute(group.SELECT_GENERATION).first().generation
+        self.assertEqual(after, generation)
+
+    def test_drop_group_logs_its_edges(self):
+        generation = db.execute(group.SELECT_GENERATION).first().generation
+        group.drop_group("bar")
+        changes = db.execute(
+            group.SELECT_CHANGES, since=generation, until=generation + 1,
+        ).fetchall()
+        self.assertEqual(sorted(
+            (change.op, change.parent, change.child, change.edgetype)
+            for change in changes
+        ), [
+            ("drop", "bar", "1", "account"),
+            ("drop", "foo", "bar", "or"),
+            ("drop-group", "bar", None, None),
+        ])
+
+    def test_replays_group_drops(self):
+        group.load_graph()
+        reload_state = group.reload_state
+
+        def fail():
+            self.fail("A group drop should not reload everything.")
+        group.reload_state = fail
+        try:
+            self.assertEqual(group.list_accounts("foo"), set([1]))
+            with db.transaction() as t:
+                t.execute(group.DELETE_GROUP, name="bar")
+                t.execute(group.DELETE_GROUP_EDGES, name="bar")
+                group.record_changes(t, [
+                    ("drop", "foo", "bar", "or"),
+                    ("drop", "bar", "1", "account"),
+                    ("drop-group", "bar", None, None),
+                ])
+            self.assertEqual(group.list_accounts("foo"), set())
+            self.assertFalse(group.group_exists("bar"))
+            self.assertEqual(group.list_ancestors("1"), set())
+        finally:
+            group.reload_state = reload_state
+            group.unload_graph()
+
+
+class TestStreamedAccounts(unittest.TestCase):
+
+    def setUp(self):
+        self.chunk = group.STREAM_CHUNK
+        group.STREAM_CHUNK = 3
+        group.create_group("foo")
+        group.create_group("bar")
+        group.create_group("baz")
+        group.add_subgroup("foo", "bar")
+        group.add_subgroup("foo", "baz", edgetype="not")
+        group.apply_edits(
+            [("add", "foo", account, "account") for account in range(0, 40, 2)] +
+            [("add", "bar", account, "account") for account in range(0, 40, 3)] +
+            [("add", "baz", account, "account") for account in range(0, 40, 5)])
+        group.clear_caches()
+
+    def tearDown(self):
+        group.STREAM_CHUNK = self.chunk
+        group.drop_group("foo")
+        group.drop_group("bar")
+        group.drop_group("baz")
+
+    def test_pages_cover_the_group(self):
+        expected = sorted(
+            (set(range(0, 40, 2)) | set(range(0, 40, 3))) - set(range(0, 40, 5)))
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = group.page_accounts("foo", after=cursor, limit=4)
+            seen.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+        self.assertNotIn("foo", group.ACCOUNT_EXPANSIONS_CACHE)
+        self.assertEqual(sorted(group.list_accounts("foo")), expected)
+
+    def test_pages_read_only_what_they_need(self):
+        group.STREAM_CHUNK = 100
+        limits = []
+        execute = group.execute
+
+        def recording(statement, *args, **params):
+            if "limit" in params:
+                limits.append(params["limit"])
+            return execute(statement, *args, **params)
+        group.execute = recording
+        try:
+            page, cursor = group.page_accounts("foo", limit=4)
+        finally:
+            group.execute = execute
+        self.assertEqual(page, [2, 3, 4, 6])
+        if group.GRAPH is None:
+            self.assertEqual(limits, [5, 5, 5])
+
+    def test_pages_follow_edits(self):
+        group.add_member_account("foo", 1)
+        group.add_member_account("foo", 41)
+        group.drop_member_account("foo", 2)
+        page, cursor = group.page_accounts("foo", limit=3)
+        self.assertEqual((page, cursor), ([1, 3, 4], 4))
+        page, cursor = group.page_accounts("foo", after=34, limit=3)
+        self.assertEqual((page, cursor), ([36, 38, 39], 39))
+        page, cursor = group.page_accounts("foo", after=39, limit=3)
+        self.assertEqual((page, cursor), ([41], None))
+
+    def test_page_limit_must_be_positive(self):
+        self.assertRaises(group.Failure, group.page_accounts, "foo", limit=0)
+        self.assertRaises(group.Failure, group.page_accounts, "foo", limit=-1)
+
+    def test_shared_children_are_expanded(self):
+        group.create_group("qux")
+        try:
+            group.add_subgroup("qux", "bar", edgetype="and")
+            group.add_subgroup("qux", "foo", edgetype="and")
+            group.add_subgroup("qux", "baz")
+            expected = sorted(group.list_accounts("qux"))
+            group.clear_caches()
+            self.assertEqual(
+                sum(group.iter_accounts("qux", chunk_size=5), []), expected)
+            self.assertIn("bar", group.ACCOUNT_EXPANSIONS_CACHE)
+        finally:
+            group.drop_group("qux")
+
+
+class TestStreamedAccountsGraph(TestStreamedAccounts):
+
+    def setUp(self):
+        super(TestStreamedAccountsGraph, self).setUp()
+        group.load_graph()
+
+    def tearDown(self):
+        group.unload_graph()
+        super(TestStreamedAccountsGraph, self).tearDown()
+
+
+class TestBatchEdits(unittest.TestCase):
+
+    def setUp(self):
+        group.create_group("foo")
+        group.create_group("bar")
+        group.create_group("baz")
+        group.add_subgroup("foo", "bar")
+        group.add_subgroup("foo", "baz", edgetype="not")
+        group.add_member_account("bar", 1)
+        group.add_member_account("baz", 2)
+
+    def tearDown(self):
+        group.drop_group("foo")
+        group.drop_group("bar")
+        group.drop_group("baz")
+
+    def test_matches_single_edits(self):
+        self.assertEqual(group.list_accounts("foo"), set([1]))
+        self.assertEqual(group.list_ancestors("2"), set(["foo", "baz"]))
+        with group.batch() as edits:
+            edits.add_member_account("bar", 2)
+            edits.add_member_account("bar", 3)
+            edits.drop_member_account("baz", 2)
+            edits.add_subgroup("baz", "bar")
+            edits.drop_subgroup("foo", "baz", edgetype="not")
+        self.assertEqual(group.list_accounts("foo"), set([1, 2, 3]))
+        self.assertEqual(group.list_accounts("baz"), set([1, 2, 3]))
+        self.assertEqual(group.list_ancestors("2"), set(["foo", "bar", "baz"]))
+        self.assertEqual(group.list_descendants("baz"), set(["bar", "1", "2", "3"]))
+        self.assertEqual(group.list_account_memberships(3), set(["foo", "bar", "baz"]))
+
+    def test_returns_net_changes(self):
+        with group.batch() as edits:
+            edits.add_member_account("bar", 3)
+            edits.drop_member_account("bar", 3)
+            edits.add_member_account("bar", 1)
+            edits.drop_member_account("baz", 2)
+            edits.add_member_account("baz", 4)
+        self.assertEqual(edits.changes, [
+            ("drop", "baz", "2", "account"),
+            ("add", "baz", "4", "account"),
+        ])
+        self.assertEqual(group.apply_edits([]), [])
+
+    def test_writes_one_generation(self):
+        generation = db.execute(group.SELECT_GENERATION).first().generation
+        group.apply_edits([
+            ("add", "bar", 3, "account"),
+            ("add", "baz", 4, "account"),
+        ])
+        after = db.execute(group.SELECT_GENERATION).first().generation
+        self.assertEqual(after, generation + 1)
+
+    def test_missing_group_writes_nothing(self):
+        with self.assertRaises(group.Failure):
+            with group.batch() as edits:
+                edits.add_member_account("bar", 3)
+                edits.add_member_account("quux", 3)
+        self.assertFalse(group.is_member("bar", "3"))
+
+    def test_rejects_cycles(self):
+        with self.assertRaises(group.Failure):
+            group.apply_edits([
+                ("add", "baz", "foo", "or"),
+            ])
+        with self.assertRaises(group.Failure):
+            group.apply_edits([
+                ("add", "bar", "baz", "or"),
+                ("add", "baz", "bar", "or"),
+            ])
+        self.assertFalse(group.is_member("bar", "baz"))
+
+    def test_allows_reversing_an_edge(self):
+        group.apply_edits([
+            ("drop", "foo", "bar", "or"),
+            ("add", "bar", "foo", "or"),
+        ])
+        self.assertEqual(group.list_accounts("bar"), set([1]))
+        self.assertEqual(group.list_ancestors("foo"), set(["bar"]))
+
+    def test_nothing_applied_on_error(self):
+        with self.assertRaises(ZeroDivisionError):
+            with group.batch() as edits:
+                edits.add_member_account("bar", 3)
+                1 / 0
+        self.assertFalse(group.is_member("bar", "3"))
+
+
+class TestBatchEditsGraph(TestBatchEdits):
+    """Runs the batch edit tests against a loaded graph."""
+
+    def setUp(self):
+        super(TestBatchEditsGraph, self).setUp()
+        group.load_graph()
+
+    def tearDown(self):
+        group.unload_graph()
+        super(TestBatchEditsGraph, self).tearDown()
+
+
+class TestBatchEditsIncremental(TestBatchEdits):
+    """Runs the batch edit tests with incremental cache maintenance."""
+
+    def setUp(self):
+        group.use_incremental_caches()
+        super(TestBatchEditsIncremental, self).setUp()
+
+    def tearDown(self):
+        super(TestBatchEditsIncremental, self).tearDown()
+        group.use_incremental_caches(False)
+
+    def test_caches_stay_fresh(self):
+        group.build_membership_index()
+        try:
+            for name in ("foo", "bar", "baz"):
+                group.list_accounts(name)
+            group.apply_edits([
+                ("add", "bar", "2", "account"),
+                ("add", "baz", "3", "account"),
+                ("drop", "foo", "baz", "not"),
+                ("add", "foo", "baz", "and"),
+            ])
+            cached = dict(group.ACCOUNT_EXPANSIONS_CACHE)
+            group.clear_account_cache()
+            for name, accounts in cached.items():
+                self.assertEqual(accounts, group.list_accounts(name), name)
+            self.assertEqual(group.list_account_memberships(2), set(["foo", "bar", "baz"]))
+        finally:
+            group.drop_membership_index()
+
+
+class TestConcurrentCaches(unittest.TestCase):
+
+    def setUp(self):
+        group.create_group("foo")
+        group.create_group("bar")
+        group.add_subgroup("foo", "bar")
+        group.add_member_account("foo", 1)
+        group.add_member_account("bar", 2)
+        group.clear_caches()
+
+    def tearDown(self):
+        group.drop_group("foo")
+        group.drop_group("bar")
+
+    def test_results_read_during_a_write_are_not_cached(self):
+        def members(name):
+            edges = group.list_members(name)
+            if name == "bar":
+                # Lands after bar was read, but before foo is cached.
+                group.add_member_account("bar", 3)
+            return edges
+        self.assertEqual(group.evaluate_accounts("foo", members), set([1, 2]))
+        self.assertNotIn("foo", group.ACCOUNT_EXPANSIONS_CACHE)
+        self.assertEqual(group.list_accounts("foo"), set([1, 2, 3]))
+        group.drop_member_account("bar", 3)
+
+    def test_writers_keep_what_they_cache(self):
+        with group.changing_caches():
+            group.list_accounts("foo")
+        self.assertIn("foo", group.ACCOUNT_EXPANSIONS_CACHE)
+
+    def test_readers_and_writers_in_threads(self):
+        # Threads would each get their own in-memory db, so they read
+        # from the graph while this thread does the writing.
+        group.load_graph()
+        stop = threading.Event()
+        errors = []
+
+        def read():
+            try:
+                while not stop.is_set():
+                    group.list_accounts("foo")
+                    group.is_member_account("foo", 4)
+                    group.list_ancestors("4")
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        try:
+            for reader in readers:
+                reader.start()
+            for _ in range(50):
+                group.add_member_account("bar", 4)
+                group.drop_member_account("bar", 4)
+            group.add_member_account("bar", 4)
+        finally:
+            stop.set()
+            for reader in readers:
+                reader.join()
+        try:
+            self.assertEqual(errors, [])
+            self.assertEqual(group.list_accounts("foo"), set([1, 2, 4]))
+            self.assertEqual(group.list_ancestors("4"), set(["foo", "bar"]))
+        finally:
+            group.unload_graph()
+            group.drop_member_account("bar", 4)
@@ -0,0 +1,68 @@
+import unittest
+
+from soundauth import account
+from soundauth import auth
+from soundauth import group
+from soundauth import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        group.clear_caches()
+        group.create_group("foo")
+        group.create_group("bar")
+        group.add_subgroup("foo", "bar")
+        group.add_member_account("bar", 1)
+        self.recorder = metrics.Recorder()
+        metrics.set_sink(self.recorder)
+
+    def tearDown(self):
+        metrics.set_sink(None)
+        group.drop_group("foo")
+        group.drop_group("bar")
+        group.clear_caches()
+
+    def test_records_outermost_call_only(self):
+        self.assertEqual(group.list_accounts("foo"), set([1]))
+        totals = self.recorder.totals()
+        self.assertEqual(list(totals), ["group.list_accounts"])
+        self.assertEqual(totals["group.list_accounts"]["calls"], 1)
+        self.assertGreater(totals["group.list_accounts"]["queries"], 0)
+        self.assertEqual(totals["group.list_accounts"]["misses"], 2)
+
+    def test_counts_cache_hits(self):
+        group.list_accounts("foo")
+        self.recorder.reset()
+        self.assertTrue(group.is_member_account("foo", 1))
+        totals = self.recorder.totals()["group.is_member_account"]
+        self.assertEqual(totals["queries"], 0)
+        self.assertEqual(totals["hits"], 1)
+        self.assertEqual(totals["misses"], 0)
+
+    def test_records_failed_calls(self):
+        with self.assertRaises(group.Failure):
+            group.create_group("foo")
+        self.assertEqual(
+            self.recorder.totals()["group.create_group"]["calls"], 1)
+
+    def test_bcrypt_is_timed_separately(self):
+        account_id = account.create_account()
+        try:
+            auth.create_bcrypt_authenticator("foo", "bar", account_id)
+            self.recorder.reset()
+            self.assertTrue(auth.verify_authenticator("foo", "bar"))
+            totals = self.recorder.totals()
+            self.assertEqual(totals["auth.verify_authenticator"]["queries"], 1)
+            self.assertEqual(totals["auth.bcrypt"]["calls"], 1)
+            self.assertLessEqual(
+                totals["auth.bcrypt"]["seconds"],
+                totals["auth.verify_authenticator"]["seconds"])
+        finally:
+            auth.drop_authenticator("foo")
+            account.drop_account(account_id)
+
+    def test_nothing_recorded_without_sink(self):
+        metrics.set_sink(None)
+        group.list_accounts("foo")
+        self.assertEqual(self.recorder.totals(), {})
@@ -1,5 +1,6 @@
 import unittest
 
+from soundauth import db
 from soundauth import group
 from soundauth import rule
 
@@ -31,3 +32,135 @@ class TestRule(unittest.TestCase):
             )
         finally:
             rule.drop_rule(rule_id)
+
+    def test_rules_are_compiled_once(self):
+        rule_id = rule.create_rule("foo", "grant", "always")
+        try:
+            program = rule.compile_rules("foo")
+            self.assertIs(program, rule.compile_rules("foo"))
+            self.assertEqual(
+                rule.evaluate_rules_many("foo", [{}, {}]),
+                ["grant", "grant"],
+            )
+        finally:
+            rule.drop_rule(rule_id)
+
+    def test_changes_recompile(self):
+        self.assertEqual("ignore", rule.evaluate_rules("foo", {}))
+        rule_id = rule.create_rule("foo", "deny", "always")
+        self.assertEqual("deny", rule.evaluate_rules("foo", {}))
+        rule.drop_rule(rule_id)
+        self.assertEqual("ignore", rule.evaluate_rules("foo", {}))
+
+    def test_sees_other_processes_writes(self):
+        rule_id = rule.create_rule("foo", "deny", "always")
+        try:
+            rule.configure_sync(0)
+            self.assertEqual("deny", rule.evaluate_rules("foo", {}))
+            # Dropped the way another process would, behind our programs.
+            with db.transaction() as t:
+                t.execute(rule.DELETE_RULE, rule_id=rule_id)
+                t.execute(rule.BUMP_RULE_GENERATION)
+            self.assertEqual("ignore", rule.evaluate_rules("foo", {}))
+        finally:
+            rule.configure_sync(None)
+            rule.drop_rule(rule_id)
+
+    def test_configure_sync_drops_programs(self):
+        self.assertIsNone(rule.SYNC_INTERVAL)
+        rule.compile_rules("foo")
+        try:
+            rule.configure_sync(3600)
+            self.assertNotIn("foo", rule.RULE_PROGRAMS)
+        finally:
+            rule.configure_sync(None)
+
+    def test_program_read_during_a_write_is_not_kept(self):
+        added = []
+
+        class WriteWhileReading(rule.RuleProgram):
+            def __init__(self, group_rules):
+                super(WriteWhileReading, self).__init__(group_rules)
+                if not added:
+                    added.append(rule.create_rule("foo", "deny", "always"))
+        program = rule.RuleProgram
+        rule.RuleProgram = WriteWhileReading
+        try:
+            self.assertEqual("ignore", rule.evaluate_rules("foo", {}))
+            self.assertNotIn("foo", rule.RULE_PROGRAMS)
+            self.assertEqual("deny", rule.evaluate_rules("foo", {}))
+        finally:
+            rule.RuleProgram = program
+            rule.drop_rule(added[0])
+
+    def test_unknown_condition_fails_when_reached(self):
+        first = rule.create_rule("foo", "grant", "nonsense")
+        try:
+            with self.assertRaises(rule.Failure):
+                rule.evaluate_rules("foo", {})
+        finally:
+            rule.drop_rule(first)
+
+
+class TestRuleOrdering(unittest.TestCase):
+
+    def setUp(self):
+        group.create_group("foo")
+        self.rule_ids = [
+            rule.create_rule("foo", action, "always")
+            for action in ("grant", "deny", "grant", "deny")
+        ]
+
+    def tearDown(self):
+        for rule_id in self.rule_ids:
+            rule.drop_rule(rule_id)
+        group.drop_group("foo")
+
+    def ordered_ids(self):
+        return [
+            row.id for row in rule.execute(rule.rules.select().where(
+                rule.rules.c.group == "foo",
+            ).order_by(rule.rules.c.order))
+        ]
+
+    def test_insert_before(self):
+        first = self.rule_ids[0]
+        new = rule.create_rule("foo", "deny", "always", before=first)
+        self.rule_ids.append(new)
+        self.assertEqual(self.ordered_ids()[0], new)
+        self.assertEqual(rule.evaluate_rules("foo", {}), "deny")
+
+    def test_move_rule(self):
+        first, second, third, fourth = self.rule_ids
+        rule.move_rule(first)
+        self.assertEqual(self.ordered_ids(), [second, third, fourth, first])
+        rule.move_rule(fourth, before=second)
+        self.assertEqual(self.ordered_ids(), [fourth, second, third, first])
+
+    def test_insert_without_room_renumbers(self):
+        first, second = self.rule_ids[:2]
+        for _ in range(12):
+            self.rule_ids.append(
+                rule.create_rule("foo", "deny", "always", before=second))
+        ordered = self.ordered_ids()
+        self.assertEqual(ordered[0], first)
+        self.assertEqual(ordered[-3], second)
+        self.assertEqual(len(ordered), 16)
+
+    def test_reorder_touches_few_rows(self):
+        first, second, third, fourth = self.rule_ids
+        new_order = [second, third, fourth, first]
+        self.assertEqual(rule.reorder_rules("foo", new_order), 1)
+        self.assertEqual(self.ordered_ids(), new_order)
+        new_order = [fourth, third, second, first]
+        self.assertEqual(rule.reorder_rules("foo", new_order), 2)
+        self.assertEqual(self.ordered_ids(), new_order)
+        self.assertEqual(rule.evaluate_rules("foo", {}), "deny")
+
+    def test_reorder_requires_every_rule(self):
+        with self.assertRaises(rule.Failure):
+            rule.reorder_rules("foo", self.rule_ids[1:])
+
+    def test_increasing_run(self):
+        self.assertEqual(rule.increasing_run([5, 1, 2, 8, 3, 4]), set([1, 2, 4, 5]))
+        self.assertEqual(rule.increasing_run([]), set())
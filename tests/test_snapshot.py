@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from soundauth import accountset
+from soundauth import db
+from soundauth import group
+from soundauth import snapshot
+from soundauth.accountset import AccountSet
+
+
+def write_elsewhere(parent, account):
+    """Add an account the way another process would, behind our caches."""
+    with db.transaction() as t:
+        t.execute(group.INSERT_EDGE,
+                  parent=parent, child=unicode(account), edgetype="account")
+        group.record_change(t, "add", parent, unicode(account), "account")
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "groups")
+        group.create_group("foo")
+        group.create_group("bar")
+        group.create_group("baz")
+        group.add_subgroup("foo", "bar")
+        group.add_subgroup("foo", "baz", edgetype="not")
+        group.add_member_account("foo", 1)
+        group.add_member_account("bar", 2)
+        group.add_member_account("bar", 3)
+        group.add_member_account("baz", 3)
+
+    def tearDown(self):
+        group.unload_graph()
+        group.drop_group("foo")
+        group.drop_group("bar")
+        group.drop_group("baz")
+        shutil.rmtree(self.directory)
+
+    def test_load_fills_caches(self):
+        snapshot.save(self.path)
+        group.clear_caches()
+        snapshot.load(self.path)
+        self.assertEqual(group.ACCOUNT_EXPANSIONS_CACHE["foo"], set([1, 2]))
+        self.assertEqual(group.ACCOUNT_EXPANSIONS_CACHE["baz"], set([3]))
+        self.assertIsNone(group.GRAPH)
+
+    def test_load_graph(self):
+        snapshot.save(self.path)
+        group.clear_caches()
+        snapshot.load(self.path, graph=True)
+        self.assertEqual(
+            sorted(group.GRAPH.edges()), sorted(group.GroupGraph.load().edges()))
+        self.assertTrue(group.is_member("foo", "1"))
+
+    def test_load_catches_up(self):
+        generation = snapshot.save(self.path)
+        write_elsewhere("bar", 4)
+        self.assertEqual(snapshot.load(self.path, graph=True), generation)
+        self.assertEqual(group.list_accounts("foo"), set([1, 2, 4]))
+        self.assertTrue(group.is_member("bar", "4"))
+        group.drop_member_account("bar", 4)
+
+    def test_pruned_log_fails(self):
+        snapshot.save(self.path)
+        group.list_accounts("foo")
+        write_elsewhere("bar", 4)
+        group.prune_changes(keep=0)
+        with self.assertRaises(snapshot.Failure):
+            snapshot.load(self.path)
+        # The caches were left alone.
+        self.assertEqual(group.ACCOUNT_EXPANSIONS_CACHE["foo"], set([1, 2]))
+        group.drop_member_account("bar", 4)
+
+    def test_not_a_snapshot(self):
+        with open(self.path, "wb") as f:
+            f.write(b"hello")
+        with self.assertRaises(snapshot.Failure):
+            snapshot.load(self.path)
+
+    def test_compact_accounts(self):
+        group.use_compact_accounts()
+        try:
+            snapshot.save(self.path)
+            snapshot.load(self.path)
+            accounts = group.ACCOUNT_EXPANSIONS_CACHE["foo"]
+            self.assertIsInstance(accounts, AccountSet)
+            self.assertEqual(accounts, set([1, 2]))
+            self.assertEqual(group.list_accounts("bar"), set([2, 3]))
+        finally:
+            group.use_compact_accounts(False)
+
+
+class TestAccountDumps(unittest.TestCase):
+
+    def test_round_trip(self):
+        accounts = AccountSet([5, 2 ** 40, 1])
+        data = b"xxxxxxxx" + accountset.dump(accounts)
+        self.assertEqual(len(data), 32)
+        self.assertEqual(accountset.from_buffer(data, 8, 3), accounts)
+        self.assertEqual(accountset.from_buffer(data, 8, 0), set())